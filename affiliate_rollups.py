@@ -0,0 +1,183 @@
+import threading
+
+from database import telemetry_db
+
+class AffiliateRollups:
+    """Hourly and daily affiliate stats per (user, product, platform).
+
+    Clicks are folded into affiliate_stats_hourly/affiliate_stats_daily up to
+    a watermark kept in backfill_progress. The event ingestor advances it in
+    the same transaction that writes each click batch, and conversions apply
+    their deltas directly, so the rollups stay exact. Reads add the few raw
+    clicks above the watermark (the live tail), so a user's stats never scan
+    their full click history.
+
+    Committed changes bump an in-process per-user version, which live stats
+    streams wait on instead of polling.
+    """
+
+    job = 'affiliate_rollups'
+
+    # (table, bucket column, bucket expression over affiliate_clicks)
+    tables = (
+        ('affiliate_stats_hourly', 'hour', "strftime('%Y-%m-%d %H:00:00', clicked_at)"),
+        ('affiliate_stats_daily', 'day', 'DATE(clicked_at)'),
+    )
+
+    def __init__(self, database, batch_size=5000):
+        self.database = database
+        self.batch_size = batch_size
+        self._versions = {}
+        self._changed = threading.Condition()
+
+    def watermark(self, conn):
+        row = conn.execute('SELECT last_id FROM backfill_progress WHERE job = ?', (self.job,)).fetchone()
+        return row[0] if row else 0
+
+    def _set_watermark(self, conn, last_id):
+        conn.execute('''
+            INSERT INTO backfill_progress (job, last_id) VALUES (?, ?)
+            ON CONFLICT(job) DO UPDATE SET last_id = excluded.last_id, updated_at = CURRENT_TIMESTAMP
+        ''', (self.job, last_id))
+
+    def _fold(self, conn, where, params):
+        """Add the clicks matching `where` into both rollup tables"""
+        for table, bucket, expression in self.tables:
+            conn.execute(f'''
+                INSERT INTO {table} (user_id, {bucket}, product_id, platform, clicks, conversions, commission)
+                SELECT user_id, {expression}, product_id, platform,
+                       COUNT(*), COALESCE(SUM(converted), 0), COALESCE(SUM(commission_earned), 0)
+                FROM affiliate_clicks
+                WHERE {where}
+                GROUP BY 1, 2, 3, 4
+                ON CONFLICT(user_id, {bucket}, product_id, platform) DO UPDATE SET
+                    clicks = clicks + excluded.clicks,
+                    conversions = conversions + excluded.conversions,
+                    commission = commission + excluded.commission
+            ''', params)
+
+    def roll_up(self, conn):
+        """Fold clicks above the watermark into the rollups; returns how many.
+
+        Runs on the caller's connection, which must already hold the write
+        lock (the ingestor calls it right after inserting a batch).
+        """
+        last_id = self.watermark(conn)
+        upper_id, count = conn.execute('''
+            SELECT MAX(id), COUNT(*) FROM (
+                SELECT id FROM affiliate_clicks WHERE id > ? ORDER BY id LIMIT ?
+            )
+        ''', (last_id, self.batch_size)).fetchone()
+        if not count:
+            return 0
+        self._fold(conn, 'id > ? AND id <= ?', (last_id, upper_id))
+        self._set_watermark(conn, upper_id)
+        return count
+
+    def after_ingest(self, conn, grouped):
+        """Event ingestor hook: roll up right after a batch of clicks lands"""
+        if 'affiliate_click' in grouped:
+            self.roll_up(conn)
+
+    def after_commit(self, grouped):
+        """Event ingestor hook: wake streams of users whose clicks just landed"""
+        clicks = grouped.get('affiliate_click')
+        if clicks:
+            self.notify({params[0] for params in clicks})
+
+    # Change notification
+    def version(self, user_id):
+        with self._changed:
+            return self._versions.get(user_id, 0)
+
+    def notify(self, user_ids):
+        """Mark these users' stats changed; call only after the change commits"""
+        with self._changed:
+            for user_id in user_ids:
+                self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            self._changed.notify_all()
+
+    def wait_for_change(self, user_id, version, timeout):
+        """Block until the user's version differs from `version`; returns the current one"""
+        with self._changed:
+            self._changed.wait_for(lambda: self._versions.get(user_id, 0) != version, timeout)
+            return self._versions.get(user_id, 0)
+
+    def record_conversion(self, conn, user_id, product_id, commission_amount):
+        """Mark a user's clicks on a product converted, keeping the rollups in step.
+
+        Call inside a write transaction on the telemetry database
+        (telemetry_db.immediate) so the watermark cannot move underneath it.
+        """
+        watermark = self.watermark(conn)
+        # Deltas only for clicks already folded in; tail clicks are read raw
+        # and get rolled up later with their converted flag
+        for table, bucket, expression in self.tables:
+            conn.execute(f'''
+                INSERT INTO {table} (user_id, {bucket}, product_id, platform, clicks, conversions, commission)
+                SELECT user_id, {expression}, product_id, platform,
+                       0, SUM(1 - converted), SUM(? - commission_earned)
+                FROM affiliate_clicks
+                WHERE user_id = ? AND product_id = ? AND id <= ?
+                GROUP BY 1, 2, 3, 4
+                ON CONFLICT(user_id, {bucket}, product_id, platform) DO UPDATE SET
+                    conversions = conversions + excluded.conversions,
+                    commission = commission + excluded.commission
+            ''', (commission_amount, user_id, product_id, watermark))
+
+        conn.execute('''
+            UPDATE affiliate_clicks
+            SET converted = 1, commission_earned = ?
+            WHERE user_id = ? AND product_id = ?
+        ''', (commission_amount, user_id, product_id))
+
+    def user_stats(self, conn, user_id):
+        """Totals, today's clicks and this month's conversions for one user"""
+        rolled = conn.execute('''
+            SELECT COALESCE(SUM(clicks), 0),
+                   COALESCE(SUM(conversions), 0),
+                   COALESCE(SUM(commission), 0),
+                   COALESCE(SUM(CASE WHEN day = DATE('now') THEN clicks END), 0),
+                   COALESCE(SUM(CASE WHEN day >= DATE('now', 'start of month') THEN conversions END), 0)
+            FROM affiliate_stats_daily
+            WHERE user_id = ?
+        ''', (user_id,)).fetchone()
+
+        tail = conn.execute('''
+            SELECT COUNT(*),
+                   COALESCE(SUM(converted), 0),
+                   COALESCE(SUM(commission_earned), 0),
+                   COUNT(CASE WHEN clicked_at >= DATE('now') THEN 1 END),
+                   COUNT(CASE WHEN converted = 1 AND clicked_at >= DATE('now', 'start of month') THEN 1 END)
+            FROM affiliate_clicks
+            WHERE id > ? AND user_id = ?
+        ''', (self.watermark(conn), user_id)).fetchone()
+
+        keys = ('total_clicks', 'total_conversions', 'total_earned', 'clicks_today', 'conversions_month')
+        return {key: a + b for key, a, b in zip(keys, rolled, tail)}
+
+    def rebuild(self, conn, since=None):
+        """Recompute the rollups from raw clicks, fully or from day `since` on"""
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            upper_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM affiliate_clicks').fetchone()[0]
+            if since:
+                conn.execute('DELETE FROM affiliate_stats_hourly WHERE hour >= ?', (since,))
+                conn.execute('DELETE FROM affiliate_stats_daily WHERE day >= ?', (since,))
+                self._fold(conn, 'clicked_at >= ? AND id <= ?', (since, upper_id))
+                # Older clicks that were still in the tail
+                self._fold(conn, 'clicked_at < ? AND id > ? AND id <= ?',
+                           (since, self.watermark(conn), upper_id))
+            else:
+                conn.execute('DELETE FROM affiliate_stats_hourly')
+                conn.execute('DELETE FROM affiliate_stats_daily')
+                self._fold(conn, 'id <= ?', (upper_id,))
+            self._set_watermark(conn, upper_id)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return upper_id
+
+# Global affiliate rollups instance
+affiliate_rollups = AffiliateRollups(telemetry_db)
@@ -1,22 +1,45 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, session
 import os
 import random
 import string
 import sqlite3
 from datetime import datetime, timedelta
-import hashlib
 import secrets
 import re
+import json
+import csv
+import io
+import base64
+import hashlib
+import time
+import threading
 from functools import wraps
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 import random
+import click
 from translations import translator, t
+from database import db, get_db, get_report_db, telemetry_db, get_telemetry_db
+from counters import platform_counters
+from email_outbox import email_outbox
+from passwords import password_hasher, PasswordHasherBusy
+from ingestion import event_ingestor
+from affiliate_rollups import affiliate_rollups
+from catalog import catalog, catalog_sync, fetch_json_products, fts_query
+from inventory import inventory
+from product_import import product_importer
+from exports import exporter, EXPORT_DATASETS, EXPORT_FORMATS
+from migrations import schema, telemetry_schema
+from ledger import ledger
+from reconciliation import reconciler
+from money import to_cents, parse_cents, to_basis_points, apply_rate, to_dollars, to_rate, cents_sql, basis_points_sql
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dadaal_secret_key_2025_change_in_production')
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=24)
+app.config['DATABASE'] = 'dadaal.db'
+
+# Pooled, request-scoped SQLite connections (committed or rolled back at teardown)
+db.init_app(app)
+telemetry_db.init_app(app)
 
 # Make translation function available in templates
 @app.context_processor
@@ -25,19 +48,17 @@ def inject_translation():
 
 # Security functions
 def hash_password(password):
-    """Hash password with salt"""
-    salt = secrets.token_hex(16)
-    password_hash = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), 100000)
-    return salt + password_hash.hex()
+    """Hash password with salt (runs on the bounded hashing pool)"""
+    return password_hasher.hash(password)
 
 def verify_password(stored_password, provided_password):
-    """Verify password against hash"""
-    if not stored_password:
-        return False
-    salt = stored_password[:32]
-    stored_hash = stored_password[32:]
-    password_hash = hashlib.pbkdf2_hmac('sha256', provided_password.encode(), salt.encode(), 100000)
-    return password_hash.hex() == stored_hash
+    """Verify password against hash (runs on the bounded hashing pool)"""
+    return password_hasher.verify(stored_password, provided_password)
+
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(e):
+    """Shed load early when the hashing queue is full"""
+    return 'Adeegga waa mashquul. Fadlan isku day mar kale.', 503, {'Retry-After': '1'}
 
 def validate_email(email):
     """Validate email format"""
@@ -80,17 +101,10 @@ def generate_secure_token():
     return secrets.token_urlsafe(32)
 
 def send_reset_email(email, reset_token):
-    """Send password reset email"""
+    """Queue password reset email"""
+    reset_link = f"https://dadaal.onrender.com/reset_password/{reset_token}"
     try:
-        # Gmail SMTP configuration
-        smtp_server = "smtp.gmail.com"
-        smtp_port = 587
-        gmail_user = os.environ.get('GMAIL_USER')  # Your Gmail address
-        gmail_password = os.environ.get('GMAIL_APP_PASSWORD')  # Gmail App Password
-
-        reset_link = f"https://dadaal.onrender.com/reset_password/{reset_token}"
-
-        if not gmail_user or not gmail_password:
+        if not email_outbox.is_configured():
             print(f"⚠️ Gmail credentials not configured!")
             print(f"Reset link for {email}: {reset_link}")
             # For demo mode, show link in flash message
@@ -115,42 +129,22 @@ def send_reset_email(email, reset_token):
         Kooxda Dadaal App
         """
 
-        # Create message
-        msg = MIMEMultipart()
-        msg['From'] = gmail_user
-        msg['To'] = email
-        msg['Subject'] = subject
-        msg.attach(MIMEText(body, 'plain'))
-
-        # Send email
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()  # Enable TLS encryption
-        server.login(gmail_user, gmail_password)
-        text = msg.as_string()
-        server.sendmail(gmail_user, email, text)
-        server.quit()
-
-        print(f"Password reset email sent successfully to {email}")
+        # Delivered by the outbox worker once the request commits
+        email_outbox.enqueue(get_db(), email, subject, body)
+        print(f"Password reset email queued for {email}")
         return True
 
     except Exception as e:
-        print(f"Email sending error: {e}")
+        print(f"Email queueing error: {e}")
         print(f"Fallback: Password reset link for {email}: {reset_link}")
         return True  # Return True for demo purposes
 
 def send_verification_email(email, verification_code):
-    """Send email verification code"""
+    """Queue email verification code"""
     try:
-        # Gmail SMTP configuration
-        smtp_server = "smtp.gmail.com"
-        smtp_port = 587
-        gmail_user = os.environ.get('GMAIL_USER')  # Your Gmail address
-        gmail_password = os.environ.get('GMAIL_APP_PASSWORD')  # Gmail App Password
-
-        if not gmail_user or not gmail_password:
+        if not email_outbox.is_configured():
             print(f"Gmail credentials not configured. Verification code for {email}: {verification_code}")
             # For Render deployment, show code on screen if email fails
-            from flask import flash
             flash(f"Demo Mode: Verification code-kaagu waa: {verification_code}")
             return True  # Return True for demo purposes
 
@@ -169,26 +163,13 @@ def send_verification_email(email, verification_code):
         Kooxda Dadaal App
         """
 
-        # Create message
-        msg = MIMEMultipart()
-        msg['From'] = gmail_user
-        msg['To'] = email
-        msg['Subject'] = subject
-        msg.attach(MIMEText(body, 'plain'))
-
-        # Send email
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()  # Enable TLS encryption
-        server.login(gmail_user, gmail_password)
-        text = msg.as_string()
-        server.sendmail(gmail_user, email, text)
-        server.quit()
-
-        print(f"Verification email sent successfully to {email}")
+        # Delivered by the outbox worker once the request commits
+        email_outbox.enqueue(get_db(), email, subject, body)
+        print(f"Verification email queued for {email}")
         return True
 
     except Exception as e:
-        print(f"Email verification sending error: {e}")
+        print(f"Email verification queueing error: {e}")
         print(f"Fallback: Verification code for {email}: {verification_code}")
         return True  # Return True for demo purposes
 
@@ -196,9 +177,478 @@ def generate_verification_code():
     """Generate 6-digit verification code"""
     return str(random.randint(100000, 999999))
 
-# Database setup
-def init_db():
-    conn = sqlite3.connect('dadaal.db')
+# Rollup maintenance: each trigger runs inside the transaction of the write
+# that fired it, so the admin totals always match the base tables.
+def _rollup_upsert(table, key_columns, value_columns, key_values, value_values):
+    keys = ', '.join(key_columns)
+    columns = ', '.join(key_columns + value_columns)
+    values = ', '.join(key_values + value_values)
+    updates = ', '.join(f'{col} = {col} + excluded.{col}' for col in value_columns)
+    return (f'INSERT INTO {table} ({columns}) VALUES ({values}) '
+            f'ON CONFLICT({keys}) DO UPDATE SET {updates};')
+
+def _rollup_triggers(name, source, table, key_columns, value_columns, keys, values, update_of):
+    add_new = _rollup_upsert(table, key_columns, value_columns,
+                             [k.format(row='NEW') for k in keys], [v.format(row='NEW', sign='') for v in values])
+    remove_old = _rollup_upsert(table, key_columns, value_columns,
+                                [k.format(row='OLD') for k in keys], [v.format(row='OLD', sign='-') for v in values])
+    return [
+        f'CREATE TRIGGER IF NOT EXISTS trg_{name}_rollup_insert AFTER INSERT ON {source} BEGIN {add_new} END',
+        f'CREATE TRIGGER IF NOT EXISTS trg_{name}_rollup_delete AFTER DELETE ON {source} BEGIN {remove_old} END',
+        f'CREATE TRIGGER IF NOT EXISTS trg_{name}_rollup_update AFTER UPDATE OF {update_of} ON {source} '
+        f'BEGIN {remove_old} {add_new} END',
+    ]
+
+ROLLUP_TRIGGERS = (
+    _rollup_triggers('transactions', 'transactions', 'daily_transaction_totals',
+                     ['day', 'type', 'status'], ['tx_count', 'amount_total'],
+                     ["DATE({row}.created_at)", "{row}.type", "COALESCE({row}.status, 'completed')"],
+                     ["{sign}1", "{sign}COALESCE({row}.amount, 0)"],
+                     'amount, type, status, created_at')
+    + _rollup_triggers('users', 'users', 'user_status_totals',
+                       ['status'], ['user_count', 'earnings_total'],
+                       ["COALESCE({row}.status, 'active')"],
+                       ["{sign}1", "{sign}COALESCE({row}.total_earnings, 0)"],
+                       'status, total_earnings')
+    + _rollup_triggers('referrals', 'referrals', 'referral_status_totals',
+                       ['status'], ['referral_count', 'commission_total'],
+                       ["COALESCE({row}.status, 'pending')"],
+                       ["{sign}1", "{sign}COALESCE({row}.commission_earned, 0)"],
+                       'status, commission_earned')
+)
+
+REFERRAL_COUNT_TRIGGERS = (
+    '''CREATE TRIGGER IF NOT EXISTS trg_referrals_count_insert AFTER INSERT ON referrals
+       WHEN NEW.status = 'completed' BEGIN
+           UPDATE users SET referral_count = referral_count + 1 WHERE id = NEW.referrer_id;
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_referrals_count_delete AFTER DELETE ON referrals
+       WHEN OLD.status = 'completed' BEGIN
+           UPDATE users SET referral_count = referral_count - 1 WHERE id = OLD.referrer_id;
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_referrals_count_update AFTER UPDATE OF status, referrer_id ON referrals
+       BEGIN
+           UPDATE users SET referral_count = referral_count - 1
+           WHERE id = OLD.referrer_id AND OLD.status = 'completed';
+           UPDATE users SET referral_count = referral_count + 1
+           WHERE id = NEW.referrer_id AND NEW.status = 'completed';
+       END''',
+)
+
+# Dashboard/profile read model: one user_summary row per user, kept current by
+# triggers inside the transaction of every write to users, transactions or referrals
+RECENT_TRANSACTIONS_LIMIT = 10
+
+def _recent_transactions_sql(user_id):
+    """JSON array of [id, amount, type, description, created_at], newest first"""
+    return f'''(
+        SELECT json_group_array(json_array(id, amount, type, description, created_at)) FROM (
+            SELECT id, amount, type, description, created_at FROM transactions
+            WHERE user_id = {user_id} ORDER BY created_at DESC LIMIT {RECENT_TRANSACTIONS_LIMIT}
+        )
+    )'''
+
+def _refresh_recent_transactions(row):
+    return (f'UPDATE user_summary SET recent_transactions = {_recent_transactions_sql(f"{row}.user_id")} '
+            f'WHERE user_id = {row}.user_id;')
+
+def _referral_commission_delta(row, sign):
+    return (f"UPDATE user_summary SET referral_commission = referral_commission {sign} COALESCE({row}.commission_earned, 0) "
+            f"WHERE user_id = {row}.referrer_id AND {row}.status = 'completed';")
+
+USER_SUMMARY_TRIGGERS = (
+    '''CREATE TRIGGER IF NOT EXISTS trg_user_summary_insert AFTER INSERT ON users BEGIN
+           INSERT INTO user_summary (user_id, name, email, phone, referral_code, balance,
+                                     premium_until, referral_count, created_at)
+           VALUES (NEW.id, NEW.name, NEW.email, NEW.phone, NEW.referral_code, COALESCE(NEW.total_earnings, 0),
+                   NEW.premium_until, NEW.referral_count, NEW.created_at);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_user_summary_update
+       AFTER UPDATE OF name, email, phone, referral_code, total_earnings, premium_until, referral_count ON users
+       BEGIN
+           UPDATE user_summary SET name = NEW.name, email = NEW.email, phone = NEW.phone,
+               referral_code = NEW.referral_code, balance = COALESCE(NEW.total_earnings, 0),
+               premium_until = NEW.premium_until, referral_count = NEW.referral_count
+           WHERE user_id = NEW.id;
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_user_summary_delete AFTER DELETE ON users BEGIN
+           DELETE FROM user_summary WHERE user_id = OLD.id;
+       END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_user_summary_tx_insert AFTER INSERT ON transactions BEGIN
+           {_refresh_recent_transactions('NEW')}
+       END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_user_summary_tx_delete AFTER DELETE ON transactions BEGIN
+           {_refresh_recent_transactions('OLD')}
+       END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_user_summary_tx_update
+       AFTER UPDATE OF user_id, amount, type, description, created_at ON transactions BEGIN
+           {_refresh_recent_transactions('OLD')}
+           {_refresh_recent_transactions('NEW')}
+       END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_user_summary_referral_insert AFTER INSERT ON referrals BEGIN
+           {_referral_commission_delta('NEW', '+')}
+       END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_user_summary_referral_delete AFTER DELETE ON referrals BEGIN
+           {_referral_commission_delta('OLD', '-')}
+       END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_user_summary_referral_update
+       AFTER UPDATE OF status, referrer_id, commission_earned ON referrals BEGIN
+           {_referral_commission_delta('OLD', '-')}
+           {_referral_commission_delta('NEW', '+')}
+       END''',
+)
+
+# Ledger entries are immutable; users.total_earnings caches each user account's balance
+LEDGER_TRIGGERS = (
+    '''CREATE TRIGGER IF NOT EXISTS trg_ledger_no_update BEFORE UPDATE ON ledger_entries BEGIN
+           SELECT RAISE(ABORT, 'ledger entries are append-only');
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_ledger_no_delete BEFORE DELETE ON ledger_entries BEGIN
+           SELECT RAISE(ABORT, 'ledger entries are append-only');
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_ledger_user_balance AFTER INSERT ON ledger_entries
+       WHEN NEW.account LIKE 'user:%' BEGIN
+           UPDATE users SET total_earnings = COALESCE(total_earnings, 0) + NEW.amount
+           WHERE id = CAST(substr(NEW.account, 6) AS INTEGER);
+       END''',
+)
+
+# Users whose stored balance changed, however it changed, for the incremental reconciler
+BALANCE_CHANGE_TRIGGERS = (
+    '''CREATE TRIGGER IF NOT EXISTS trg_balance_changes_insert AFTER INSERT ON users
+       WHEN COALESCE(NEW.total_earnings, 0) != 0 BEGIN
+           INSERT INTO balance_changes (user_id) VALUES (NEW.id);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_balance_changes_update AFTER UPDATE OF total_earnings ON users
+       WHEN NEW.total_earnings IS NOT OLD.total_earnings BEGIN
+           INSERT INTO balance_changes (user_id) VALUES (NEW.id);
+       END''',
+)
+
+# Integer money columns: (REAL column, integer column, SQL conversion) per table.
+# Writers set both; the REAL column is the display copy (cents / 100).
+MONEY_COLUMNS = {
+    'transactions': [('amount', 'amount_cents', cents_sql)],
+    'users': [('total_earnings', 'earnings_cents', cents_sql)],
+    'referrals': [('commission_earned', 'commission_cents', cents_sql)],
+    'ledger_entries': [('amount', 'amount_cents', cents_sql)],
+    'wholesale_products': [('price', 'price_cents', cents_sql),
+                           ('wholesale_price', 'wholesale_price_cents', cents_sql),
+                           ('commission_rate', 'commission_bps', basis_points_sql)],
+    'wholesale_sales': [('unit_price', 'unit_price_cents', cents_sql),
+                        ('total_amount', 'total_cents', cents_sql),
+                        ('commission_amount', 'commission_cents', cents_sql),
+                        ('commission_rate', 'commission_bps', basis_points_sql)],
+    'wholesale_orders': [('total_amount', 'total_cents', cents_sql),
+                         ('commission_amount', 'commission_cents', cents_sql)],
+}
+
+# Mirror the REAL columns' defaults so inserts that omit both agree
+MONEY_COLUMN_DEFAULTS = {
+    'earnings_cents': ' NOT NULL DEFAULT 0',
+    'commission_bps': ' DEFAULT 1500',
+}
+
+def _money_fill(table, row):
+    """Set the integer columns of `row` from its REAL ones when they disagree"""
+    columns = MONEY_COLUMNS[table]
+    mismatch = ' OR '.join(f'{row}.{cents} IS NOT {convert(f"{row}.{real}")}' for real, cents, convert in columns)
+    updates = ', '.join(f'{cents} = {convert(f"{row}.{real}")}' for real, cents, convert in columns)
+    return mismatch, f'UPDATE {table} SET {updates} WHERE rowid = {row}.rowid;'
+
+def _money_fill_triggers(table, on_update=True):
+    mismatch, fill = _money_fill(table, 'NEW')
+    triggers = [f'CREATE TRIGGER IF NOT EXISTS trg_{table}_cents_insert AFTER INSERT ON {table} '
+                f'WHEN {mismatch} BEGIN {fill} END']
+    if on_update:
+        real_columns = ', '.join(real for real, _, _ in MONEY_COLUMNS[table])
+        triggers.append(f'CREATE TRIGGER IF NOT EXISTS trg_{table}_cents_update AFTER UPDATE OF {real_columns} '
+                        f'ON {table} WHEN {mismatch} BEGIN {fill} END')
+    return triggers
+
+# Writers that only set the REAL columns (older code, ad-hoc SQL) still get
+# their integer columns filled. Ledger entries are only ever inserted.
+MONEY_FILL_TRIGGERS = [statement for table in MONEY_COLUMNS
+                       for statement in _money_fill_triggers(table, on_update=table != 'ledger_entries')]
+
+MONEY_ROLLUP_TRIGGERS = (
+    _rollup_triggers('transactions_cents', 'transactions', 'daily_transaction_totals',
+                     ['day', 'type', 'status'], ['amount_total_cents'],
+                     ["DATE({row}.created_at)", "{row}.type", "COALESCE({row}.status, 'completed')"],
+                     ["{sign}COALESCE({row}.amount_cents, 0)"],
+                     'amount_cents, type, status, created_at')
+    + _rollup_triggers('users_cents', 'users', 'user_status_totals',
+                       ['status'], ['earnings_total_cents'],
+                       ["COALESCE({row}.status, 'active')"],
+                       ["{sign}COALESCE({row}.earnings_cents, 0)"],
+                       'status, earnings_cents')
+    + _rollup_triggers('referrals_cents', 'referrals', 'referral_status_totals',
+                       ['status'], ['commission_total_cents'],
+                       ["COALESCE({row}.status, 'pending')"],
+                       ["{sign}COALESCE({row}.commission_cents, 0)"],
+                       'status, commission_cents')
+)
+
+# Replaces trg_ledger_no_update and trg_ledger_user_balance: the one update an
+# entry may still take is filling in its amount_cents, and the cached balance
+# is kept in cents with total_earnings derived from it
+LEDGER_CENTS_TRIGGERS = (
+    '''CREATE TRIGGER IF NOT EXISTS trg_ledger_no_change BEFORE UPDATE ON ledger_entries
+       WHEN OLD.amount_cents IS NOT NULL OR NEW.id IS NOT OLD.id OR NEW.account IS NOT OLD.account
+            OR NEW.amount IS NOT OLD.amount OR NEW.source IS NOT OLD.source
+            OR NEW.transaction_id IS NOT OLD.transaction_id OR NEW.created_at IS NOT OLD.created_at
+       BEGIN
+           SELECT RAISE(ABORT, 'ledger entries are append-only');
+       END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_ledger_user_balance_cents AFTER INSERT ON ledger_entries
+       WHEN NEW.account LIKE 'user:%' BEGIN
+           UPDATE users SET
+               earnings_cents = COALESCE(earnings_cents, 0) + COALESCE(NEW.amount_cents, {cents_sql('NEW.amount')}),
+               total_earnings = (COALESCE(earnings_cents, 0)
+                                 + COALESCE(NEW.amount_cents, {cents_sql('NEW.amount')})) / 100.0
+           WHERE id = CAST(substr(NEW.account, 6) AS INTEGER);
+       END''',
+)
+
+def _referral_commission_cents_delta(row, sign):
+    cents = f'COALESCE({row}.commission_cents, 0)'
+    return (f"UPDATE user_summary SET referral_commission_cents = referral_commission_cents {sign} {cents}, "
+            f"referral_commission = (referral_commission_cents {sign} {cents}) / 100.0 "
+            f"WHERE user_id = {row}.referrer_id AND {row}.status = 'completed';")
+
+# Replace the user and referral triggers of USER_SUMMARY_TRIGGERS: balances and
+# referral commission are kept in cents, the REAL columns derived from them.
+# earnings_cents always changes with total_earnings (see MONEY_FILL_TRIGGERS).
+USER_SUMMARY_CENTS_TRIGGERS = (
+    '''CREATE TRIGGER IF NOT EXISTS trg_user_summary_cents_insert AFTER INSERT ON users BEGIN
+           INSERT INTO user_summary (user_id, name, email, phone, referral_code, balance, balance_cents,
+                                     premium_until, referral_count, created_at)
+           VALUES (NEW.id, NEW.name, NEW.email, NEW.phone, NEW.referral_code, NEW.earnings_cents / 100.0,
+                   NEW.earnings_cents, NEW.premium_until, NEW.referral_count, NEW.created_at);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_user_summary_cents_update
+       AFTER UPDATE OF name, email, phone, referral_code, earnings_cents, premium_until, referral_count ON users
+       BEGIN
+           UPDATE user_summary SET name = NEW.name, email = NEW.email, phone = NEW.phone,
+               referral_code = NEW.referral_code, balance = NEW.earnings_cents / 100.0,
+               balance_cents = NEW.earnings_cents, premium_until = NEW.premium_until,
+               referral_count = NEW.referral_count
+           WHERE user_id = NEW.id;
+       END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_user_summary_cents_referral_insert AFTER INSERT ON referrals BEGIN
+           {_referral_commission_cents_delta('NEW', '+')}
+       END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_user_summary_cents_referral_delete AFTER DELETE ON referrals BEGIN
+           {_referral_commission_cents_delta('OLD', '-')}
+       END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_user_summary_cents_referral_update
+       AFTER UPDATE OF status, referrer_id, commission_cents ON referrals BEGIN
+           {_referral_commission_cents_delta('OLD', '-')}
+           {_referral_commission_cents_delta('NEW', '+')}
+       END''',
+)
+
+def fetch_user_summary(cursor, user_id):
+    """The user's dashboard/profile read model as a dict, or None"""
+    cursor.execute('''
+        SELECT name, email, phone, referral_code, balance_cents, premium_until, referral_count,
+               referral_commission_cents, recent_transactions, created_at
+        FROM user_summary WHERE user_id = ?
+    ''', (user_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    columns = [description[0] for description in cursor.description]
+    summary = dict(zip(columns, row))
+    summary['balance'] = to_dollars(summary.pop('balance_cents'))
+    summary['referral_commission'] = to_dollars(summary.pop('referral_commission_cents'))
+    summary['recent_transactions'] = json.loads(summary['recent_transactions'] or '[]')
+    return summary
+
+# Marketplace facets: active item counts per category and price band
+MARKETPLACE_PRICE_BANDS = [('0-10', 0, 10), ('10-50', 10, 50), ('50-100', 50, 100),
+                           ('100-500', 100, 500), ('500+', 500, None)]
+
+def _price_band_sql(price):
+    cases = ' '.join(f"WHEN {price} < {upper} THEN '{band}'"
+                     for band, lower, upper in MARKETPLACE_PRICE_BANDS if upper is not None)
+    return f"CASE {cases} ELSE '{MARKETPLACE_PRICE_BANDS[-1][0]}' END"
+
+FACET_TRIGGERS = (
+    _rollup_triggers('marketplace_category', 'marketplace_items', 'marketplace_facets',
+                     ['facet', 'value'], ['item_count'],
+                     ["'category'", "COALESCE({row}.category, 'other')"],
+                     ["{sign}({row}.status = 'active')"],
+                     'category, status')
+    + _rollup_triggers('marketplace_price', 'marketplace_items', 'marketplace_facets',
+                       ['facet', 'value'], ['item_count'],
+                       ["'price_band'", _price_band_sql('{row}.price')],
+                       ["{sign}({row}.status = 'active')"],
+                       'price, status')
+)
+
+# Full-text search: external-content FTS5 tables kept current by triggers
+def _fts_index(fts_table, source, columns):
+    cols = ', '.join(columns)
+    insert_new = f"INSERT INTO {fts_table} (rowid, {cols}) VALUES (new.id, {', '.join('new.' + c for c in columns)});"
+    delete_old = (f"INSERT INTO {fts_table} ({fts_table}, rowid, {cols}) "
+                  f"VALUES ('delete', old.id, {', '.join('old.' + c for c in columns)});")
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5({cols}, content='{source}', "
+        f"content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        f'CREATE TRIGGER IF NOT EXISTS {fts_table}_insert AFTER INSERT ON {source} BEGIN {insert_new} END',
+        f'CREATE TRIGGER IF NOT EXISTS {fts_table}_delete AFTER DELETE ON {source} BEGIN {delete_old} END',
+        f'CREATE TRIGGER IF NOT EXISTS {fts_table}_update AFTER UPDATE OF {cols} ON {source} '
+        f'BEGIN {delete_old} {insert_new} END',
+    ]
+
+FTS_INDEXES = (
+    _fts_index('catalog_products_fts', 'catalog_products', ['name', 'brand'])
+    + _fts_index('marketplace_items_fts', 'marketplace_items', ['title', 'description', 'category'])
+    + _fts_index('wholesale_products_fts', 'wholesale_products', ['product_name', 'description', 'category'])
+)
+
+def rebuild_marketplace_search(conn):
+    """Recompute marketplace facets and reindex the marketplace FTS tables"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('DELETE FROM marketplace_facets')
+        conn.execute(f'''
+            INSERT INTO marketplace_facets (facet, value, item_count)
+            SELECT 'category', COALESCE(category, 'other'), COUNT(*)
+            FROM marketplace_items WHERE status = 'active' GROUP BY 2
+            UNION ALL
+            SELECT 'price_band', {_price_band_sql('price')}, COUNT(*)
+            FROM marketplace_items WHERE status = 'active' GROUP BY 2
+        ''')
+        conn.execute("INSERT INTO marketplace_items_fts (marketplace_items_fts) VALUES ('rebuild')")
+        conn.execute("INSERT INTO wholesale_products_fts (wholesale_products_fts) VALUES ('rebuild')")
+        conn.execute('''
+            INSERT INTO backfill_progress (job, last_id) VALUES ('marketplace_search', 1)
+            ON CONFLICT(job) DO UPDATE SET updated_at = CURRENT_TIMESTAMP
+        ''')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def rebuild_platform_rollups(conn):
+    """Recompute every rollup table from the base tables in one transaction"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('DELETE FROM daily_transaction_totals')
+        conn.execute('''
+            INSERT INTO daily_transaction_totals (day, type, status, tx_count, amount_total)
+            SELECT DATE(created_at), type, COALESCE(status, 'completed'), COUNT(*), COALESCE(SUM(amount), 0)
+            FROM transactions
+            GROUP BY 1, 2, 3
+        ''')
+        conn.execute('DELETE FROM user_status_totals')
+        conn.execute('''
+            INSERT INTO user_status_totals (status, user_count, earnings_total)
+            SELECT COALESCE(status, 'active'), COUNT(*), COALESCE(SUM(total_earnings), 0)
+            FROM users
+            GROUP BY 1
+        ''')
+        conn.execute('DELETE FROM referral_status_totals')
+        conn.execute('''
+            INSERT INTO referral_status_totals (status, referral_count, commission_total)
+            SELECT COALESCE(status, 'pending'), COUNT(*), COALESCE(SUM(commission_earned), 0)
+            FROM referrals
+            GROUP BY 1
+        ''')
+        conn.execute('''
+            INSERT INTO backfill_progress (job, last_id) VALUES ('platform_rollups', 1)
+            ON CONFLICT(job) DO UPDATE SET updated_at = CURRENT_TIMESTAMP
+        ''')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def rebuild_money_rollups(conn):
+    """Recompute the integer rollup columns from the base tables in one transaction"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('UPDATE daily_transaction_totals SET amount_total_cents = 0')
+        conn.execute('''
+            INSERT INTO daily_transaction_totals (day, type, status, tx_count, amount_total, amount_total_cents)
+            SELECT DATE(created_at), type, COALESCE(status, 'completed'), COUNT(*), COALESCE(SUM(amount), 0),
+                   COALESCE(SUM(amount_cents), 0)
+            FROM transactions
+            GROUP BY 1, 2, 3
+            ON CONFLICT(day, type, status) DO UPDATE SET amount_total_cents = excluded.amount_total_cents
+        ''')
+        conn.execute('UPDATE user_status_totals SET earnings_total_cents = 0')
+        conn.execute('''
+            INSERT INTO user_status_totals (status, user_count, earnings_total, earnings_total_cents)
+            SELECT COALESCE(status, 'active'), COUNT(*), COALESCE(SUM(total_earnings), 0),
+                   COALESCE(SUM(earnings_cents), 0)
+            FROM users
+            GROUP BY 1
+            ON CONFLICT(status) DO UPDATE SET earnings_total_cents = excluded.earnings_total_cents
+        ''')
+        conn.execute('UPDATE referral_status_totals SET commission_total_cents = 0')
+        conn.execute('''
+            INSERT INTO referral_status_totals (status, referral_count, commission_total, commission_total_cents)
+            SELECT COALESCE(status, 'pending'), COUNT(*), COALESCE(SUM(commission_earned), 0),
+                   COALESCE(SUM(commission_cents), 0)
+            FROM referrals
+            GROUP BY 1
+            ON CONFLICT(status) DO UPDATE SET commission_total_cents = excluded.commission_total_cents
+        ''')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def backfill_money_columns(conn, batch_size=5000):
+    """Fill the integer money columns of existing rows in rowid order, one committed chunk at a time.
+
+    Progress is stored per table in backfill_progress, so an interrupted run
+    picks up after the last committed chunk. Rows written meanwhile are
+    filled by MONEY_FILL_TRIGGERS. Returns the number of rows updated.
+    """
+    updated = 0
+    for table, columns in MONEY_COLUMNS.items():
+        job = f'money_columns_{table}'
+        updates = ', '.join(f'{cents} = {convert(real)}' for real, cents, convert in columns)
+        # Entries only accept the NULL -> cents fill (see trg_ledger_no_change)
+        only_unset = ' AND amount_cents IS NULL' if table == 'ledger_entries' else ''
+        while True:
+            with db.immediate(conn):
+                row = conn.execute('SELECT last_id FROM backfill_progress WHERE job = ?', (job,)).fetchone()
+                last_id = row[0] if row else 0
+                upper_id = conn.execute(f'''
+                    SELECT MAX(rowid) FROM (
+                        SELECT rowid FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?
+                    )
+                ''', (last_id, batch_size)).fetchone()[0]
+                if upper_id is None:
+                    break
+                updated += conn.execute(f'''
+                    UPDATE {table} SET {updates} WHERE rowid > ? AND rowid <= ?{only_unset}
+                ''', (last_id, upper_id)).rowcount
+                conn.execute('''
+                    INSERT INTO backfill_progress (job, last_id) VALUES (?, ?)
+                    ON CONFLICT(job) DO UPDATE SET last_id = excluded.last_id, updated_at = CURRENT_TIMESTAMP
+                ''', (job, upper_id))
+
+    # Checkpoints hold sums of entries, so they are re-added from the filled entries
+    with db.immediate(conn):
+        conn.execute('''
+            UPDATE ledger_checkpoints SET balance_cents = (
+                SELECT COALESCE(SUM(amount_cents), 0) FROM ledger_entries e
+                WHERE e.account = ledger_checkpoints.account AND e.id <= ledger_checkpoints.entry_id
+            )
+        ''')
+    return updated
+
+# Schema migrations, numbered per database file (see migrations.Migrator).
+# Append new ones; never edit a migration that has shipped.
+@schema.migration(1)
+def create_base_schema(conn):
+    """Base tables, rollup triggers, search indexes and indexes"""
     cursor = conn.cursor()
 
     # Users table with enhanced fields
@@ -215,6 +665,7 @@ def init_db():
             status TEXT DEFAULT 'active',
             premium_until DATE,
             email_verified BOOLEAN DEFAULT 0,
+            referral_count INTEGER NOT NULL DEFAULT 0,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (referrer_id) REFERENCES users (id)
@@ -231,6 +682,8 @@ def init_db():
             status TEXT DEFAULT 'completed' CHECK (status IN ('pending', 'completed', 'failed', 'cancelled')),
             description TEXT,
             reference_id TEXT UNIQUE,
+            payment_method TEXT,
+            source TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (user_id) REFERENCES users (id)
         )
@@ -303,18 +756,6 @@ def init_db():
         )
     ''')
 
-    # User activity logs table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_activity_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            activity_type TEXT NOT NULL,
-            description TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-
     # Wholesale partners table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS wholesale_partners (
@@ -376,6 +817,192 @@ def init_db():
         )
     ''')
 
+    # Multi-item wholesale orders (one row per cart; lines live in wholesale_sales)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS wholesale_orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            buyer_id INTEGER NOT NULL,
+            item_count INTEGER NOT NULL,
+            total_amount REAL NOT NULL,
+            commission_amount REAL NOT NULL,
+            status TEXT DEFAULT 'completed',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (buyer_id) REFERENCES users (id)
+        )
+    ''')
+
+    # Background bulk product imports and their per-row error reports
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS product_imports (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            partner_id INTEGER NOT NULL,
+            filename TEXT,
+            format TEXT NOT NULL CHECK (format IN ('csv', 'jsonl')),
+            path TEXT NOT NULL,
+            status TEXT DEFAULT 'queued' CHECK (status IN ('queued', 'running', 'completed', 'failed')),
+            rows_processed INTEGER DEFAULT 0,
+            inserted INTEGER DEFAULT 0,
+            updated INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            bytes_read INTEGER DEFAULT 0,
+            total_bytes INTEGER DEFAULT 0,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            FOREIGN KEY (partner_id) REFERENCES wholesale_partners (id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS product_import_errors (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            import_id INTEGER NOT NULL,
+            row_number INTEGER NOT NULL,
+            sku TEXT,
+            error TEXT NOT NULL,
+            FOREIGN KEY (import_id) REFERENCES product_imports (id)
+        )
+    ''')
+
+    # Stock held for multi-step wholesale checkout
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stock_reservations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_id INTEGER NOT NULL,
+            buyer_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL CHECK (quantity > 0),
+            status TEXT NOT NULL DEFAULT 'held'
+                CHECK (status IN ('held', 'confirmed', 'released', 'expired')),
+            expires_at TIMESTAMP NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (product_id) REFERENCES wholesale_products (id),
+            FOREIGN KEY (buyer_id) REFERENCES users (id)
+        )
+    ''')
+
+    # Platform-wide counters shared by every worker
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS platform_counters (
+            name TEXT PRIMARY KEY,
+            value REAL NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Outgoing email queue drained by the outbox worker
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            recipient TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'sending', 'sent', 'failed')),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            claimed_at TIMESTAMP,
+            sent_at TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Progress markers for resumable backfill jobs
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS backfill_progress (
+            job TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Platform rollups for the admin pages, kept current by the triggers below
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_transaction_totals (
+            day DATE NOT NULL,
+            type TEXT NOT NULL,
+            status TEXT NOT NULL,
+            tx_count INTEGER NOT NULL DEFAULT 0,
+            amount_total REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, type, status)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_status_totals (
+            status TEXT PRIMARY KEY,
+            user_count INTEGER NOT NULL DEFAULT 0,
+            earnings_total REAL NOT NULL DEFAULT 0
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS referral_status_totals (
+            status TEXT PRIMARY KEY,
+            referral_count INTEGER NOT NULL DEFAULT 0,
+            commission_total REAL NOT NULL DEFAULT 0
+        )
+    ''')
+
+    for statement in ROLLUP_TRIGGERS:
+        cursor.execute(statement)
+
+    # Local mirror of partner catalogs, kept current by catalog_sync
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS catalog_products (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            platform TEXT NOT NULL,
+            external_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            brand TEXT,
+            category TEXT,
+            price REAL,
+            commission_rate REAL,
+            image_url TEXT,
+            affiliate_url TEXT,
+            rating REAL,
+            reviews INTEGER,
+            data TEXT,
+            content_hash TEXT NOT NULL,
+            active BOOLEAN NOT NULL DEFAULT 1,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (platform, external_id)
+        )
+    ''')
+
+    # Marketplace listings
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS marketplace_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            seller_id INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            description TEXT,
+            price REAL NOT NULL,
+            category TEXT,
+            image_url TEXT,
+            status TEXT DEFAULT 'active',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (seller_id) REFERENCES users (id)
+        )
+    ''')
+
+    # Marketplace facet counts, kept current by FACET_TRIGGERS
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS marketplace_facets (
+            facet TEXT NOT NULL,
+            value TEXT NOT NULL,
+            item_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (facet, value)
+        )
+    ''')
+
+    for statement in FACET_TRIGGERS:
+        cursor.execute(statement)
+
+    # Full-text indexes (catalog, marketplace, wholesale)
+    for statement in FTS_INDEXES:
+        cursor.execute(statement)
+
     # Create indexes for better performance
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_email ON users(email)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_referral_code ON users(referral_code)')
@@ -383,93 +1010,913 @@ def init_db():
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_type ON transactions(type)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_affiliate_user ON affiliate_links(user_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_created_at ON transactions(created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_contact_messages_status ON contact_messages(status)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox(status, next_attempt_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_catalog_platform ON catalog_products(platform, category, commission_rate, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_catalog_category ON catalog_products(category, commission_rate, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_catalog_commission ON catalog_products(commission_rate, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_marketplace_newest ON marketplace_items(status, created_at, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_marketplace_category ON marketplace_items(status, category, created_at, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_marketplace_price ON marketplace_items(status, price, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_wholesale_products_newest ON wholesale_products(status, created_at, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_product_imports_status ON product_imports(status, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_product_import_errors ON product_import_errors(import_id, row_number)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_stock_reservations_expiry ON stock_reservations(status, expires_at)')
+
+# Tables that live in the telemetry database (see database.TelemetryDatabase)
+TELEMETRY_TABLES = ('user_activity_logs', 'affiliate_clicks', 'shares',
+                    'affiliate_stats_hourly', 'affiliate_stats_daily')
+
+@telemetry_schema.migration(1)
+def create_telemetry_schema(conn):
+    """Click, share and activity tables with the affiliate rollups"""
+    cursor = conn.cursor()
+
+    # User activity logs table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_activity_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            activity_type TEXT NOT NULL,
+            description TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Affiliate clicks table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS affiliate_clicks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            product_id TEXT NOT NULL,
+            platform TEXT NOT NULL,
+            clicked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            ip_address TEXT,
+            converted BOOLEAN DEFAULT 0,
+            commission_earned REAL DEFAULT 0
+        )
+    ''')
+
+    # Social shares table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS shares (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            platform TEXT NOT NULL,
+            referral_code TEXT,
+            shared_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Affiliate stats rollups, advanced from affiliate_clicks by affiliate_rollups
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS affiliate_stats_hourly (
+            user_id INTEGER NOT NULL,
+            hour TIMESTAMP NOT NULL,
+            product_id TEXT NOT NULL,
+            platform TEXT NOT NULL,
+            clicks INTEGER NOT NULL DEFAULT 0,
+            conversions INTEGER NOT NULL DEFAULT 0,
+            commission REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, hour, product_id, platform)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS affiliate_stats_daily (
+            user_id INTEGER NOT NULL,
+            day DATE NOT NULL,
+            product_id TEXT NOT NULL,
+            platform TEXT NOT NULL,
+            clicks INTEGER NOT NULL DEFAULT 0,
+            conversions INTEGER NOT NULL DEFAULT 0,
+            commission REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day, product_id, platform)
+        )
+    ''')
+
+    # Watermarks of jobs over telemetry rows (the affiliate rollups)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS backfill_progress (
+            job TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_activity_created_at ON user_activity_logs(created_at)')
+
+@telemetry_schema.migration(2, transactional=False)
+def build_affiliate_rollups(conn):
+    """Build the affiliate stats rollups from raw clicks"""
+    if not conn.execute("SELECT 1 FROM backfill_progress WHERE job = ?", (affiliate_rollups.job,)).fetchone():
+        affiliate_rollups.rebuild(conn)
+
+@telemetry_schema.migration(3)
+def add_affiliate_click_index(conn):
+    """Index for marking a user's clicks on a product converted"""
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_affiliate_clicks_user ON affiliate_clicks(user_id, product_id)')
+
+@telemetry_schema.migration(4)
+def add_affiliate_click_tail_index(conn):
+    """Index for reading a user's clicks above the rollup watermark"""
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_affiliate_clicks_user_tail ON affiliate_clicks(user_id, id)')
+
+def move_telemetry_tables(conn, batch_size=5000):
+    """Move telemetry rows left in the main database into the telemetry file.
+
+    Rows keep their ids and are copied in id-ordered chunks with INSERT OR
+    IGNORE, each chunk committed on its own, so an interrupted move resumes
+    without duplicates. A table is dropped from the main file only once all
+    of its rows are across. Returns how many rows were moved.
+    """
+    present = {row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name IN (SELECT value FROM json_each(?))",
+        (json.dumps(TELEMETRY_TABLES),))}
+    if not present:
+        return 0
 
     conn.commit()
-    conn.close()
+    conn.execute('ATTACH DATABASE ? AS telemetry', (telemetry_db.path,))
+    moved = 0
+    try:
+        for table in TELEMETRY_TABLES:
+            if table not in present:
+                continue
+            # Columns both copies have, so tables predating a column still move
+            legacy_columns = {row[1] for row in conn.execute(f'PRAGMA main.table_info({table})')}
+            columns = ', '.join(row[1] for row in conn.execute(f'PRAGMA telemetry.table_info({table})')
+                                if row[1] in legacy_columns)
+            if table.startswith('affiliate_stats_'):
+                # Rollups are small: copy them whole with their watermark
+                conn.execute(f'INSERT OR REPLACE INTO telemetry.{table} ({columns}) SELECT {columns} FROM main.{table}')
+                moved += conn.execute('SELECT changes()').fetchone()[0]
+            else:
+                last_id = 0
+                while True:
+                    upper_id = conn.execute(f'''
+                        SELECT MAX(id) FROM (SELECT id FROM main.{table} WHERE id > ? ORDER BY id LIMIT ?)
+                    ''', (last_id, batch_size)).fetchone()[0]
+                    if upper_id is None:
+                        break
+                    conn.execute(f'''
+                        INSERT OR IGNORE INTO telemetry.{table} ({columns})
+                        SELECT {columns} FROM main.{table} WHERE id > ? AND id <= ?
+                    ''', (last_id, upper_id))
+                    moved += conn.execute('SELECT changes()').fetchone()[0]
+                    conn.commit()
+                    last_id = upper_id
+            conn.execute(f'DROP TABLE main.{table}')
+            conn.commit()
 
-# Database migration function
-def migrate_database():
-    """Migrate existing database to new schema"""
-    conn = sqlite3.connect('dadaal.db')
+        conn.execute('''
+            INSERT OR REPLACE INTO telemetry.backfill_progress (job, last_id, updated_at)
+            SELECT job, last_id, updated_at FROM main.backfill_progress WHERE job = ?
+        ''', (affiliate_rollups.job,))
+        conn.execute('DELETE FROM main.backfill_progress WHERE job = ?', (affiliate_rollups.job,))
+        conn.commit()
+    finally:
+        conn.execute('DETACH DATABASE telemetry')
+    return moved
+
+@schema.migration(2)
+def add_legacy_columns(conn):
+    """Columns and indexes added after the first release"""
     cursor = conn.cursor()
 
-    try:
-        # Check if password_hash column exists
-        cursor.execute("PRAGMA table_info(users)")
-        columns = [column[1] for column in cursor.fetchall()]
-
-        if 'password_hash' not in columns:
-            # Add missing columns to users table one by one
-            columns_to_add = [
-                ('password_hash', 'TEXT NOT NULL DEFAULT ""'),
-                ('total_earnings', 'REAL DEFAULT 0'),
-                ('referral_code', 'TEXT'),
-                ('referrer_id', 'INTEGER'),
-                ('status', 'TEXT DEFAULT "active"'),
-                ('premium_until', 'DATE'),
-                ('email_verified', 'BOOLEAN DEFAULT 0'),
-                ('created_at', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP'),
-                ('updated_at', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP')
-            ]
-
-            for col_name, col_definition in columns_to_add:
-                try:
-                    cursor.execute(f'ALTER TABLE users ADD COLUMN {col_name} {col_definition}')
-                    print(f"Added column: {col_name}")
-                except sqlite3.OperationalError as e:
-                    if "duplicate column name" in str(e):
-                        print(f"Column {col_name} already exists")
-                    else:
-                        print(f"Error adding column {col_name}: {e}")
-
-        # Check and add user_activity_logs table if it doesn't exist
+    # Check if password_hash column exists
+    cursor.execute("PRAGMA table_info(users)")
+    columns = [column[1] for column in cursor.fetchall()]
+
+    if 'password_hash' not in columns:
+        # Add missing columns to users table one by one
+        columns_to_add = [
+            ('password_hash', 'TEXT NOT NULL DEFAULT ""'),
+            ('total_earnings', 'REAL DEFAULT 0'),
+            ('referral_code', 'TEXT'),
+            ('referrer_id', 'INTEGER'),
+            ('status', 'TEXT DEFAULT "active"'),
+            ('premium_until', 'DATE'),
+            ('email_verified', 'BOOLEAN DEFAULT 0'),
+            ('created_at', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP'),
+            ('updated_at', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP')
+        ]
+
+        for col_name, col_definition in columns_to_add:
+            try:
+                cursor.execute(f'ALTER TABLE users ADD COLUMN {col_name} {col_definition}')
+                print(f"Added column: {col_name}")
+            except sqlite3.OperationalError as e:
+                if "duplicate column name" in str(e):
+                    print(f"Column {col_name} already exists")
+                else:
+                    print(f"Error adding column {col_name}: {e}")
+
+    # Typed payment method / earning source columns on transactions
+    cursor.execute("PRAGMA table_info(transactions)")
+    transaction_columns = [column[1] for column in cursor.fetchall()]
+    for col_name in ('payment_method', 'source'):
+        if col_name not in transaction_columns:
+            cursor.execute(f'ALTER TABLE transactions ADD COLUMN {col_name} TEXT')
+            print(f"Added column: transactions.{col_name}")
+
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_payment_method ON transactions(payment_method, source, amount)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_user_source ON transactions(user_id, source, amount)')
+
+    # Precomputed completed-referral count per user for the admin listing
+    cursor.execute("PRAGMA table_info(users)")
+    if 'referral_count' not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute('ALTER TABLE users ADD COLUMN referral_count INTEGER NOT NULL DEFAULT 0')
         cursor.execute('''
-            SELECT name FROM sqlite_master WHERE type='table' AND name='user_activity_logs'
+            UPDATE users SET referral_count = (
+                SELECT COUNT(*) FROM referrals r
+                WHERE r.referrer_id = users.id AND r.status = 'completed'
+            )
         ''')
+        print("Added column: users.referral_count")
+
+    for statement in REFERRAL_COUNT_TRIGGERS:
+        cursor.execute(statement)
+
+    # Cart orders group their sale lines
+    cursor.execute("PRAGMA table_info(wholesale_sales)")
+    if 'order_id' not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute('ALTER TABLE wholesale_sales ADD COLUMN order_id INTEGER REFERENCES wholesale_orders (id)')
+        print("Added column: wholesale_sales.order_id")
+
+    # Keyset pagination indexes for the admin user listing
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_status_created ON users(status, created_at, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_earnings ON users(total_earnings, id)')
+
+@schema.migration(3, transactional=False)
+def build_rollups_and_search(conn):
+    """Build the admin rollups, marketplace facets and search index"""
+    if not conn.execute("SELECT 1 FROM backfill_progress WHERE job = 'platform_rollups'").fetchone():
+        rebuild_platform_rollups(conn)
+    if not conn.execute("SELECT 1 FROM backfill_progress WHERE job = 'marketplace_search'").fetchone():
+        rebuild_marketplace_search(conn)
+
+@schema.migration(4, transactional=False)
+def move_legacy_telemetry(conn):
+    """Move telemetry rows out of the main database file"""
+    moved = move_telemetry_tables(conn)
+    if moved:
+        print(f"Moved {moved} telemetry rows to {telemetry_db.path}")
+
+@schema.migration(5)
+def add_route_query_indexes(conn):
+    """Composite indexes behind the dashboard, verification and wholesale queries"""
+    cursor = conn.cursor()
 
-        if not cursor.fetchone():  # Table doesn't exist
-            cursor.execute('''
-                CREATE TABLE user_activity_logs (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    activity_type TEXT NOT NULL,
-                    description TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (id)
-                )
-            ''')
-            print("user_activity_logs table created successfully!")
+    # Dashboard and affiliate history: newest first per user, read from the index alone.
+    # Replaces idx_transactions_user_id, which is a prefix of it.
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_transactions_user_created
+        ON transactions(user_id, created_at, type, amount, description)
+    ''')
+    cursor.execute('DROP INDEX IF EXISTS idx_transactions_user_id')
 
-        conn.commit()
-        print("Database migration completed successfully!")
+    # verify_email(): equality on the first three columns, newest code first
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_email_codes_lookup
+        ON email_verification_codes(email, code, verified, created_at, expires_at)
+    ''')
 
-    except Exception as e:
-        print(f"Migration error: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
+    # delete_user() matches either side of a referral
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_referrals_referred ON referrals(referred_id)')
+
+    # Wholesale partner dashboard
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_wholesale_partners_user ON wholesale_partners(user_id, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_wholesale_partners_email ON wholesale_partners(business_email)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_wholesale_products_partner ON wholesale_products(partner_id, created_at)')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_wholesale_sales_partner
+        ON wholesale_sales(partner_id, sale_date, total_amount, commission_amount)
+    ''')
+
+    # Admin user listing filtered by status, sorted by earnings
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_status_earnings ON users(status, total_earnings, id)')
+
+    # Catalog search sorted by price
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_catalog_price ON catalog_products(price, id)')
+
+@schema.migration(6)
+def add_user_summary(conn):
+    """Per-user dashboard read model maintained by triggers"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_summary (
+            user_id INTEGER PRIMARY KEY,
+            name TEXT,
+            email TEXT,
+            phone TEXT,
+            referral_code TEXT,
+            balance REAL NOT NULL DEFAULT 0,
+            premium_until DATE,
+            referral_count INTEGER NOT NULL DEFAULT 0,
+            referral_commission REAL NOT NULL DEFAULT 0,
+            recent_transactions TEXT NOT NULL DEFAULT '[]',
+            created_at TIMESTAMP
+        )
+    ''')
+
+    # Backfill existing users, then keep every row current from here on
+    cursor.execute(f'''
+        INSERT OR REPLACE INTO user_summary (
+            user_id, name, email, phone, referral_code, balance, premium_until,
+            referral_count, referral_commission, recent_transactions, created_at
+        )
+        SELECT u.id, u.name, u.email, u.phone, u.referral_code, COALESCE(u.total_earnings, 0), u.premium_until,
+               u.referral_count,
+               (SELECT COALESCE(SUM(commission_earned), 0) FROM referrals r
+                WHERE r.referrer_id = u.id AND r.status = 'completed'),
+               {_recent_transactions_sql('u.id')},
+               u.created_at
+        FROM users u
+    ''')
+    for statement in USER_SUMMARY_TRIGGERS:
+        cursor.execute(statement)
+
+@schema.migration(7)
+def add_ledger(conn):
+    """Append-only double-entry ledger with per-account balance checkpoints"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ledger_entries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            account TEXT NOT NULL,
+            amount REAL NOT NULL,
+            source TEXT NOT NULL,
+            transaction_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ledger_checkpoints (
+            account TEXT PRIMARY KEY,
+            balance REAL NOT NULL DEFAULT 0,
+            entry_id INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Balance tails: entries of one account above the checkpoint, read from the index alone
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ledger_account ON ledger_entries(account, id, amount)')
+
+    # Opening balances: whatever users.total_earnings holds today becomes one posting per user
+    cursor.execute('''
+        INSERT INTO ledger_entries (account, amount, source)
+        SELECT 'user:' || id, total_earnings, 'opening_balance' FROM users WHERE total_earnings != 0
+    ''')
+    cursor.execute('''
+        INSERT INTO ledger_entries (account, amount, source)
+        SELECT 'platform:opening_balance', -SUM(total_earnings), 'opening_balance' FROM users
+        WHERE total_earnings != 0 HAVING COUNT(*) > 0
+    ''')
 
-# Initialize database
+    # Created after the backfill so opening balances are not added twice
+    for statement in LEDGER_TRIGGERS:
+        cursor.execute(statement)
+
+@schema.migration(8)
+def add_balance_reconciliation(conn):
+    """Queue of changed user balances and the drift report the reconciler fills"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS balance_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS balance_drift (
+            user_id INTEGER PRIMARY KEY,
+            stored_balance REAL NOT NULL,
+            ledger_balance REAL NOT NULL,
+            drift REAL NOT NULL,
+            detected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    for statement in BALANCE_CHANGE_TRIGGERS:
+        cursor.execute(statement)
+
+@schema.migration(9)
+def add_money_columns(conn):
+    """Integer cents and basis-point columns next to every REAL money column"""
+    cursor = conn.cursor()
+    new_columns = [(table, column, f'INTEGER{MONEY_COLUMN_DEFAULTS.get(column, "")}')
+                   for table, columns in MONEY_COLUMNS.items() for _, column, _ in columns]
+    new_columns += [
+        ('ledger_checkpoints', 'balance_cents', 'INTEGER NOT NULL DEFAULT 0'),
+        ('daily_transaction_totals', 'amount_total_cents', 'INTEGER NOT NULL DEFAULT 0'),
+        ('user_status_totals', 'earnings_total_cents', 'INTEGER NOT NULL DEFAULT 0'),
+        ('referral_status_totals', 'commission_total_cents', 'INTEGER NOT NULL DEFAULT 0'),
+    ]
+    for table, column, definition in new_columns:
+        existing = {row[1] for row in cursor.execute(f'PRAGMA table_info({table})')}
+        if column not in existing:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+    for statement in MONEY_FILL_TRIGGERS + MONEY_ROLLUP_TRIGGERS:
+        cursor.execute(statement)
+    cursor.execute('DROP TRIGGER IF EXISTS trg_ledger_no_update')
+    cursor.execute('DROP TRIGGER IF EXISTS trg_ledger_user_balance')
+    for statement in LEDGER_CENTS_TRIGGERS:
+        cursor.execute(statement)
+
+    # Covering indexes that summed or sorted REAL amounts now carry the integers
+    for name, definition in (
+        ('idx_transactions_payment_method', 'transactions(payment_method, source, amount_cents)'),
+        ('idx_transactions_user_source', 'transactions(user_id, source, amount_cents)'),
+        ('idx_ledger_account', 'ledger_entries(account, id, amount_cents)'),
+        ('idx_wholesale_sales_partner', 'wholesale_sales(partner_id, sale_date, total_cents, commission_cents)'),
+        ('idx_users_earnings', 'users(earnings_cents, id)'),
+        ('idx_users_status_earnings', 'users(status, earnings_cents, id)'),
+    ):
+        cursor.execute(f'DROP INDEX IF EXISTS {name}')
+        cursor.execute(f'CREATE INDEX {name} ON {definition}')
+
+@schema.migration(10, transactional=False)
+def backfill_money(conn):
+    """Fill the integer money columns of existing rows, then their rollups"""
+    filled = backfill_money_columns(conn)
+    rebuild_money_rollups(conn)
+    if filled:
+        print(f"Filled integer money columns on {filled} rows")
+
+@schema.migration(11)
+def add_summary_and_counter_cents(conn):
+    """Integer dashboard balances and platform counters, money ones in cents"""
+    cursor = conn.cursor()
+    existing = {row[1] for row in cursor.execute('PRAGMA table_info(user_summary)')}
+    for column in ('balance_cents', 'referral_commission_cents'):
+        if column not in existing:
+            cursor.execute(f'ALTER TABLE user_summary ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('''
+        UPDATE user_summary SET
+            balance_cents = (SELECT earnings_cents FROM users WHERE users.id = user_summary.user_id),
+            referral_commission_cents = (SELECT COALESCE(SUM(commission_cents), 0) FROM referrals r
+                                         WHERE r.referrer_id = user_summary.user_id AND r.status = 'completed')
+    ''')
+    for name in ('insert', 'update', 'referral_insert', 'referral_delete', 'referral_update'):
+        cursor.execute(f'DROP TRIGGER IF EXISTS trg_user_summary_{name}')
+    for statement in USER_SUMMARY_CENTS_TRIGGERS:
+        cursor.execute(statement)
+
+    # Counters become integers: counts as they are, money totals in cents under new names
+    cursor.execute('''
+        CREATE TABLE platform_counters_new (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute(f'''
+        INSERT INTO platform_counters_new (name, value, updated_at)
+        SELECT CASE WHEN name IN ('total_earnings', 'affiliate_earnings') THEN name || '_cents' ELSE name END,
+               CASE WHEN name IN ('total_earnings', 'affiliate_earnings') THEN {cents_sql('value')}
+                    ELSE CAST(value AS INTEGER) END,
+               updated_at
+        FROM platform_counters
+    ''')
+    cursor.execute('DROP TABLE platform_counters')
+    cursor.execute('ALTER TABLE platform_counters_new RENAME TO platform_counters')
+
+@schema.migration(12)
+def fill_catalog_sort_keys(conn):
+    """Catalog products synced without a price or commission sort as 0, as catalog_sync now writes them"""
+    cursor = conn.cursor()
+    cursor.execute('UPDATE catalog_products SET price = 0 WHERE price IS NULL')
+    cursor.execute('UPDATE catalog_products SET commission_rate = 0 WHERE commission_rate IS NULL')
+
+def init_db():
+    """Bring both database files up to their latest schema version"""
+    # Telemetry first: moving legacy rows needs its tables
+    telemetry_schema.migrate()
+    schema.migrate()
+
+def migrate_database():
+    """Older name for init_db(); a no-op once the schema is current"""
+    init_db()
+
+# Initialize database: one user_version read per file when already current
 init_db()
-migrate_database()
 
-# Global variables for tracking earnings
-total_earnings = 0
-user_referrals = {}
-affiliate_earnings = 0
+# Fold each batch of buffered clicks into the affiliate rollups as it is written
+event_ingestor.after_write.append(affiliate_rollups.after_ingest)
+event_ingestor.after_commit.append(affiliate_rollups.after_commit)
+
+# Deliver queued emails in the background when SMTP is configured
+if email_outbox.is_configured() and not app.config.get('TESTING'):
+    email_outbox.start()
+
+# Mirror partner catalogs into catalog_products in the background when enabled
+if os.environ.get('CATALOG_SYNC_INTERVAL') and not app.config.get('TESTING'):
+    catalog_sync.interval = int(os.environ['CATALOG_SYNC_INTERVAL'])
+    catalog_sync.start()
+
+# Serve admin reports from a periodically refreshed copy when configured
+if os.environ.get('REPORTS_SNAPSHOT') and not app.config.get('TESTING'):
+    app.config['REPORTS_SNAPSHOT'] = os.environ['REPORTS_SNAPSHOT']
+    db.start_snapshots(int(os.environ.get('REPORTS_SNAPSHOT_INTERVAL', 300)))
+
+# Resume bulk product imports left unfinished by a previous process
+if not app.config.get('TESTING'):
+    with db.session() as conn:
+        if conn.execute("SELECT 1 FROM product_imports WHERE status IN ('queued', 'running') LIMIT 1").fetchone():
+            product_importer.start()
+
+@app.cli.command('sync-catalog')
+def sync_catalog_command():
+    """Sync partner catalogs into catalog_products once and exit"""
+    for platform, counts in catalog_sync.run_once().items():
+        print(f"{platform}: {counts}")
+
+@app.cli.command('expire-reservations')
+def expire_reservations_command():
+    """Return the stock of abandoned checkout reservations"""
+    with db.session() as conn:
+        with db.immediate(conn):
+            expired = inventory.expire_reservations(conn)
+    print(f"Expired {expired} reservations")
+
+@app.cli.command('send-outbox')
+def send_outbox_command():
+    """Send every due email in the outbox and exit"""
+    total = 0
+    while True:
+        sent = email_outbox.run_once()
+        if not sent:
+            break
+        total += sent
+    email_outbox.stop()
+    print(f"Sent {total} queued emails")
+
+# Transaction helpers
+PAYMENT_METHODS = ('mobile_money', 'credit_card', 'bank_transfer')
+
+# Fixed payouts and rates, in cents and basis points
+PAYMENT_COMMISSION_BPS = 500
+REFERRAL_BONUS_CENTS = 500
+SHARE_BONUS_CENTS = 25
+
+TRANSACTION_INSERT = '''
+    INSERT INTO transactions (user_id, amount, amount_cents, type, status, description, reference_id,
+                              payment_method, source)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+def record_transaction(cursor, user_id, amount_cents, type, description, status='completed',
+                       reference_id=None, payment_method=None, source=None):
+    """Insert a transaction row with its typed payment method and earning source"""
+    cursor.execute(TRANSACTION_INSERT, (user_id, to_dollars(amount_cents), amount_cents, type, status,
+                                        description, reference_id, payment_method, source))
+    return cursor.lastrowid
+
+def classify_transaction(type, description, reference_id):
+    """Derive (payment_method, source) for rows written before the typed columns existed"""
+    description = (description or '').lower()
+    reference_id = (reference_id or '').upper()
+
+    payment_method = None
+    if 'mobile_money' in description or 'mobile money' in description or reference_id.startswith('MM-'):
+        payment_method = 'mobile_money'
+    elif ('credit_card' in description or 'credit card' in description or 'stripe' in description
+          or reference_id.startswith('STRIPE-')):
+        payment_method = 'credit_card'
+    elif 'bank_transfer' in description or 'bank transfer' in description or reference_id.startswith('BANK-'):
+        payment_method = 'bank_transfer'
+
+    if type == 'premium':
+        source = 'premium'
+    elif 'affiliate' in description:
+        source = 'affiliate'
+    elif 'wholesale' in description:
+        source = 'wholesale'
+    elif 'sharing bonus' in description:
+        source = 'share_bonus'
+    elif description.startswith('commission from'):
+        source = 'payment_commission'
+    elif type == 'referral':
+        source = 'referral'
+    else:
+        source = 'other'
+
+    return payment_method, source
+
+def backfill_transaction_classification(batch_size=1000):
+    """Classify untyped transactions in id order, one committed chunk at a time.
+
+    Progress is stored in backfill_progress, so an interrupted run picks up
+    after the last committed chunk.
+    """
+    job = 'transaction_classification'
+    updated = 0
+    while True:
+        with db.session() as conn:
+            row = conn.execute('SELECT last_id FROM backfill_progress WHERE job = ?', (job,)).fetchone()
+            last_id = row[0] if row else 0
+
+            rows = conn.execute('''
+                SELECT id, type, description, reference_id, payment_method, source
+                FROM transactions
+                WHERE id > ?
+                ORDER BY id
+                LIMIT ?
+            ''', (last_id, batch_size)).fetchall()
+            if not rows:
+                return updated
+
+            changes = []
+            for row_id, type, description, reference_id, payment_method, source in rows:
+                if source is None:
+                    method, source = classify_transaction(type, description, reference_id)
+                    changes.append((payment_method or method, source, row_id))
+
+            conn.executemany('UPDATE transactions SET payment_method = ?, source = ? WHERE id = ?', changes)
+            conn.execute('''
+                INSERT INTO backfill_progress (job, last_id) VALUES (?, ?)
+                ON CONFLICT(job) DO UPDATE SET last_id = excluded.last_id, updated_at = CURRENT_TIMESTAMP
+            ''', (job, rows[-1][0]))
+            updated += len(changes)
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Recompute the admin rollup tables from scratch"""
+    with db.session() as conn:
+        rebuild_platform_rollups(conn)
+        rebuild_money_rollups(conn)
+    print("Platform rollups rebuilt")
+
+@app.cli.command('rebuild-affiliate-stats')
+@click.option('--since', default=None, help='Only rebuild days from this date (YYYY-MM-DD)')
+def rebuild_affiliate_stats_command(since):
+    """Recompute the affiliate stats rollups from affiliate_clicks"""
+    with telemetry_db.session() as conn:
+        upper_id = affiliate_rollups.rebuild(conn, since)
+    print(f"Affiliate stats rebuilt up to click {upper_id}")
+
+@app.cli.command('backfill-transactions')
+@click.option('--batch-size', default=1000, show_default=True)
+def backfill_transactions_command(batch_size):
+    """Fill transactions.payment_method/source for existing rows"""
+    updated = backfill_transaction_classification(batch_size)
+    print(f"Classified {updated} transactions")
+
+@app.cli.command('backfill-money')
+@click.option('--batch-size', default=5000, show_default=True)
+def backfill_money_command(batch_size):
+    """Re-derive the integer money columns from the REAL ones and rebuild their rollups"""
+    with db.session() as conn:
+        conn.execute("DELETE FROM backfill_progress WHERE job LIKE 'money_columns_%'")
+        conn.commit()
+        filled = backfill_money_columns(conn, batch_size)
+        rebuild_money_rollups(conn)
+    print(f"Filled integer money columns on {filled} rows")
+
+@app.cli.command('checkpoint-ledger')
+def checkpoint_ledger_command():
+    """Fold new ledger entries into the per-account balance checkpoints (run from cron)"""
+    with db.session() as conn:
+        folded = ledger.checkpoint(conn)
+    print(f"Checkpointed {folded} ledger entries")
+
+@app.cli.command('reconcile-balances')
+@click.option('--full', is_flag=True, help='Check every user, not only those changed since the last run')
+def reconcile_balances_command(full):
+    """Compare users.total_earnings with the ledger and record drift"""
+    with db.session() as conn:
+        checked, drifted = reconciler.run_full(conn) if full else reconciler.run(conn)
+    print(f"Reconciled {checked} users, {drifted} with drift")
+
+# Admin user listing (keyset pagination on the sort key plus id)
+USER_LIST_SORTS = {
+    'newest': ('created_at', 'DESC'),
+    'oldest': ('created_at', 'ASC'),
+    'earnings': ('earnings_cents', 'DESC'),
+}
+
+def encode_page_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+def decode_page_cursor(cursor_token):
+    if not cursor_token:
+        return None
+    try:
+        padded = cursor_token + '=' * (-len(cursor_token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return values if isinstance(values, list) and len(values) == 2 else None
+    except (ValueError, TypeError):
+        return None
+
+def fetch_users_page(cursor, status=None, premium=None, email_prefix=None,
+                     sort='newest', after=None, limit=50):
+    """Return (rows, next_cursor) for one page of the admin user listing"""
+    sort_column, direction = USER_LIST_SORTS.get(sort, USER_LIST_SORTS['newest'])
+    conditions, params = [], []
+
+    if status:
+        conditions.append('status = ?')
+        params.append(status)
+    if premium == 'premium':
+        conditions.append("premium_until >= DATE('now')")
+    elif premium == 'regular':
+        conditions.append("(premium_until IS NULL OR premium_until < DATE('now'))")
+    if email_prefix:
+        # Range predicate so the prefix match can use idx_users_email
+        conditions.append('email >= ? AND email < ?')
+        params.extend([email_prefix, email_prefix + '\U0010ffff'])
+
+    last = decode_page_cursor(after)
+    if last:
+        comparison = '<' if direction == 'DESC' else '>'
+        conditions.append(f'({sort_column}, id) {comparison} (?, ?)')
+        params.extend(last)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    cursor.execute(f'''
+        SELECT id, name, email, phone, total_earnings, status, premium_until,
+               created_at, referral_code, referral_count, earnings_cents
+        FROM users
+        {where}
+        ORDER BY {sort_column} {direction}, id {direction}
+        LIMIT ?
+    ''', params + [limit + 1])
+    rows = cursor.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        sort_value = rows[-1][10] if sort_column == 'earnings_cents' else rows[-1][7]
+        next_cursor = encode_page_cursor([sort_value, rows[-1][0]])
+    return rows, next_cursor
+
+# Catalog search (keyset pagination, FTS5 for free text)
+CATALOG_SORTS = {
+    'commission': ('commission_rate', 'DESC'),
+    'price_low': ('price', 'ASC'),
+    'price_high': ('price', 'DESC'),
+}
+
+def fetch_catalog_page(cursor, query=None, platform=None, category=None, min_commission=None,
+                       sort='commission', after=None, limit=24):
+    """Return (rows, next_cursor) for one page of catalog_products search results"""
+    sort_column, direction = CATALOG_SORTS.get(sort, CATALOG_SORTS['commission'])
+    conditions, params = ['p.active = 1'], []
+    source = 'catalog_products p'
+
+    match = fts_query(query or '')
+    if match:
+        source = 'catalog_products_fts f JOIN catalog_products p ON p.id = f.rowid'
+        conditions.append('catalog_products_fts MATCH ?')
+        params.append(match)
+    if platform:
+        conditions.append('p.platform = ?')
+        params.append(platform)
+    if category:
+        conditions.append('p.category = ?')
+        params.append(category)
+    if min_commission is not None:
+        conditions.append('p.commission_rate >= ?')
+        params.append(min_commission)
+
+    last = decode_page_cursor(after)
+    if last:
+        comparison = '<' if direction == 'DESC' else '>'
+        conditions.append(f'(p.{sort_column}, p.id) {comparison} (?, ?)')
+        params.extend(last)
+
+    cursor.execute(f'''
+        SELECT p.id, p.platform, p.external_id, p.name, p.brand, p.category, p.price,
+               p.commission_rate, p.image_url, p.affiliate_url, p.rating, p.reviews
+        FROM {source}
+        WHERE {' AND '.join(conditions)}
+        ORDER BY p.{sort_column} {direction}, p.id {direction}
+        LIMIT ?
+    ''', params + [limit + 1])
+    columns = [description[0] for description in cursor.description]
+    rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_page_cursor([rows[-1][sort_column], rows[-1]['id']])
+    return rows, next_cursor
+
+# Marketplace listing (keyset pagination, FTS5 search, facet filters)
+MARKETPLACE_SORTS = {
+    'newest': ('created_at', 'DESC'),
+    'price_low': ('price', 'ASC'),
+    'price_high': ('price', 'DESC'),
+}
+
+def _price_band_range(band):
+    for name, lower, upper in MARKETPLACE_PRICE_BANDS:
+        if name == band:
+            return lower, upper
+    return None
+
+def fetch_marketplace_page(cursor, query=None, category=None, price_band=None,
+                           sort='newest', after=None, limit=24):
+    """Return (rows, next_cursor) for one page of active marketplace items"""
+    sort_column, direction = MARKETPLACE_SORTS.get(sort, MARKETPLACE_SORTS['newest'])
+    conditions, params = ["m.status = 'active'"], []
+    source = 'marketplace_items m'
+
+    match = fts_query(query or '')
+    if match:
+        source = 'marketplace_items_fts f JOIN marketplace_items m ON m.id = f.rowid'
+        conditions.append('marketplace_items_fts MATCH ?')
+        params.append(match)
+    if category:
+        conditions.append('m.category = ?')
+        params.append(category)
+    price_range = _price_band_range(price_band)
+    if price_range:
+        conditions.append('m.price >= ?')
+        params.append(price_range[0])
+        if price_range[1] is not None:
+            conditions.append('m.price < ?')
+            params.append(price_range[1])
+
+    last = decode_page_cursor(after)
+    if last:
+        comparison = '<' if direction == 'DESC' else '>'
+        conditions.append(f'(m.{sort_column}, m.id) {comparison} (?, ?)')
+        params.extend(last)
+
+    cursor.execute(f'''
+        SELECT m.id, m.seller_id, m.title, m.description, m.price, m.category,
+               m.image_url, m.status, m.created_at, u.name AS seller_name
+        FROM {source}
+        JOIN users u ON m.seller_id = u.id
+        WHERE {' AND '.join(conditions)}
+        ORDER BY m.{sort_column} {direction}, m.id {direction}
+        LIMIT ?
+    ''', params + [limit + 1])
+    rows = cursor.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        sort_value = rows[-1][4] if sort_column == 'price' else rows[-1][8]
+        next_cursor = encode_page_cursor([sort_value, rows[-1][0]])
+    return rows, next_cursor
+
+def fetch_wholesale_page(cursor, query=None, category=None, after=None, limit=12):
+    """Return (rows, next_cursor) for one page of wholesale products, newest first"""
+    conditions, params = ["wp.status = 'active'", "wpart.status = 'approved'"], []
+    source = 'wholesale_products wp'
+
+    match = fts_query(query or '')
+    if match:
+        source = 'wholesale_products_fts f JOIN wholesale_products wp ON wp.id = f.rowid'
+        conditions.append('wholesale_products_fts MATCH ?')
+        params.append(match)
+    if category:
+        conditions.append('wp.category = ?')
+        params.append(category)
+
+    last = decode_page_cursor(after)
+    if last:
+        conditions.append('(wp.created_at, wp.id) < (?, ?)')
+        params.extend(last)
+
+    cursor.execute(f'''
+        SELECT wp.id, wp.product_name, wp.description, wp.price, wp.wholesale_price,
+               wp.category, wpart.company_name AS partner_name, wp.commission_rate,
+               wp.sku, wp.stock_quantity, wp.created_at
+        FROM {source}
+        JOIN wholesale_partners wpart ON wp.partner_id = wpart.id
+        WHERE {' AND '.join(conditions)}
+        ORDER BY wp.created_at DESC, wp.id DESC
+        LIMIT ?
+    ''', params + [limit + 1])
+    rows = cursor.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_page_cursor([rows[-1][10], rows[-1][0]])
+    return rows, next_cursor
+
+def fetch_marketplace_facets(cursor):
+    """Category and price band counts for the marketplace filters"""
+    cursor.execute('SELECT facet, value, item_count FROM marketplace_facets WHERE item_count > 0')
+    facets = {'category': [], 'price_band': []}
+    for facet, value, item_count in cursor.fetchall():
+        facets.setdefault(facet, []).append((value, item_count))
+    facets['category'].sort()
+    band_order = [band for band, lower, upper in MARKETPLACE_PRICE_BANDS]
+    facets['price_band'].sort(key=lambda facet: band_order.index(facet[0]) if facet[0] in band_order else len(band_order))
+    return facets
 
 # Analytics functions
 def log_user_activity(user_id, activity_type, description):
-    """Log user activity to database."""
+    """Log user activity (buffered, written in batches by the event ingestor)."""
     try:
-        conn = sqlite3.connect('dadaal.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO user_activity_logs (user_id, activity_type, description)
-            VALUES (?, ?, ?)
-        ''', (user_id, activity_type, description))
-        conn.commit()
-        conn.close()
+        event_ingestor.emit('activity', user_id, activity_type, description)
     except Exception as e:
         print(f"Error logging user activity: {e}")
 
@@ -485,7 +1932,7 @@ def set_language(language):
 
 @app.route('/')
 def home():
-    return render_template('index.html', earnings=total_earnings)
+    return render_template('index.html', earnings=to_dollars(platform_counters.get('total_earnings_cents')))
 
 @app.route('/admin', methods=['GET', 'POST'])
 def admin():
@@ -512,29 +1959,25 @@ def admin():
 @app.route('/admin/dashboard')
 @admin_required
 def admin_dashboard():
-    conn = sqlite3.connect('dadaal.db')
+    conn = get_report_db()
     cursor = conn.cursor()
 
-    # Get total platform stats
-    cursor.execute('SELECT COUNT(*), SUM(total_earnings) FROM users WHERE status = "active"')
-    user_stats = cursor.fetchone()
+    # Get total platform stats from the rollup tables
+    cursor.execute("SELECT user_count, earnings_total_cents FROM user_status_totals WHERE status = 'active'")
+    user_count, earnings_cents = cursor.fetchone() or (0, 0)
+    user_stats = (user_count, to_dollars(earnings_cents))
 
-    cursor.execute('SELECT COUNT(*) FROM contact_messages WHERE status = "new"')
+    cursor.execute("SELECT COUNT(*) FROM contact_messages WHERE status = 'new'")
     new_messages = cursor.fetchone()[0]
 
-    cursor.execute('SELECT SUM(amount) FROM transactions WHERE type = "earning"')
-    total_earnings_db = cursor.fetchone()[0] or 0
+    cursor.execute("SELECT SUM(amount_total_cents) FROM daily_transaction_totals WHERE type = 'earning'")
+    total_earnings_db = to_dollars(cursor.fetchone()[0] or 0)
 
-    cursor.execute('SELECT SUM(commission_earned) FROM referrals WHERE status = "completed"')
-    affiliate_earnings_db = cursor.fetchone()[0] or 0
+    cursor.execute("SELECT commission_total_cents FROM referral_status_totals WHERE status = 'completed'")
+    affiliate_earnings_db = to_dollars((cursor.fetchone() or (0,))[0])
 
-    # Get all users with detailed info
-    cursor.execute('''
-        SELECT id, name, email, phone, total_earnings, status, premium_until, created_at 
-        FROM users 
-        ORDER BY created_at DESC
-    ''')
-    all_users = cursor.fetchall()
+    # Get the newest users (the full list is paginated on /admin/users)
+    all_users, _ = fetch_users_page(cursor, limit=20)
 
     # Get recent transactions
     cursor.execute('''
@@ -545,8 +1988,6 @@ def admin_dashboard():
     ''')
     recent_transactions = cursor.fetchall()
 
-    conn.close()
-
     return render_template('admin_dashboard.html', 
                          user_stats=user_stats,
                          new_messages=new_messages,
@@ -558,39 +1999,21 @@ def admin_dashboard():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    conn = None
     try:
-        conn = sqlite3.connect('dadaal.db')
+        conn = get_db()
         cursor = conn.cursor()
 
-        # Get user's earnings and stats
-        cursor.execute('''
-            SELECT total_earnings, referral_code, premium_until, name, email
-            FROM users WHERE id = ?
-        ''', (session['user_id'],))
-        user_data = cursor.fetchone()
+        # Balance, referral stats and recent transactions in one primary-key lookup
+        summary = fetch_user_summary(cursor, session['user_id'])
 
-        if not user_data:
+        if not summary:
             flash('Akoonkaaga lama helin. Fadlan mar kale gal.')
             return redirect(url_for('login'))
 
-        # Get recent transactions
-        cursor.execute('''
-            SELECT amount, type, description, created_at 
-            FROM transactions 
-            WHERE user_id = ? 
-            ORDER BY created_at DESC 
-            LIMIT 10
-        ''', (session['user_id'],))
-        transactions = cursor.fetchall()
-
-        # Get referral stats
-        cursor.execute('''
-            SELECT COUNT(*) as count, COALESCE(SUM(commission_earned), 0) as total
-            FROM referrals 
-            WHERE referrer_id = ? AND status = "completed"
-        ''', (session['user_id'],))
-        referral_stats = cursor.fetchone()
+        user_data = (summary['balance'], summary['referral_code'], summary['premium_until'],
+                     summary['name'], summary['email'])
+        transactions = [tuple(transaction[1:]) for transaction in summary['recent_transactions']]
+        referral_stats = (summary['referral_count'], summary['referral_commission'])
 
         return render_template('dashboard.html', 
                              user_data=user_data,
@@ -601,9 +2024,6 @@ def dashboard():
         flash('Khalad ayaa dhacay dashboard-ka la keenayay.')
         print(f"Dashboard error: {e}")
         return redirect(url_for('home'))
-    finally:
-        if conn:
-            conn.close()
 
 @app.route('/payment', methods=['GET', 'POST'])
 @login_required
@@ -614,13 +2034,15 @@ def payment():
     premium_amount = request.args.get('amount', '19.99')
 
     if request.method == 'POST':
-        amount = float(request.form.get('amount', 0))
+        amount_cents = parse_cents(request.form.get('amount', 0))
         phone = sanitize_input(request.form.get('phone', ''))
         payment_method = sanitize_input(request.form.get('payment_method', 'mobile_money'))
 
-        if amount <= 0:
+        # Checked in cents: 0.001 rounds to nothing, nan and inf are not amounts
+        if amount_cents is None or amount_cents <= 0:
             flash('Fadlan geli lacag sax ah.')
             return redirect(url_for('payment'))
+        amount = to_dollars(amount_cents)
 
         if not phone:
             flash('Fadlan geli nambarka telefoonka.')
@@ -647,7 +2069,7 @@ def payment():
                 payment_success = payment_response.get('success', False)
 
             if payment_success:
-                conn = sqlite3.connect('dadaal.db')
+                conn = get_db()
                 cursor = conn.cursor()
 
                 # Generate unique reference ID
@@ -668,10 +2090,10 @@ def payment():
                     premium_until = datetime.now() + timedelta(days=premium_days)
 
                     # Insert premium transaction
-                    cursor.execute('''
-                        INSERT INTO transactions (user_id, amount, type, status, description, reference_id)
-                        VALUES (?, ?, 'premium', 'completed', ?, ?)
-                    ''', (session['user_id'], amount, f'Premium subscription - {premium_plan} plan', reference_id))
+                    record_transaction(cursor, session['user_id'], amount_cents, 'premium',
+                                       f'Premium subscription - {premium_plan} plan',
+                                       reference_id=reference_id, payment_method=payment_method,
+                                       source='premium')
 
                     # Update user's premium status
                     cursor.execute('''
@@ -682,29 +2104,24 @@ def payment():
                     flash(f'Guul! Premium {premium_plan} plan waa la activation gareeyay ilaa {premium_until.strftime("%Y-%m-%d")}!')
                 else:
                     # Regular payment - Calculate commission (5% of payment)
-                    commission = amount * 0.05
+                    commission_cents = apply_rate(amount_cents, PAYMENT_COMMISSION_BPS)
+                    commission = to_dollars(commission_cents)
 
                     # Insert payment transaction
                     payment_description = f'Commission from ${amount} payment via {payment_method.replace("_", " ").title()}'
-                    cursor.execute('''
-                        INSERT INTO transactions (user_id, amount, type, status, description, reference_id)
-                        VALUES (?, ?, 'earning', 'completed', ?, ?)
-                    ''', (session['user_id'], commission, payment_description, reference_id))
+                    transaction_id = record_transaction(cursor, session['user_id'], commission_cents, 'earning',
+                                                        payment_description, reference_id=reference_id,
+                                                        payment_method=payment_method, source='payment_commission')
 
-                    # Update user's total earnings
-                    cursor.execute('''
-                        UPDATE users SET total_earnings = total_earnings + ?
-                        WHERE id = ?
-                    ''', (commission, session['user_id']))
+                    # Credit the commission (users.total_earnings follows from the ledger)
+                    ledger.post(cursor, session['user_id'], commission_cents, 'payment_commission', transaction_id)
 
-                    # Update global earnings
-                    global total_earnings
-                    total_earnings += commission
+                    # Update platform-wide earnings
+                    platform_counters.increment(conn, 'total_earnings_cents', commission_cents)
 
                     flash(f'Guul! Lacagtaada ${amount} si guul leh ayaa loo aqbalay. Commission ${commission:.2f} ayaa lagugu daray.')
 
                 conn.commit()
-                conn.close()
 
                 # Log payment activity
                 log_user_activity(session['user_id'], 'payment', f'Payment of ${amount} via {payment_method}')
@@ -716,6 +2133,7 @@ def payment():
                 return redirect(url_for('payment'))
 
         except Exception as e:
+            db.rollback()
             flash(f'Khalad ayaa dhacay lacag bixinta: {str(e)}')
             print(f"Payment processing error: {e}")
             return redirect(url_for('payment'))
@@ -884,192 +2302,184 @@ def get_crypto_rate(crypto_type):
 
 # Real Affiliate Marketing Integration
 import requests
-import json
 
-def get_alibaba_products(category="electronics", limit=50):
+# Partner catalogs are fetched concurrently through the shared catalog cache;
+# a provider slower than its deadline renders empty and fills the cache later
+CATALOG_FETCH_TIMEOUT = 10
+CATALOG_DEADLINES = {'alibaba': 2.0, 'amazon': 2.0}
+
+def fetch_alibaba_products(category="electronics"):
     """Get real Alibaba products via API"""
-    try:
-        # Alibaba API (requires API key)
-        # For now, we'll use sample data that mimics real structure
-        sample_products = [
-            {
-                'id': 'ALB001',
-                'name': 'Wireless Bluetooth Headphones',
-                'price': 15.99,
-                'commission_rate': 0.08,  # 8% commission
-                'supplier': 'Shenzhen Tech Co.',
-                'image_url': 'https://example.com/headphones.jpg',
-                'affiliate_url': 'https://www.alibaba.com/product-detail/...',
-                'category': 'Electronics'
-            },
-            {
-                'id': 'ALB002', 
-                'name': 'Smart Phone Case iPhone 15',
-                'price': 8.50,
-                'commission_rate': 0.12,  # 12% commission
-                'supplier': 'Guangzhou Mobile Accessories',
-                'image_url': 'https://example.com/phonecase.jpg',
-                'affiliate_url': 'https://www.alibaba.com/product-detail/...',
-                'category': 'Electronics'
-            },
-            {
-                'id': 'ALB003',
-                'name': 'LED Strip Lights 5M RGB',
-                'price': 12.99,
-                'commission_rate': 0.15,  # 15% commission
-                'supplier': 'Dongguan LED Factory',
-                'image_url': 'https://example.com/ledstrip.jpg',
-                'affiliate_url': 'https://www.alibaba.com/product-detail/...',
-                'category': 'Home & Garden'
-            },
-            {
-                'id': 'ALB004',
-                'name': 'Fitness Tracker Smart Watch',
-                'price': 25.99,
-                'commission_rate': 0.10,  # 10% commission
-                'supplier': 'Shenzhen Wearable Tech',
-                'image_url': 'https://example.com/smartwatch.jpg',
-                'affiliate_url': 'https://www.alibaba.com/product-detail/...',
-                'category': 'Electronics'
-            },
-            {
-                'id': 'ALB005',
-                'name': 'Kitchen Silicone Utensils Set',
-                'price': 18.99,
-                'commission_rate': 0.20,  # 20% commission
-                'supplier': 'Yangjiang Kitchenware Co.',
-                'image_url': 'https://example.com/utensils.jpg',
-                'affiliate_url': 'https://www.alibaba.com/product-detail/...',
-                'category': 'Home & Kitchen'
-            }
-        ]
+    if os.environ.get('ALIBABA_API_URL'):
+        return fetch_json_products(os.environ['ALIBABA_API_URL'], {'category': category},
+                                   timeout=CATALOG_FETCH_TIMEOUT)
+    # Alibaba API (requires API key)
+    # For now, we'll use sample data that mimics real structure
+    sample_products = [
+        {
+            'id': 'ALB001',
+            'name': 'Wireless Bluetooth Headphones',
+            'price': 15.99,
+            'commission_rate': 0.08,  # 8% commission
+            'supplier': 'Shenzhen Tech Co.',
+            'image_url': 'https://example.com/headphones.jpg',
+            'affiliate_url': 'https://www.alibaba.com/product-detail/...',
+            'category': 'Electronics'
+        },
+        {
+            'id': 'ALB002', 
+            'name': 'Smart Phone Case iPhone 15',
+            'price': 8.50,
+            'commission_rate': 0.12,  # 12% commission
+            'supplier': 'Guangzhou Mobile Accessories',
+            'image_url': 'https://example.com/phonecase.jpg',
+            'affiliate_url': 'https://www.alibaba.com/product-detail/...',
+            'category': 'Electronics'
+        },
+        {
+            'id': 'ALB003',
+            'name': 'LED Strip Lights 5M RGB',
+            'price': 12.99,
+            'commission_rate': 0.15,  # 15% commission
+            'supplier': 'Dongguan LED Factory',
+            'image_url': 'https://example.com/ledstrip.jpg',
+            'affiliate_url': 'https://www.alibaba.com/product-detail/...',
+            'category': 'Home & Garden'
+        },
+        {
+            'id': 'ALB004',
+            'name': 'Fitness Tracker Smart Watch',
+            'price': 25.99,
+            'commission_rate': 0.10,  # 10% commission
+            'supplier': 'Shenzhen Wearable Tech',
+            'image_url': 'https://example.com/smartwatch.jpg',
+            'affiliate_url': 'https://www.alibaba.com/product-detail/...',
+            'category': 'Electronics'
+        },
+        {
+            'id': 'ALB005',
+            'name': 'Kitchen Silicone Utensils Set',
+            'price': 18.99,
+            'commission_rate': 0.20,  # 20% commission
+            'supplier': 'Yangjiang Kitchenware Co.',
+            'image_url': 'https://example.com/utensils.jpg',
+            'affiliate_url': 'https://www.alibaba.com/product-detail/...',
+            'category': 'Home & Kitchen'
+        }
+    ]
 
-        return sample_products[:limit]
-    except Exception as e:
-        print(f"Alibaba API error: {e}")
-        return []
+    return sample_products
 
-def get_amazon_products(keyword="electronics", limit=20):
+def fetch_amazon_products(keyword="electronics"):
     """Get Amazon products via Amazon Associates API"""
-    try:
-        # Amazon Associates API integration would go here
-        # For now, using sample data that mimics real Amazon structure
-        sample_products = [
-            {
-                'id': 'AMZ001',
-                'name': 'Apple AirPods Pro (2nd Generation)',
-                'price': 249.99,
-                'commission_rate': 0.04,  # 4% commission (Amazon's typical rate)
-                'brand': 'Apple',
-                'image_url': 'https://example.com/airpods.jpg',
-                'affiliate_url': 'https://amazon.com/dp/B0BDHWDR12?tag=dadaal-20',
-                'category': 'Electronics',
-                'rating': 4.5,
-                'reviews': 89234
-            },
-            {
-                'id': 'AMZ002',
-                'name': 'Samsung Galaxy S24 Ultra',
-                'price': 1199.99,
-                'commission_rate': 0.02,  # 2% commission
-                'brand': 'Samsung',
-                'image_url': 'https://example.com/samsung.jpg',
-                'affiliate_url': 'https://amazon.com/dp/B0CMDRCG4Q?tag=dadaal-20',
-                'category': 'Electronics',
-                'rating': 4.4,
-                'reviews': 12456
-            },
-            {
-                'id': 'AMZ003',
-                'name': 'Instant Pot Duo 7-in-1 Electric Pressure Cooker',
-                'price': 79.99,
-                'commission_rate': 0.08,  # 8% commission
-                'brand': 'Instant Pot',
-                'image_url': 'https://example.com/instantpot.jpg',
-                'affiliate_url': 'https://amazon.com/dp/B00FLYWNYQ?tag=dadaal-20',
-                'category': 'Home & Kitchen',
-                'rating': 4.6,
-                'reviews': 156789
-            }
-        ]
+    if os.environ.get('AMAZON_API_URL'):
+        return fetch_json_products(os.environ['AMAZON_API_URL'], {'keyword': keyword},
+                                   timeout=CATALOG_FETCH_TIMEOUT)
+    # Amazon Associates API integration would go here
+    # For now, using sample data that mimics real Amazon structure
+    sample_products = [
+        {
+            'id': 'AMZ001',
+            'name': 'Apple AirPods Pro (2nd Generation)',
+            'price': 249.99,
+            'commission_rate': 0.04,  # 4% commission (Amazon's typical rate)
+            'brand': 'Apple',
+            'image_url': 'https://example.com/airpods.jpg',
+            'affiliate_url': 'https://amazon.com/dp/B0BDHWDR12?tag=dadaal-20',
+            'category': 'Electronics',
+            'rating': 4.5,
+            'reviews': 89234
+        },
+        {
+            'id': 'AMZ002',
+            'name': 'Samsung Galaxy S24 Ultra',
+            'price': 1199.99,
+            'commission_rate': 0.02,  # 2% commission
+            'brand': 'Samsung',
+            'image_url': 'https://example.com/samsung.jpg',
+            'affiliate_url': 'https://amazon.com/dp/B0CMDRCG4Q?tag=dadaal-20',
+            'category': 'Electronics',
+            'rating': 4.4,
+            'reviews': 12456
+        },
+        {
+            'id': 'AMZ003',
+            'name': 'Instant Pot Duo 7-in-1 Electric Pressure Cooker',
+            'price': 79.99,
+            'commission_rate': 0.08,  # 8% commission
+            'brand': 'Instant Pot',
+            'image_url': 'https://example.com/instantpot.jpg',
+            'affiliate_url': 'https://amazon.com/dp/B00FLYWNYQ?tag=dadaal-20',
+            'category': 'Home & Kitchen',
+            'rating': 4.6,
+            'reviews': 156789
+        }
+    ]
 
-        return sample_products[:limit]
-    except Exception as e:
-        print(f"Amazon API error: {e}")
-        return []
+    return sample_products
 
-def track_affiliate_click(user_id, product_id, platform):
-    """Track affiliate link clicks"""
-    try:
-        conn = sqlite3.connect('dadaal.db', timeout=20.0)
-        cursor = conn.cursor()
+catalog.register('alibaba', fetch_alibaba_products, deadline=CATALOG_DEADLINES['alibaba'])
+catalog.register('amazon', fetch_amazon_products, deadline=CATALOG_DEADLINES['amazon'])
 
-        # Create affiliate clicks table if doesn't exist
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS affiliate_clicks (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                product_id TEXT NOT NULL,
-                platform TEXT NOT NULL,
-                clicked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                ip_address TEXT,
-                converted BOOLEAN DEFAULT 0,
-                commission_earned REAL DEFAULT 0,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-
-        # Record the click
-        cursor.execute('''
-            INSERT INTO affiliate_clicks (user_id, product_id, platform)
-            VALUES (?, ?, ?)
-        ''', (user_id, product_id, platform))
+def get_alibaba_products(category="electronics", limit=50):
+    """Get Alibaba products from the catalog cache"""
+    return catalog.get('alibaba', category=category)[:limit]
 
-        conn.commit()
-        conn.close()
+def get_amazon_products(keyword="electronics", limit=20):
+    """Get Amazon products from the catalog cache"""
+    return catalog.get('amazon', keyword=keyword)[:limit]
 
-        return True
+def track_affiliate_click(user_id, product_id, platform):
+    """Track affiliate link clicks"""
+    try:
+        # Buffered: the ingestor writes clicks in batches
+        return event_ingestor.emit('affiliate_click', user_id, product_id, platform)
     except Exception as e:
         print(f"Affiliate click tracking error: {e}")
         return False
 
+def affiliate_commission_cents(sale_amount, commission_rate):
+    """Commission on a sale in dollars at a fractional rate, in whole cents"""
+    return apply_rate(to_cents(sale_amount), to_basis_points(commission_rate))
+
 def process_affiliate_commission(user_id, product_id, sale_amount, commission_rate):
     """Process real affiliate commission when sale happens"""
     try:
-        commission_amount = sale_amount * commission_rate
+        commission_cents = affiliate_commission_cents(sale_amount, commission_rate)
+        commission_amount = to_dollars(commission_cents)
 
-        conn = sqlite3.connect('dadaal.db', timeout=20.0)
+        conn = get_db()
         cursor = conn.cursor()
 
-        # Add commission to user's earnings
-        cursor.execute('''
-            UPDATE users SET total_earnings = total_earnings + ?
-            WHERE id = ?
-        ''', (commission_amount, user_id))
-
-        # Record the transaction
-        cursor.execute('''
-            INSERT INTO transactions (user_id, amount, type, description, status)
-            VALUES (?, ?, 'earning', ?, 'completed')
-        ''', (user_id, commission_amount, f'Affiliate commission - Product {product_id}'))
+        # Record the transaction and credit the commission
+        transaction_id = record_transaction(cursor, user_id, commission_cents, 'earning',
+                                            f'Affiliate commission - Product {product_id}', source='affiliate')
+        ledger.post(cursor, user_id, commission_cents, 'affiliate', transaction_id)
 
-        # Update affiliate click record
-        cursor.execute('''
-            UPDATE affiliate_clicks 
-            SET converted = 1, commission_earned = ?
-            WHERE user_id = ? AND product_id = ?
-        ''', (commission_amount, user_id, product_id))
+        platform_counters.increment(conn, 'affiliate_earnings_cents', commission_cents)
 
         conn.commit()
-        conn.close()
-
-        print(f"✅ Affiliate commission processed: ${commission_amount} for user {user_id}")
-        return True
 
     except Exception as e:
+        db.rollback()
         print(f"Commission processing error: {e}")
         return False
 
+    # The commission is committed from here on, so a telemetry failure is only
+    # logged: reporting failure would invite a retry that credits it twice
+    try:
+        # Write clicks still buffered in the ingestor, so a sale right after a click converts it
+        event_ingestor.flush()
+        telemetry = get_telemetry_db()
+        with telemetry_db.immediate(telemetry):
+            affiliate_rollups.record_conversion(telemetry, user_id, product_id, commission_amount)
+        affiliate_rollups.notify([user_id])
+    except Exception as e:
+        print(f"Affiliate conversion tracking error: {e}")
+
+    print(f"✅ Affiliate commission processed: ${commission_amount} for user {user_id}")
+    return True
+
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -1104,12 +2514,11 @@ def register():
 
         try:
             # Check if email exists
-            conn = sqlite3.connect('dadaal.db')
+            conn = get_db()
             cursor = conn.cursor()
             cursor.execute('SELECT id FROM users WHERE email = ?', (email,))
             if cursor.fetchone():
                 flash('Email-kan horay ayaa loo isticmaalay.')
-                conn.close()
                 return redirect(url_for('register'))
         except Exception as e:
             flash('Khalad ayaa dhacay database-ka. Fadlan isku day mar kale.')
@@ -1148,18 +2557,18 @@ def register():
                 }
 
                 conn.commit()
-                conn.close()
 
                 flash(f'Verification code waxaa lagu diray {email}. Fadlan hubi email-kaaga oo gali code-ka.')
                 return redirect(url_for('verify_email'))
             else:
                 flash('Khalad ayaa dhacay email-ka dirista. Fadlan isku day mar kale.')
-                conn.close()
                 return redirect(url_for('register'))
 
+        except PasswordHasherBusy:
+            db.rollback()
+            raise
         except Exception as e:
-            conn.rollback()
-            conn.close()
+            db.rollback()
             flash(f'Khalad ayaa dhacay akoonka samayniisa: {str(e)}')
             return redirect(url_for('register'))
 
@@ -1175,7 +2584,7 @@ def forgot_password():
             return render_template('forgot_password.html')
 
         try:
-            conn = sqlite3.connect('dadaal.db')
+            conn = get_db()
             cursor = conn.cursor()
 
             # Check if user exists
@@ -1204,7 +2613,6 @@ def forgot_password():
                 # Don't reveal if email exists or not for security
                 flash('Haddii email-kaan jiro, fariinta password reset waxaa lagu diray email-kaaga.')
 
-            conn.close()
             return redirect(url_for('forgot_password'))
 
         except Exception as e:
@@ -1216,9 +2624,8 @@ def forgot_password():
 
 @app.route('/reset_password/<token>', methods=['GET', 'POST'])
 def reset_password(token):
-    conn = None
     try:
-        conn = sqlite3.connect('dadaal.db')
+        conn = get_db()
         cursor = conn.cursor()
 
         # Check if token is valid and not expired
@@ -1263,13 +2670,14 @@ def reset_password(token):
 
         return render_template('reset_password.html', token=token, user_name=token_data[3])
 
+    except PasswordHasherBusy:
+        db.rollback()
+        raise
     except Exception as e:
+        db.rollback()
         flash('Khalad ayaa dhacay. Fadlan isku day mar kale.')
         print(f"Reset password error: {e}")
         return redirect(url_for('login'))
-    finally:
-        if conn:
-            conn.close()
 
 @app.route('/verify_email', methods=['GET', 'POST'])
 def verify_email():
@@ -1284,9 +2692,8 @@ def verify_email():
             flash('Fadlan gali verification code-ka.')
             return render_template('verify_email.html')
 
-        conn = None
         try:
-            conn = sqlite3.connect('dadaal.db')
+            conn = get_db()
             cursor = conn.cursor()
 
             # Check if verification code is valid
@@ -1318,15 +2725,17 @@ def verify_email():
                 # Create referral record if applicable
                 if user_data['referrer_id']:
                     cursor.execute('''
-                        INSERT INTO referrals (referrer_id, referred_id, commission_earned)
-                        VALUES (?, ?, ?)
-                    ''', (user_data['referrer_id'], user_id, 5.00))
+                        INSERT INTO referrals (referrer_id, referred_id, commission_earned, commission_cents)
+                        VALUES (?, ?, ?, ?)
+                    ''', (user_data['referrer_id'], user_id, to_dollars(REFERRAL_BONUS_CENTS), REFERRAL_BONUS_CENTS))
 
-                    # Add referral bonus to referrer
-                    cursor.execute('''
-                        UPDATE users SET total_earnings = total_earnings + 5.00 
-                        WHERE id = ?
-                    ''', (user_data['referrer_id'],))
+                    # Add referral bonus to referrer, with the transaction row it used to lack
+                    transaction_id = record_transaction(cursor, user_data['referrer_id'], REFERRAL_BONUS_CENTS,
+                                                        'referral', f"Referral bonus - {user_data['name']}",
+                                                        source='referral')
+                    ledger.post(cursor, user_data['referrer_id'], REFERRAL_BONUS_CENTS, 'referral', transaction_id)
+
+                    platform_counters.increment(conn, 'referral_count', 1)
 
                 conn.commit()
 
@@ -1348,12 +2757,10 @@ def verify_email():
                 return render_template('verify_email.html')
 
         except Exception as e:
+            db.rollback()
             flash('Khalad ayaa dhacay verification-ka. Fadlan isku day mar kale.')
             print(f"Email verification error: {e}")
             return render_template('verify_email.html')
-        finally:
-            if conn:
-                conn.close()
 
     return render_template('verify_email.html', email=session['pending_user']['email'])
 
@@ -1362,13 +2769,12 @@ def resend_verification():
     if 'pending_user' not in session:
         return {'success': False, 'error': 'No pending verification found'}
 
-    conn = None
     try:
         email = session['pending_user']['email']
         verification_code = generate_verification_code()
         expires_at = datetime.now() + timedelta(minutes=10)
 
-        conn = sqlite3.connect('dadaal.db')
+        conn = get_db()
         cursor = conn.cursor()
 
         # Insert new verification code
@@ -1388,9 +2794,6 @@ def resend_verification():
     except Exception as e:
         print(f"Resend verification error: {e}")
         return {'success': False, 'error': 'Technical error occurred'}
-    finally:
-        if conn:
-            conn.close()
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -1402,9 +2805,8 @@ def login():
             flash('Fadlan geli email iyo password.')
             return render_template('login.html')
 
-        conn = None
         try:
-            conn = sqlite3.connect('dadaal.db')
+            conn = get_db()
             cursor = conn.cursor()
             cursor.execute('SELECT id, name, password_hash, status FROM users WHERE email = ?', (email,))
             user = cursor.fetchone()
@@ -1422,6 +2824,11 @@ def login():
                 return render_template('login.html')
 
             if verify_password(user[2], password):
+                # Upgrade hashes written with an older format or iteration count
+                if password_hasher.needs_rehash(user[2]):
+                    cursor.execute('UPDATE users SET password_hash = ? WHERE id = ?',
+                                   (hash_password(password), user[0]))
+
                 session['user_id'] = user[0]
                 session['user_name'] = user[1]
                 session['is_admin'] = False  # Add admin check if needed
@@ -1433,13 +2840,12 @@ def login():
                 flash('Password khalad. Fadlan isku day mar kale.')
                 return render_template('login.html')
 
+        except PasswordHasherBusy:
+            raise
         except Exception as e:
             flash('Khalad ayaa dhacay mareegta. Fadlan isku day mar kale.')
             print(f"Login error: {e}")
             return render_template('login.html')
-        finally:
-            if conn:
-                conn.close()
 
     return render_template('login.html')
 
@@ -1452,28 +2858,21 @@ def logout():
 @app.route('/profile')
 @login_required
 def profile():
-    conn = None
     try:
-        conn = sqlite3.connect('dadaal.db')
+        conn = get_db()
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT name, email, phone, total_earnings, referral_code, premium_until, created_at
-            FROM users WHERE id = ?
-        ''', (session['user_id'],))
-        user_data = cursor.fetchone()
-
-        # Get referral stats
-        cursor.execute('SELECT COUNT(*) FROM referrals WHERE referrer_id = ? AND status = "completed"', (session['user_id'],))
-        referral_count = cursor.fetchone()[0]
+        summary = fetch_user_summary(cursor, session['user_id'])
+        if not summary:
+            flash('Akoonkaaga lama helin. Fadlan mar kale gal.')
+            return redirect(url_for('login'))
 
-        return render_template('profile.html', user=user_data, referral_count=referral_count)
+        user_data = (summary['name'], summary['email'], summary['phone'], summary['balance'],
+                     summary['referral_code'], summary['premium_until'], summary['created_at'])
+        return render_template('profile.html', user=user_data, referral_count=summary['referral_count'])
     except Exception as e:
         flash('Khalad ayaa dhacay profile-ka.')
         print(f"Profile error: {e}")
         return redirect(url_for('dashboard'))
-    finally:
-        if conn:
-            conn.close()
 
 
 
@@ -1500,14 +2899,14 @@ def track_referral():
     referral_code = data.get('referral_code')
     action = data.get('action')  # 'signup', 'share', etc.
 
-    # Here you would normally save to database
-    global total_earnings
     if action == 'signup':
-        total_earnings += 5.00  # $5 for successful referral
+        earnings_cents = platform_counters.increment(get_db(), 'total_earnings_cents', REFERRAL_BONUS_CENTS)
     elif action == 'share':
-        total_earnings += 0.25  # $0.25 for sharing
+        earnings_cents = platform_counters.increment(get_db(), 'total_earnings_cents', SHARE_BONUS_CENTS)
+    else:
+        earnings_cents = platform_counters.get('total_earnings_cents')
 
-    return {'success': True, 'earnings': total_earnings}
+    return {'success': True, 'earnings': to_dollars(earnings_cents)}
 
 @app.route('/track_share', methods=['POST'])
 def track_share():
@@ -1518,47 +2917,25 @@ def track_share():
         referral_code = data.get('referral_code')
         timestamp = data.get('timestamp')
 
-        # Save sharing analytics to database
-        conn = sqlite3.connect('dadaal.db')
-        cursor = conn.cursor()
-
-        # Create shares table if it doesn't exist
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS shares (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                platform TEXT NOT NULL,
-                referral_code TEXT,
-                shared_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-
-        # Insert share record
+        # Save sharing analytics (buffered by the event ingestor)
         user_id = session.get('user_id')
-        cursor.execute('''
-            INSERT INTO shares (user_id, platform, referral_code)
-            VALUES (?, ?, ?)
-        ''', (user_id, platform, referral_code))
+        event_ingestor.emit('share', user_id, platform, referral_code)
 
         # Give small bonus for sharing (optional)
         if user_id:
-            cursor.execute('''
-                INSERT INTO transactions (user_id, amount, type, description)
-                VALUES (?, ?, 'bonus', ?)
-            ''', (user_id, 0.25, f'Sharing bonus - {platform}'))
+            conn = get_db()
+            cursor = conn.cursor()
 
-            cursor.execute('''
-                UPDATE users SET total_earnings = total_earnings + 0.25
-                WHERE id = ?
-            ''', (user_id,))
+            transaction_id = record_transaction(cursor, user_id, SHARE_BONUS_CENTS, 'bonus',
+                                                f'Sharing bonus - {platform}', source='share_bonus')
+            ledger.post(cursor, user_id, SHARE_BONUS_CENTS, 'share_bonus', transaction_id)
 
-        conn.commit()
-        conn.close()
+            conn.commit()
 
         return {'success': True, 'message': 'Share tracked successfully'}
 
     except Exception as e:
+        db.rollback()
         print(f"Share tracking error: {e}")
         return {'success': False, 'error': str(e)}
 
@@ -1596,65 +2973,45 @@ def business_plans():
 @login_required
 def marketplace():
     """Digital marketplace for selling products/services"""
-    conn = None
     try:
-        conn = sqlite3.connect('dadaal.db')
+        conn = get_db()
         cursor = conn.cursor()
 
-        # Get marketplace items (create table if needed)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS marketplace_items (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                seller_id INTEGER NOT NULL,
-                title TEXT NOT NULL,
-                description TEXT,
-                price REAL NOT NULL,
-                category TEXT,
-                image_url TEXT,
-                status TEXT DEFAULT 'active',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (seller_id) REFERENCES users (id)
-            )
-        ''')
+        filters = {
+            'q': sanitize_input(request.args.get('q', '')),
+            'category': sanitize_input(request.args.get('category', '')),
+            'price_band': sanitize_input(request.args.get('price_band', '')),
+            'sort': sanitize_input(request.args.get('sort', 'newest')),
+        }
 
-        # Get active marketplace items
-        cursor.execute('''
-            SELECT m.*, u.name as seller_name 
-            FROM marketplace_items m 
-            JOIN users u ON m.seller_id = u.id 
-            WHERE m.status = 'active' 
-            ORDER BY m.created_at DESC
-        ''')
-        marketplace_items = cursor.fetchall()
+        # Get one page of active marketplace items
+        marketplace_items, next_cursor = fetch_marketplace_page(
+            cursor, query=filters['q'], category=filters['category'],
+            price_band=filters['price_band'], sort=filters['sort'],
+            after=request.args.get('after'))
 
-        # Get wholesale products
-        cursor.execute('''
-            SELECT wp.*, wpart.company_name as partner_name
-            FROM wholesale_products wp
-            JOIN wholesale_partners wpart ON wp.partner_id = wpart.id
-            WHERE wp.status = 'active' AND wpart.status = 'approved'
-            ORDER BY wp.created_at DESC
-        ''')
-        wholesale_products = cursor.fetchall()
+        # Get one page of wholesale products
+        wholesale_products, wholesale_next_cursor = fetch_wholesale_page(
+            cursor, query=filters['q'], category=filters['category'],
+            after=request.args.get('wafter'))
 
-        conn.commit()
-        return render_template('marketplace.html', 
+        return render_template('marketplace.html',
                              items=marketplace_items,
-                             wholesale_products=wholesale_products)
+                             wholesale_products=wholesale_products,
+                             facets=fetch_marketplace_facets(cursor),
+                             filters=filters,
+                             next_cursor=next_cursor,
+                             wholesale_next_cursor=wholesale_next_cursor)
 
     except Exception as e:
         flash('Khalad ayaa dhacay marketplace-ka.')
         print(f"Marketplace error: {e}")
         return redirect(url_for('dashboard'))
-    finally:
-        if conn:
-            conn.close()
 
 @app.route('/add_marketplace_item', methods=['POST'])
 @login_required
 def add_marketplace_item():
     """Add item to marketplace"""
-    conn = None
     try:
         title = sanitize_input(request.form.get('title'))
         description = sanitize_input(request.form.get('description'))
@@ -1665,7 +3022,7 @@ def add_marketplace_item():
             flash('Fadlan buuxi macluumaadka item-ka.')
             return redirect(url_for('marketplace'))
 
-        conn = sqlite3.connect('dadaal.db')
+        conn = get_db()
         cursor = conn.cursor()
 
         cursor.execute('''
@@ -1681,9 +3038,6 @@ def add_marketplace_item():
         flash('Khalad ayaa dhacay item-ka ku darista.')
         print(f"Add marketplace item error: {e}")
         return redirect(url_for('marketplace'))
-    finally:
-        if conn:
-            conn.close()
 
 @app.route('/affiliate')
 def affiliate():
@@ -1693,40 +3047,20 @@ def affiliate():
 @login_required
 def real_affiliate():
     """Real affiliate marketing with Alibaba, Amazon integration"""
-    conn = None
     try:
-        # Get real products from different platforms
-        alibaba_products = get_alibaba_products(limit=12)
-        amazon_products = get_amazon_products(limit=8)
-
-        # Get user's affiliate stats
-        conn = sqlite3.connect('dadaal.db')
-        cursor = conn.cursor()
-
-        # Get total affiliate earnings
-        cursor.execute('''
-            SELECT COALESCE(SUM(commission_earned), 0) 
-            FROM affiliate_clicks 
-            WHERE user_id = ? AND converted = 1
-        ''', (session['user_id'],))
-        affiliate_earnings = cursor.fetchone()[0]
-
-        # Get clicks today
-        cursor.execute('''
-            SELECT COUNT(*) 
-            FROM affiliate_clicks 
-            WHERE user_id = ? AND DATE(clicked_at) = DATE('now')
-        ''', (session['user_id'],))
-        clicks_today = cursor.fetchone()[0]
-
-        # Get conversions this month
-        cursor.execute('''
-            SELECT COUNT(*) 
-            FROM affiliate_clicks 
-            WHERE user_id = ? AND converted = 1 
-            AND strftime('%Y-%m', clicked_at) = strftime('%Y-%m', 'now')
-        ''', (session['user_id'],))
-        conversions_month = cursor.fetchone()[0]
+        # Get real products from different platforms (fetched concurrently)
+        products = catalog.get_many({
+            'alibaba': {'category': 'electronics'},
+            'amazon': {'keyword': 'electronics'},
+        })
+        alibaba_products = products['alibaba'][:12]
+        amazon_products = products['amazon'][:8]
+
+        # Get user's affiliate stats (rollups plus the unrolled tail)
+        stats = affiliate_rollups.user_stats(get_telemetry_db(), session['user_id'])
+        affiliate_earnings = stats['total_earned']
+        clicks_today = stats['clicks_today']
+        conversions_month = stats['conversions_month']
 
         return render_template('real_affiliate.html',
                              alibaba_products=alibaba_products,
@@ -1739,9 +3073,30 @@ def real_affiliate():
         flash('Khalad ayaa dhacay affiliate marketing.')
         print(f"Real affiliate error: {e}")
         return redirect(url_for('affiliate'))
-    finally:
-        if conn:
-            conn.close()
+
+@app.route('/affiliate/products')
+@login_required
+def affiliate_products():
+    """Search the mirrored partner catalogs"""
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        limit = min(max(request.args.get('limit', 24, type=int), 1), 100)
+        products, next_cursor = fetch_catalog_page(
+            cursor,
+            query=sanitize_input(request.args.get('q', '')),
+            platform=sanitize_input(request.args.get('platform', '')),
+            category=sanitize_input(request.args.get('category', '')),
+            min_commission=request.args.get('min_commission', type=float),
+            sort=sanitize_input(request.args.get('sort', 'commission')),
+            after=request.args.get('after'),
+            limit=limit,
+        )
+        return {'success': True, 'products': products, 'next_cursor': next_cursor}
+
+    except Exception as e:
+        print(f"Catalog search error: {e}")
+        return {'success': False, 'error': str(e)}
 
 @app.route('/track_affiliate_click', methods=['POST'])
 @login_required
@@ -1763,43 +3118,78 @@ def track_affiliate_click_route():
     except Exception as e:
         return {'success': False, 'error': str(e)}
 
+# Live affiliate stats: streams wake on committed changes instead of polling
+# Each open stream holds a gunicorn thread (render.yaml runs gthread workers), so
+# streams end well inside the worker --timeout and the browser reconnects, and at
+# most AFFILIATE_STREAM_SLOTS of a worker's threads ever hold one. Past that the
+# stream answers 204, which stops EventSource; the page then polls /affiliate_stats.
+AFFILIATE_STREAM_HEARTBEAT = 15   # seconds between keepalives / cross-process rechecks
+AFFILIATE_STREAM_LIFETIME = 45    # seconds before the browser is asked to reconnect
+AFFILIATE_STREAM_SLOTS = 4        # of the 16 threads per worker in render.yaml
+affiliate_stream_slots = threading.BoundedSemaphore(AFFILIATE_STREAM_SLOTS)
+
+def affiliate_stats_snapshot(conn, user_id):
+    """Stats for the affiliate dashboard plus a version tag for ETag / event ids"""
+    stats = affiliate_rollups.user_stats(conn, user_id)
+    stats['conversion_rate'] = (stats['total_conversions'] / stats['total_clicks'] * 100) if stats['total_clicks'] > 0 else 0
+    tag = hashlib.sha1(json.dumps(stats, sort_keys=True).encode()).hexdigest()[:16]
+    return stats, tag
+
 @app.route('/affiliate_stats')
 @login_required
 def affiliate_stats():
     """Get real-time affiliate statistics"""
-    conn = None
     try:
-        conn = sqlite3.connect('dadaal.db')
-        cursor = conn.cursor()
-
-        # Get comprehensive stats
-        cursor.execute('''
-            SELECT 
-                COUNT(*) as total_clicks,
-                COUNT(CASE WHEN converted = 1 THEN 1 END) as total_conversions,
-                COALESCE(SUM(commission_earned), 0) as total_earned,
-                COUNT(CASE WHEN DATE(clicked_at) = DATE('now') THEN 1 END) as clicks_today
-            FROM affiliate_clicks 
-            WHERE user_id = ?
-        ''', (session['user_id'],))
+        stats, tag = affiliate_stats_snapshot(get_telemetry_db(), session['user_id'])
 
-        stats = cursor.fetchone()
-        
-        return {
-            'success': True,
-            'total_clicks': stats[0],
-            'total_conversions': stats[1], 
-            'total_earned': stats[2],
-            'clicks_today': stats[3],
-            'conversion_rate': (stats[1] / stats[0] * 100) if stats[0] > 0 else 0
-        }
+        response = app.make_response({'success': True, **stats})
+        response.set_etag(tag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response.make_conditional(request)
 
     except Exception as e:
         print(f"Affiliate stats error: {e}")
         return {'success': False, 'error': str(e)}
-    finally:
-        if conn:
-            conn.close()
+
+@app.route('/affiliate_stats/stream')
+@login_required
+def affiliate_stats_stream():
+    """Server-Sent Events: push the fields of a user's stats that changed"""
+    user_id = session['user_id']
+    last_event_id = request.headers.get('Last-Event-ID')
+    heartbeat = app.config.get('AFFILIATE_STREAM_HEARTBEAT', AFFILIATE_STREAM_HEARTBEAT)
+    lifetime = app.config.get('AFFILIATE_STREAM_LIFETIME', AFFILIATE_STREAM_LIFETIME)
+    slots = affiliate_stream_slots
+    if not slots.acquire(blocking=False):
+        return '', 204
+
+    def generate():
+        deadline = time.monotonic() + lifetime
+        version = affiliate_rollups.version(user_id)
+        sent, sent_tag = {}, last_event_id
+        yield 'retry: 5000\n\n'
+        while True:
+            with telemetry_db.session() as conn:
+                stats, tag = affiliate_stats_snapshot(conn, user_id)
+            if tag != sent_tag:
+                delta = {key: value for key, value in stats.items() if sent.get(key) != value}
+                yield f'id: {tag}\ndata: {json.dumps(delta)}\n\n'
+            else:
+                yield ': keepalive\n\n'
+            sent, sent_tag = stats, tag
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            # Changes committed by this process wake us immediately; the timeout
+            # picks up writes from other worker processes
+            version = affiliate_rollups.wait_for_change(user_id, version, min(heartbeat, remaining))
+
+    response = Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Runs when the server closes the response: finished, or the client went away
+    response.call_on_close(slots.release)
+    return response
 
 @app.route('/simulate_sale', methods=['POST'])
 @login_required
@@ -1820,7 +3210,7 @@ def simulate_affiliate_sale():
         )
 
         if success:
-            commission_earned = sale_amount * commission_rate
+            commission_earned = to_dollars(affiliate_commission_cents(sale_amount, commission_rate))
             flash(f'🎉 Guul! Someone bought through your link! You earned ${commission_earned:.2f}!')
             return {'success': True, 'commission': commission_earned}
         else:
@@ -1834,9 +3224,8 @@ def simulate_affiliate_sale():
 @login_required
 def advanced_affiliate():
     """Advanced affiliate dashboard with real earnings tracking"""
-    conn = None
     try:
-        conn = sqlite3.connect('dadaal.db')
+        conn = get_db()
         cursor = conn.cursor()
 
         # Get user's affiliate links and performance
@@ -1848,10 +3237,10 @@ def advanced_affiliate():
 
         # Calculate total affiliate earnings
         cursor.execute('''
-            SELECT SUM(amount) FROM transactions 
-            WHERE user_id = ? AND type = 'earning' AND description LIKE '%affiliate%'
+            SELECT SUM(amount_cents) FROM transactions 
+            WHERE user_id = ? AND source = 'affiliate'
         ''', (session['user_id'],))
-        total_affiliate_earnings = cursor.fetchone()[0] or 0
+        total_affiliate_earnings = to_dollars(cursor.fetchone()[0] or 0)
 
         # Get recent affiliate activity
         cursor.execute('''
@@ -1869,15 +3258,11 @@ def advanced_affiliate():
         flash('Khalad ayaa dhacay affiliate dashboard-ka.')
         print(f"Advanced affiliate error: {e}")
         return redirect(url_for('affiliate'))
-    finally:
-        if conn:
-            conn.close()
 
 @app.route('/create_affiliate_link', methods=['POST'])
 @login_required
 def create_affiliate_link():
     """Create new affiliate marketing link"""
-    conn = None
     try:
         product_name = sanitize_input(request.form.get('product_name'))
         commission_rate = float(request.form.get('commission_rate', 0.20))
@@ -1889,7 +3274,7 @@ def create_affiliate_link():
         # Generate unique link code
         link_code = f"AFF-{secrets.token_hex(8).upper()}"
 
-        conn = sqlite3.connect('dadaal.db')
+        conn = get_db()
         cursor = conn.cursor()
 
         cursor.execute('''
@@ -1905,9 +3290,6 @@ def create_affiliate_link():
         flash('Khalad ayaa dhacay affiliate link samayniisa.')
         print(f"Create affiliate link error: {e}")
         return redirect(url_for('advanced_affiliate'))
-    finally:
-        if conn:
-            conn.close()
 
 @app.route('/admin/toggle_user_status', methods=['POST'])
 @admin_required
@@ -1920,12 +3302,11 @@ def toggle_user_status():
         if new_status not in ['active', 'suspended']:
             return {'success': False, 'error': 'Invalid status'}
 
-        conn = sqlite3.connect('dadaal.db')
+        conn = get_db()
         cursor = conn.cursor()
 
         cursor.execute('UPDATE users SET status = ? WHERE id = ?', (new_status, user_id))
         conn.commit()
-        conn.close()
 
         return {'success': True, 'message': f'User status updated to {new_status}'}
 
@@ -1936,110 +3317,92 @@ def toggle_user_status():
 @app.route('/admin/delete_user', methods=['POST'])
 @admin_required
 def delete_user():
-    conn = None
     try:
         data = request.get_json()
-        user_id = data.get('user_id')
+        user_id = int(data.get('user_id'))
 
-        conn = sqlite3.connect('dadaal.db')
+        conn = get_db()
         cursor = conn.cursor()
 
-        # Delete user's transactions first (foreign key constraint)
-        cursor.execute('DELETE FROM transactions WHERE user_id = ?', (user_id,))
-        cursor.execute('DELETE FROM referrals WHERE referrer_id = ? OR referred_id = ?', (user_id, user_id))
-        cursor.execute('DELETE FROM affiliate_links WHERE user_id = ?', (user_id,))
+        with db.immediate(conn):
+            # Close the user's ledger account: what is left moves to the platform,
+            # so the append-only ledger keeps no balance for a deleted user. Their
+            # transactions stay, as the records the ledger's postings point at.
+            balance_cents = ledger.balance(conn, user_id)
+            if balance_cents:
+                ledger.post(cursor, user_id, -balance_cents, 'account_closure')
 
-        # Delete the user
-        cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
+            cursor.execute('DELETE FROM referrals WHERE referrer_id = ? OR referred_id = ?', (user_id, user_id))
+            cursor.execute('DELETE FROM affiliate_links WHERE user_id = ?', (user_id,))
+
+            # Delete the user
+            cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
 
-        conn.commit()
         return {'success': True, 'message': 'User deleted successfully'}
 
     except Exception as e:
+        db.rollback()
         print(f"Delete user error: {e}")
         return {'success': False, 'error': str(e)}
-    finally:
-        if conn:
-            conn.close()
 
 @app.route('/admin/users')
 @admin_required
 def admin_users():
-    conn = None
     try:
-        conn = sqlite3.connect('dadaal.db')
+        conn = get_report_db()
         cursor = conn.cursor()
 
-        # Get all users with detailed information
-        cursor.execute('''
-            SELECT u.id, u.name, u.email, u.phone, u.total_earnings, u.status, 
-                   u.premium_until, u.created_at, u.referral_code,
-                   COUNT(r.id) as referrals_count
-            FROM users u
-            LEFT JOIN referrals r ON u.id = r.referrer_id AND r.status = 'completed'
-            GROUP BY u.id
-            ORDER BY u.created_at DESC
-        ''')
-        users = cursor.fetchall()
+        filters = {
+            'status': sanitize_input(request.args.get('status', '')),
+            'premium': sanitize_input(request.args.get('premium', '')),
+            'email_prefix': sanitize_input(request.args.get('email', '')),
+            'sort': sanitize_input(request.args.get('sort', 'newest')),
+        }
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
 
-        return render_template('admin_users.html', users=users)
+        # One indexed range read per page
+        users, next_cursor = fetch_users_page(cursor, after=request.args.get('after'),
+                                              limit=limit, **filters)
+
+        return render_template('admin_users.html', users=users, filters=filters,
+                               next_cursor=next_cursor, limit=limit)
     except Exception as e:
         flash('Khalad ayaa dhacay helida users.')
         print(f"Admin users error: {e}")
         return redirect(url_for('admin_dashboard'))
-    finally:
-        if conn:
-            conn.close()
 
 @app.route('/admin/payments')
 @admin_required
 def admin_payments():
     """Admin payment analytics dashboard."""
-    conn = None
     try:
-        conn = sqlite3.connect('dadaal.db')
+        conn = get_report_db()
         cursor = conn.cursor()
 
         # Calculate total revenue
-        cursor.execute('SELECT SUM(amount) FROM transactions WHERE status = "completed"')
-        total_revenue = cursor.fetchone()[0] or 0
-
-        # Payment method statistics
-        cursor.execute('''
-            SELECT 
-                COUNT(*) as mobile_money_count,
-                COALESCE(SUM(amount), 0) as mobile_money_total
-            FROM transactions 
-            WHERE description LIKE '%mobile_money%' OR description LIKE '%Mobile Money%'
-        ''')
-        mobile_money_stats = cursor.fetchone()
+        cursor.execute("SELECT SUM(amount_total_cents) FROM daily_transaction_totals WHERE status = 'completed'")
+        total_revenue = to_dollars(cursor.fetchone()[0] or 0)
 
+        # Payment method statistics (one pass over idx_transactions_payment_method)
         cursor.execute('''
-            SELECT 
-                COUNT(*) as credit_card_count,
-                COALESCE(SUM(amount), 0) as credit_card_total
-            FROM transactions 
-            WHERE description LIKE '%credit_card%' OR description LIKE '%Credit Card%' OR description LIKE '%Stripe%'
-        ''')
-        credit_card_stats = cursor.fetchone()
-
-        cursor.execute('''
-            SELECT 
-                COUNT(*) as bank_transfer_count,
-                COALESCE(SUM(amount), 0) as bank_transfer_total
-            FROM transactions 
-            WHERE description LIKE '%bank_transfer%' OR description LIKE '%Bank Transfer%'
-        ''')
-        bank_transfer_stats = cursor.fetchone()
-
-        cursor.execute('''
-            SELECT 
-                COUNT(*) as premium_count,
-                COALESCE(SUM(amount), 0) as premium_total
-            FROM transactions 
-            WHERE type = 'premium'
+            SELECT payment_method, source, COUNT(*), COALESCE(SUM(amount_cents), 0)
+            FROM transactions
+            GROUP BY payment_method, source
         ''')
-        premium_stats = cursor.fetchone()
+        method_stats = {method: [0, 0] for method in PAYMENT_METHODS}
+        premium_stats = [0, 0]
+        for method, source, count, total in cursor.fetchall():
+            stats = method_stats.setdefault(method, [0, 0])
+            stats[0] += count
+            stats[1] += total
+            if source == 'premium':
+                premium_stats[0] += count
+                premium_stats[1] += total
+        for stats in list(method_stats.values()) + [premium_stats]:
+            stats[1] = to_dollars(stats[1])
+        mobile_money_stats = method_stats['mobile_money']
+        credit_card_stats = method_stats['credit_card']
+        bank_transfer_stats = method_stats['bank_transfer']
 
         # Recent payments
         cursor.execute('''
@@ -2068,34 +3431,31 @@ def admin_payments():
         print(f"Admin payments error: {e}")
         flash(f"Error loading payment analytics: {e}")
         return redirect(url_for('admin_dashboard'))
-    finally:
-        if conn:
-            conn.close()
 
 @app.route('/admin/analytics')
 @admin_required
 def admin_analytics():
     """Admin analytics dashboard."""
-    conn = None
     try:
-        conn = sqlite3.connect('dadaal.db')
+        conn = get_report_db()
         cursor = conn.cursor()
 
-        # Total users
-        cursor.execute('SELECT COUNT(*) FROM users')
-        total_users = cursor.fetchone()[0]
-
-        # Active users
-        cursor.execute('SELECT COUNT(*) FROM users WHERE status = "active"')
-        active_users = cursor.fetchone()[0]
-
-        # Total transactions
-        cursor.execute('SELECT COUNT(*) FROM transactions')
-        total_transactions = cursor.fetchone()[0]
+        # Total and active users
+        cursor.execute('''
+            SELECT COALESCE(SUM(user_count), 0),
+                   COALESCE(SUM(CASE WHEN status = 'active' THEN user_count END), 0)
+            FROM user_status_totals
+        ''')
+        total_users, active_users = cursor.fetchone()
 
-        # Total earnings
-        cursor.execute('SELECT SUM(amount) FROM transactions WHERE type = "earning"')
-        total_earnings = cursor.fetchone()[0] or 0
+        # Total transactions and earnings
+        cursor.execute('''
+            SELECT COALESCE(SUM(tx_count), 0),
+                   COALESCE(SUM(CASE WHEN type = 'earning' THEN amount_total_cents END), 0)
+            FROM daily_transaction_totals
+        ''')
+        total_transactions, total_earnings = cursor.fetchone()
+        total_earnings = to_dollars(total_earnings)
 
         # Recent user activity
         cursor.execute('''
@@ -2109,12 +3469,13 @@ def admin_analytics():
 
         # Payment statistics
         cursor.execute('''
-            SELECT type, COUNT(*), SUM(amount)
-            FROM transactions
+            SELECT type, SUM(tx_count), SUM(amount_total_cents)
+            FROM daily_transaction_totals
             WHERE type IN ('earning', 'withdrawal', 'referral', 'premium', 'bonus')
             GROUP BY type
+            HAVING SUM(tx_count) > 0
         ''')
-        payment_stats = cursor.fetchall()
+        payment_stats = [(type, count, to_dollars(total)) for type, count, total in cursor.fetchall()]
 
         return render_template('admin_analytics.html',
                                total_users=total_users,
@@ -2128,16 +3489,57 @@ def admin_analytics():
         print(f"Analytics error: {e}")
         flash(f"Error loading analytics: {e}")
         return redirect(url_for('admin_dashboard'))
-    finally:
-        if conn:
-            conn.close()
+
+@app.route('/admin/export/<dataset>.<fmt>')
+@admin_required
+def admin_export(dataset, fmt):
+    """Stream transactions, users or sales as CSV/JSONL, optionally gzipped"""
+    if dataset not in EXPORT_DATASETS or fmt not in EXPORT_FORMATS:
+        return {'success': False, 'error': 'Export-kan ma jiro'}, 404
+
+    filters = {
+        'start': sanitize_input(request.args.get('start', '')) or None,
+        'end': sanitize_input(request.args.get('end', '')) or None,
+        'type': sanitize_input(request.args.get('type', '')) or None,
+        'user_id': request.args.get('user_id', type=int),
+    }
+    compress = request.args.get('gzip') == '1'
+    filename = f"{dataset}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{fmt}" + ('.gz' if compress else '')
+    return Response(exporter.stream(dataset, fmt, compress, **filters),
+                    mimetype='application/gzip' if compress else EXPORT_FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@app.route('/admin/ingestion_stats')
+@admin_required
+def admin_ingestion_stats():
+    """Backpressure metrics for the buffered click/share/activity pipeline"""
+    return event_ingestor.stats()
+
+@app.route('/admin/catalog_stats')
+@admin_required
+def admin_catalog_stats():
+    """Hit/miss/timeout counters for the partner catalog cache"""
+    return catalog.stats()
+
+@app.route('/admin/ledger')
+@admin_required
+def admin_ledger():
+    """Platform-wide balances from the ledger checkpoints plus the unfolded tail"""
+    return ledger.report(get_report_db())
+
+@app.route('/admin/reconciliation')
+@admin_required
+def admin_reconciliation():
+    """Users whose stored balance disagrees with the ledger, largest drift first"""
+    return reconciler.report(get_report_db())
 
 @app.route('/earnings')
 def earnings():
+    counters = platform_counters.snapshot()
     return render_template('earnings.html', 
-                         total_earnings=total_earnings,
-                         affiliate_earnings=affiliate_earnings,
-                         referral_count=len(user_referrals))
+                         total_earnings=to_dollars(counters.get('total_earnings_cents', 0)),
+                         affiliate_earnings=to_dollars(counters.get('affiliate_earnings_cents', 0)),
+                         referral_count=counters.get('referral_count', 0))
 
 @app.route('/about')
 def about():
@@ -2169,7 +3571,6 @@ def wholesale():
 @app.route('/wholesale_signup', methods=['POST'])
 def wholesale_signup():
     """Handle wholesale partner signup"""
-    conn = None
     try:
         if request.content_type == 'application/json':
             data = request.get_json()
@@ -2204,8 +3605,7 @@ def wholesale_signup():
         else:
             commission_tier = 'bronze'
 
-        conn = sqlite3.connect('dadaal.db', timeout=20.0)
-        conn.execute('PRAGMA journal_mode=WAL;')  # Better concurrency
+        conn = get_db()
         cursor = conn.cursor()
 
         # Check if business email already exists
@@ -2259,26 +3659,24 @@ def wholesale_signup():
             flash(f'Guul! Application waa la gudbiyay. Partner ID: WS-{partner_id:04d}. Waan kala soo xiriiri doonaa 24 saacadood gudahood.')
             return redirect(url_for('wholesale_dashboard'))
 
+    except PasswordHasherBusy:
+        db.rollback()
+        raise
     except Exception as db_error:
-        if conn:
-            conn.rollback()
+        db.rollback()
         print(f"Database error in wholesale signup: {db_error}")
         if request.content_type == 'application/json':
             return {'success': False, 'error': f'Database error: {str(db_error)}'}
         else:
             flash('Khalad ayaa dhacay application submit-ka. Fadlan isku day mar kale.')
             return redirect(url_for('wholesale'))
-    finally:
-        if conn:
-            conn.close()
 
 @app.route('/wholesale/dashboard')
 @login_required
 def wholesale_dashboard():
     """Wholesale partner dashboard"""
-    conn = None
     try:
-        conn = sqlite3.connect('dadaal.db')
+        conn = get_db()
         cursor = conn.cursor()
 
         # Get partner info
@@ -2303,11 +3701,12 @@ def wholesale_dashboard():
 
         # Get sales stats
         cursor.execute('''
-            SELECT COUNT(*), SUM(total_amount), SUM(commission_amount)
+            SELECT COUNT(*), SUM(total_cents), SUM(commission_cents)
             FROM wholesale_sales 
             WHERE partner_id = ?
         ''', (partner_data[0],))
-        sales_stats = cursor.fetchone()
+        sale_count, total_cents, commission_cents = cursor.fetchone()
+        sales_stats = (sale_count, to_dollars(total_cents), to_dollars(commission_cents))
 
         # Get recent sales
         cursor.execute('''
@@ -2331,101 +3730,239 @@ def wholesale_dashboard():
         flash('Khalad ayaa dhacay dashboard-ka.')
         print(f"Wholesale dashboard error: {e}")
         return redirect(url_for('wholesale'))
-    finally:
-        if conn:
-            conn.close()
+
+WHOLESALE_SALE_INSERT = '''
+    INSERT INTO wholesale_sales (
+        order_id, product_id, partner_id, buyer_id, quantity, unit_price, total_amount,
+        commission_amount, commission_rate, unit_price_cents, total_cents, commission_cents, commission_bps
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+def _wholesale_sale_row(product, buyer_id, quantity):
+    """Sale line values after order_id, with the commission worked out in cents"""
+    product_id, partner_id, _, unit_price_cents, commission_bps, _ = product
+    total_cents = unit_price_cents * quantity
+    commission_cents = apply_rate(total_cents, commission_bps)
+    return [product_id, partner_id, buyer_id, quantity, to_dollars(unit_price_cents), to_dollars(total_cents),
+            to_dollars(commission_cents), to_rate(commission_bps), unit_price_cents, total_cents,
+            commission_cents, commission_bps]
+
+MAX_ORDER_LINES = 200
+
+def record_wholesale_sale(cursor, product, buyer_id, quantity):
+    """Write the sale, the partner's instant commission and its transaction.
+
+    `product` is a row of inventory.TAKEN_PRODUCT_COLUMNS, taken atomically
+    with the stock. Returns the commission amount.
+    """
+    _, _, product_name, _, _, partner_user_id = product
+    sale = _wholesale_sale_row(product, buyer_id, quantity)
+    cursor.execute(WHOLESALE_SALE_INSERT, [None] + sale)
+    commission_cents = sale[-2]
+
+    # Add instant commission to partner
+    transaction_id = record_transaction(cursor, partner_user_id, commission_cents, 'earning',
+                                        f'Wholesale sale commission - {product_name}', source='wholesale')
+    ledger.post(cursor, partner_user_id, commission_cents, 'wholesale', transaction_id)
+    return to_dollars(commission_cents)
+
+def record_wholesale_order(cursor, buyer_id, lines, products):
+    """Write a whole cart: one order row, then batched sale lines, earnings and transactions.
+
+    Commission is summed per partner first, so each partner gets one
+    transaction and one ledger posting however many lines they supplied.
+    Returns (order_id, total_amount, commission_amount).
+    """
+    sales, partner_commissions = [], {}
+    for product_id, quantity in lines.items():
+        partner_user_id = products[product_id][5]
+        sale = _wholesale_sale_row(products[product_id], buyer_id, quantity)
+        sales.append(sale)
+        partner_commissions[partner_user_id] = partner_commissions.get(partner_user_id, 0) + sale[-2]
+
+    order_total = sum(sale[-3] for sale in sales)
+    order_commission = sum(partner_commissions.values())
+    cursor.execute('''
+        INSERT INTO wholesale_orders (buyer_id, item_count, total_amount, commission_amount,
+                                      total_cents, commission_cents)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (buyer_id, len(sales), to_dollars(order_total), to_dollars(order_commission),
+          order_total, order_commission))
+    order_id = cursor.lastrowid
+
+    cursor.executemany(WHOLESALE_SALE_INSERT, [[order_id] + sale for sale in sales])
+    cursor.executemany(TRANSACTION_INSERT, [
+        (partner_user_id, to_dollars(cents), cents, 'earning', 'completed',
+         f'Wholesale order #{order_id} commission', f'WO-{order_id}-{partner_user_id}', None, 'wholesale')
+        for partner_user_id, cents in partner_commissions.items()
+    ])
+    references = [f'WO-{order_id}-{partner_user_id}' for partner_user_id in partner_commissions]
+    transaction_ids = dict(cursor.execute('''
+        SELECT user_id, id FROM transactions WHERE reference_id IN (SELECT value FROM json_each(?))
+    ''', (json.dumps(references),)).fetchall())
+    ledger.post_many(cursor, [(partner_user_id, cents, 'wholesale', transaction_ids.get(partner_user_id))
+                              for partner_user_id, cents in partner_commissions.items()])
+    return order_id, to_dollars(order_total), to_dollars(order_commission)
 
 @app.route('/wholesale/buy_product', methods=['POST'])
 @login_required
 def wholesale_buy_product():
     """Process product purchase and instant commission"""
-    conn = None
     try:
         product_id = int(request.form.get('product_id'))
         quantity = int(request.form.get('quantity', 1))
 
-        conn = sqlite3.connect('dadaal.db', timeout=20.0)
+        conn = get_db()
         cursor = conn.cursor()
 
-        # Get product details
-        cursor.execute('''
-            SELECT wp.*, wpart.user_id as partner_user_id, wpart.commission_tier
-            FROM wholesale_products wp
-            JOIN wholesale_partners wpart ON wp.partner_id = wpart.id
-            WHERE wp.id = ? AND wp.status = 'active'
-        ''', (product_id,))
-        product = cursor.fetchone()
+        # Conditional decrement under the write lock: no oversell, no read-then-write
+        with db.immediate(conn):
+            product = inventory.take_stock(conn, product_id, quantity)
+            if product:
+                commission_amount = record_wholesale_sale(cursor, product, session['user_id'], quantity)
 
         if not product:
-            flash('Product-kan ma jiro ama ma shaqeeyo.')
+            flash('Product-kan ma jiro, ma shaqeeyo ama stock kuma filna.')
             return redirect(url_for('marketplace'))
 
-        # Calculate amounts
-        unit_price = product[3]  # price column
-        total_amount = unit_price * quantity
-        commission_rate = product[7]  # commission_rate column
-        commission_amount = total_amount * commission_rate
-
-        # Insert sale record
-        cursor.execute('''
-            INSERT INTO wholesale_sales (
-                product_id, partner_id, buyer_id, quantity, unit_price, 
-                total_amount, commission_amount, commission_rate
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (product_id, product[0], session['user_id'], quantity, unit_price,
-              total_amount, commission_amount, commission_rate))
-
-        # Add instant commission to partner
-        cursor.execute('''
-            UPDATE users SET total_earnings = total_earnings + ?
-            WHERE id = ?
-        ''', (commission_amount, product[-2]))  # partner_user_id
-
-        # Add transaction record for partner
-        cursor.execute('''
-            INSERT INTO transactions (user_id, amount, type, description, status)
-            VALUES (?, ?, 'earning', ?, 'completed')
-        ''', (product[-2], commission_amount, f'Wholesale sale commission - {product[1]}'))
-
-        # Update product stock
-        cursor.execute('''
-            UPDATE wholesale_products SET stock_quantity = stock_quantity - ?
-            WHERE id = ?
-        ''', (quantity, product_id))
-
-        conn.commit()
-        
         flash(f'Guul! Product waa la iibsaday. Partner-ka wuxuu helay ${commission_amount:.2f} commission!')
         return redirect(url_for('marketplace'))
 
     except Exception as e:
+        db.rollback()
         flash('Khalad ayaa dhacay product iibashada.')
         print(f"Wholesale buy error: {e}")
         return redirect(url_for('marketplace'))
-    finally:
-        if conn:
-            conn.close()
+
+@app.route('/wholesale/orders', methods=['POST'])
+@login_required
+def wholesale_create_order():
+    """Buy a whole cart of (product_id, quantity) lines in one transaction"""
+    try:
+        data = request.get_json() or {}
+        lines = {}
+        for item in data.get('items', []):
+            product_id = int(item['product_id'])
+            quantity = int(item.get('quantity', 1))
+            if quantity <= 0:
+                return {'success': False, 'error': 'Quantity-ga waa inuu ka badnaadaa 0'}
+            lines[product_id] = lines.get(product_id, 0) + quantity
+
+        if not lines or len(lines) > MAX_ORDER_LINES:
+            return {'success': False, 'error': f'Dalabku waa inuu lahaadaa 1 ilaa {MAX_ORDER_LINES} products'}
+
+        conn = get_db()
+        cursor = conn.cursor()
+        with db.immediate(conn):
+            products, errors = inventory.take_cart(conn, lines)
+            if not errors:
+                order_id, total_amount, commission_amount = record_wholesale_order(
+                    cursor, session['user_id'], lines, products)
+
+        if errors:
+            return {'success': False, 'error': 'Qaar ka mid ah products-ka lama heli karo',
+                    'lines': {str(product_id): error for product_id, error in errors.items()}}
+        return {'success': True, 'order_id': order_id,
+                'total_amount': total_amount, 'commission_amount': commission_amount}
+
+    except (KeyError, TypeError, ValueError):
+        return {'success': False, 'error': 'Dalab aan sax ahayn'}
+    except Exception as e:
+        db.rollback()
+        print(f"Wholesale order error: {e}")
+        return {'success': False, 'error': str(e)}
+
+@app.route('/wholesale/reserve', methods=['POST'])
+@login_required
+def wholesale_reserve():
+    """Hold stock while the buyer completes checkout"""
+    try:
+        data = request.get_json()
+        product_id = int(data.get('product_id'))
+        quantity = int(data.get('quantity', 1))
+
+        conn = get_db()
+        with db.immediate(conn):
+            reserved = inventory.reserve(conn, product_id, session['user_id'], quantity)
+
+        if not reserved:
+            return {'success': False, 'error': 'Stock kuma filna'}
+        reservation_id, product = reserved
+        return {'success': True, 'reservation_id': reservation_id,
+                'expires_in': inventory.hold_seconds, 'unit_price': to_dollars(product[3])}
+
+    except Exception as e:
+        db.rollback()
+        print(f"Wholesale reserve error: {e}")
+        return {'success': False, 'error': str(e)}
+
+@app.route('/wholesale/reservations/<int:reservation_id>/checkout', methods=['POST'])
+@login_required
+def wholesale_checkout(reservation_id):
+    """Complete the purchase for a held reservation"""
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        with db.immediate(conn):
+            confirmed = inventory.confirm(conn, reservation_id, session['user_id'])
+            if confirmed:
+                quantity, product = confirmed
+                commission_amount = record_wholesale_sale(cursor, product, session['user_id'], quantity)
+
+        if not confirmed:
+            return {'success': False, 'error': 'Reservation-ka wuu dhacay ama ma jiro'}
+        return {'success': True, 'commission': commission_amount}
+
+    except Exception as e:
+        db.rollback()
+        print(f"Wholesale checkout error: {e}")
+        return {'success': False, 'error': str(e)}
+
+@app.route('/wholesale/reservations/<int:reservation_id>/cancel', methods=['POST'])
+@login_required
+def wholesale_cancel_reservation(reservation_id):
+    """Release a held reservation back into stock"""
+    try:
+        conn = get_db()
+        with db.immediate(conn):
+            released = inventory.release(conn, reservation_id, session['user_id'])
+        return {'success': released}
+
+    except Exception as e:
+        db.rollback()
+        print(f"Wholesale cancel reservation error: {e}")
+        return {'success': False, 'error': str(e)}
 
 @app.route('/wholesale/add_product', methods=['POST'])
 @login_required
 def add_wholesale_product():
     """Add product to wholesale catalog"""
-    conn = None
     try:
         # Get form data
         product_name = sanitize_input(request.form.get('product_name'))
         description = sanitize_input(request.form.get('description'))
-        price = float(request.form.get('price'))
-        wholesale_price = float(request.form.get('wholesale_price', price * 0.7))
+        price_cents = parse_cents(request.form.get('price'))
+        wholesale_price = request.form.get('wholesale_price')
         category = sanitize_input(request.form.get('category'))
         sku = sanitize_input(request.form.get('sku'))
-        stock_quantity = int(request.form.get('stock_quantity', 0))
+        stock_quantity = request.form.get('stock_quantity') or 0
+        try:
+            stock_quantity = int(stock_quantity)
+        except ValueError:
+            stock_quantity = None
 
-        if not all([product_name, price > 0, category]):
+        # Same rules as the bulk importer: positive price, nothing negative
+        if price_cents is not None and price_cents > 0:
+            wholesale_price_cents = parse_cents(wholesale_price) if wholesale_price else apply_rate(price_cents, 7000)
+        else:
+            price_cents = wholesale_price_cents = None
+
+        if (not all([product_name, price_cents, category]) or wholesale_price_cents is None
+                or wholesale_price_cents < 0 or stock_quantity is None or stock_quantity < 0):
             flash('Fadlan buuxi dhammaan macluumaadka product-ka.')
             return redirect(url_for('wholesale_dashboard'))
 
-        conn = sqlite3.connect('dadaal.db')
+        conn = get_db()
         cursor = conn.cursor()
 
         # Get partner ID
@@ -2444,10 +3981,10 @@ def add_wholesale_product():
         cursor.execute('''
             INSERT INTO wholesale_products (
                 partner_id, product_name, description, price, wholesale_price,
-                category, sku, stock_quantity
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (partner[0], product_name, description, price, wholesale_price,
-              category, sku, stock_quantity))
+                category, sku, stock_quantity, price_cents, wholesale_price_cents
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (partner[0], product_name, description, to_dollars(price_cents), to_dollars(wholesale_price_cents),
+              category, sku, stock_quantity, price_cents, wholesale_price_cents))
 
         conn.commit()
         flash(f'Product "{product_name}" waa la ku daray catalog-ga!')
@@ -2457,12 +3994,73 @@ def add_wholesale_product():
         flash('Khalad ayaa dhacay product-ka ku darista.')
         print(f"Add wholesale product error: {e}")
         return redirect(url_for('wholesale_dashboard'))
-    finally:
-        if conn:
-            conn.close()
+
+@app.route('/wholesale/import', methods=['POST'])
+@login_required
+def wholesale_import_products():
+    """Queue a CSV or JSONL catalog upload for background import"""
+    try:
+        upload = request.files.get('file')
+        if not upload or not product_importer.format_for(upload.filename):
+            return {'success': False, 'error': 'Fadlan soo geli file CSV ama JSONL ah'}, 400
+
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT id FROM wholesale_partners WHERE user_id = ?', (session['user_id'],))
+        partner = cursor.fetchone()
+        if not partner:
+            return {'success': False, 'error': 'Ma lihid wholesale partner account.'}, 403
+
+        import_id = product_importer.submit(conn, partner[0], upload)
+        conn.commit()
+        if not app.config.get('TESTING'):
+            product_importer.start()
+        return {'success': True, 'import_id': import_id,
+                'progress_url': url_for('wholesale_import_progress', import_id=import_id)}, 202
+
+    except Exception as e:
+        db.rollback()
+        print(f"Wholesale import error: {e}")
+        return {'success': False, 'error': str(e)}, 500
+
+def _current_partner_id(cursor):
+    """Wholesale partner id of the logged-in user, or None"""
+    cursor.execute('SELECT id FROM wholesale_partners WHERE user_id = ?', (session['user_id'],))
+    partner = cursor.fetchone()
+    return partner[0] if partner else None
+
+@app.route('/wholesale/import/<int:import_id>')
+@login_required
+def wholesale_import_progress(import_id):
+    """Progress and counters of one bulk import"""
+    conn = get_db()
+    progress = product_importer.progress(conn, import_id, _current_partner_id(conn.cursor()))
+    if progress is None:
+        return {'success': False, 'error': 'Import-ka lama helin'}, 404
+    progress['errors_url'] = url_for('wholesale_import_errors', import_id=import_id)
+    return progress
+
+@app.route('/wholesale/import/<int:import_id>/errors.csv')
+@login_required
+def wholesale_import_errors(import_id):
+    """Per-row error report of one bulk import as CSV"""
+    conn = get_db()
+    if product_importer.progress(conn, import_id, _current_partner_id(conn.cursor())) is None:
+        return {'success': False, 'error': 'Import-ka lama helin'}, 404
+    rows = conn.execute('''
+        SELECT row_number, sku, error FROM product_import_errors
+        WHERE import_id = ? ORDER BY row_number
+    ''', (import_id,)).fetchall()
+
+    report = io.StringIO()
+    writer = csv.writer(report)
+    writer.writerow(('row', 'sku', 'error'))
+    writer.writerows(rows)
+    return Response(report.getvalue(), mimetype='text/csv', headers={
+        'Content-Disposition': f'attachment; filename=import-{import_id}-errors.csv'})
 
 def send_wholesale_notification(company_name, contact_person, business_email):
-    """Send notification to admin about new wholesale application"""
+    """Queue notification to admin about new wholesale application"""
     try:
         admin_email = os.environ.get('ADMIN_EMAIL', 'admin@dadaal.com')
 
@@ -2478,17 +4076,13 @@ def send_wholesale_notification(company_name, contact_person, business_email):
         """
 
         # Use existing email system
-        msg = MIMEMultipart()
-        msg['From'] = os.environ.get('GMAIL_USER', 'noreply@dadaal.com')
-        msg['To'] = admin_email
-        msg['Subject'] = subject
-        msg.attach(MIMEText(body, 'plain'))
+        email_outbox.enqueue(get_db(), admin_email, subject, body)
 
-        print(f"Wholesale notification: {subject}")
+        print(f"Wholesale notification queued: {subject}")
         return True
 
     except Exception as e:
-        print(f"Failed to send wholesale notification: {e}")
+        print(f"Failed to queue wholesale notification: {e}")
         return False
 
 @app.route('/contact', methods=['GET', 'POST'])
@@ -2500,9 +4094,8 @@ def contact():
         message = request.form.get('message')
 
         # Save to database
-        conn = None
         try:
-            conn = sqlite3.connect('dadaal.db')
+            conn = get_db()
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO contact_messages (name, email, subject, message)
@@ -2515,9 +4108,6 @@ def contact():
             flash('Khalad ayaa dhacay fariinta dirista.')
             print(f"Contact form error: {e}")
             return redirect(url_for('contact'))
-        finally:
-            if conn:
-                conn.close()
 
     return render_template('contact.html')
 
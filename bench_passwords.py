@@ -0,0 +1,42 @@
+"""Login throughput benchmark for the password hashing pool.
+
+Usage: python bench_passwords.py [--seconds 5] [--workers N] [--iterations N]
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from passwords import PasswordHasher, DEFAULT_ITERATIONS
+
+def run_benchmark(workers, iterations, seconds):
+    hasher = PasswordHasher(workers=workers, max_pending=max(workers, 1) * 4, iterations=iterations)
+    stored = hasher.hash('benchmark-password')
+    clients = max(workers, 1) * 2  # keep the pool saturated
+    deadline = time.monotonic() + seconds
+
+    def client():
+        logins = 0
+        while time.monotonic() < deadline:
+            if hasher.verify(stored, 'benchmark-password'):
+                logins += 1
+        return logins
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        total = sum(executor.map(lambda _: client(), range(clients)))
+    elapsed = time.monotonic() - started
+    hasher.shutdown()
+    return total / elapsed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS)
+    args = parser.parse_args()
+
+    print(f"🔐 PBKDF2-SHA256, {args.iterations} iterations, {args.workers} hashing workers")
+    for workers in sorted({1, args.workers}):
+        rate = run_benchmark(workers, args.iterations, args.seconds)
+        print(f"  {workers} worker(s): {rate:.1f} logins/sec, {rate / workers:.1f} logins/sec per core")
@@ -0,0 +1,327 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import requests
+
+from database import db
+
+class CatalogAggregator:
+    """Concurrent, cached product fetches across affiliate providers.
+
+    Each provider is a callable returning a list of products (raising on
+    failure) plus a deadline in seconds. get_many() starts every provider at
+    once and waits for each only up to its own deadline, so a page costs the
+    slowest deadline rather than the sum of the round-trips. Results live in
+    an LRU cache bounded by `max_entries`; entries are fresh for `ttl`
+    seconds and may then be served stale for up to `stale_ttl` more while
+    one background refresh runs. Concurrent misses for the same key share a
+    single in-flight fetch.
+    """
+
+    def __init__(self, ttl=300, stale_ttl=3600, max_entries=256, workers=8):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.providers = {}
+        self._cache = OrderedDict()   # key -> (products, fetched_at)
+        self._inflight = {}           # key -> Future
+        # Reentrant: a fetch that finishes instantly runs _store() inside _start_fetch()
+        self._lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='catalog')
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def register(self, name, fetch, deadline=2.0):
+        """Add a provider; fetch(**params) must return a list of products"""
+        self.providers[name] = (fetch, deadline)
+
+    @staticmethod
+    def _key(name, params):
+        return (name, tuple(sorted(params.items())))
+
+    def _start_fetch(self, key):
+        """Return the in-flight fetch for key, starting one if needed (lock held)"""
+        future = self._inflight.get(key)
+        if future is None:
+            name, params = key
+            fetch = self.providers[name][0]
+            future = self._executor.submit(fetch, **dict(params))
+            self._inflight[key] = future
+            future.add_done_callback(lambda f, key=key: self._store(key, f))
+        return future
+
+    def _store(self, key, future):
+        with self._lock:
+            self._inflight.pop(key, None)
+            if future.cancelled() or future.exception() is not None:
+                self.errors += 1
+                print(f"Catalog provider {key[0]} error: {future.exception()}")
+                return
+            self._cache[key] = (future.result(), time.monotonic())
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def _lookup(self, key):
+        """Return (products, None) from cache or (stale_or_None, future) to wait on"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                products, fetched_at = entry
+                age = now - fetched_at
+                if age <= self.ttl:
+                    self._cache.move_to_end(key)
+                    self.hits += 1
+                    return products, None
+                if age <= self.ttl + self.stale_ttl:
+                    # Stale-while-revalidate: answer now, refresh once in the background
+                    self._cache.move_to_end(key)
+                    self.stale_hits += 1
+                    self._start_fetch(key)
+                    return products, None
+                del self._cache[key]
+            self.misses += 1
+            return None, self._start_fetch(key)
+
+    def get_many(self, requests_by_name):
+        """Fetch several providers concurrently: {name: params} -> {name: products}"""
+        started = time.monotonic()
+        results, pending = {}, {}
+        for name, params in requests_by_name.items():
+            products, future = self._lookup(self._key(name, params))
+            if future is None:
+                results[name] = products
+            else:
+                pending[name] = future
+
+        for name, future in pending.items():
+            deadline = self.providers[name][1]
+            done, _ = wait([future], timeout=max(deadline - (time.monotonic() - started), 0))
+            if done and future.exception() is None:
+                results[name] = future.result()
+            else:
+                if not done:
+                    with self._lock:
+                        self.timeouts += 1
+                # The fetch keeps running and fills the cache for the next view
+                results[name] = []
+        return results
+
+    def get(self, name, **params):
+        return self.get_many({name: params})[name]
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._cache),
+                'max_entries': self.max_entries,
+                'inflight': len(self._inflight),
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'timeouts': self.timeouts,
+                'errors': self.errors,
+            }
+
+class CatalogSync:
+    """Background job mirroring provider catalogs into catalog_products.
+
+    Each run pulls every provider's full feed and compares a content hash per
+    product with the stored one, so only new or changed products are written
+    (the FTS index follows through triggers) and products that left the feed
+    are marked inactive. Unchanged products cost no writes at all. A feed
+    that comes back empty, or that would retire more than `max_shrink` of a
+    platform's active products in one run, is treated as a provider hiccup:
+    its products are still upserted, but nothing is deactivated.
+    """
+
+    columns = ('name', 'brand', 'category', 'price', 'commission_rate',
+               'image_url', 'affiliate_url', 'rating', 'reviews')
+
+    def __init__(self, database, aggregator, interval=3600, chunk_size=500, max_shrink=0.5):
+        self.database = database
+        self.aggregator = aggregator
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.max_shrink = max_shrink
+        self._stopping = threading.Event()
+        self._thread = None
+        self.last_result = None
+
+    @staticmethod
+    def content_hash(product):
+        return hashlib.sha256(json.dumps(product, sort_keys=True).encode()).hexdigest()
+
+    def _row(self, platform, product):
+        # price and commission_rate are keyset sort keys: a NULL would end every page walk
+        return (
+            platform, str(product['id']), product.get('name', ''),
+            product.get('brand') or product.get('supplier'),
+            product.get('category'), product.get('price') or 0, product.get('commission_rate') or 0,
+            product.get('image_url'), product.get('affiliate_url'),
+            product.get('rating'), product.get('reviews'),
+            json.dumps(product), self.content_hash(product),
+        )
+
+    def sync_platform(self, conn, platform, products):
+        """Upsert one provider's feed; returns (inserted, updated, unchanged, deactivated)"""
+        existing = dict(conn.execute('''
+            SELECT external_id, CASE WHEN active = 1 THEN content_hash END
+            FROM catalog_products WHERE platform = ?
+        ''', (platform,)).fetchall())
+
+        changed, seen, inserted = [], set(), 0
+        for product in products:
+            row = self._row(platform, product)
+            external_id = row[1]
+            if external_id in seen:
+                continue
+            seen.add(external_id)
+            if external_id not in existing:
+                inserted += 1
+            elif existing[external_id] == row[-1]:
+                continue
+            changed.append(row)
+
+        for start in range(0, len(changed), self.chunk_size):
+            conn.executemany('''
+                INSERT INTO catalog_products
+                    (platform, external_id, name, brand, category, price, commission_rate,
+                     image_url, affiliate_url, rating, reviews, data, content_hash)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(platform, external_id) DO UPDATE SET
+                    name = excluded.name, brand = excluded.brand, category = excluded.category,
+                    price = excluded.price, commission_rate = excluded.commission_rate,
+                    image_url = excluded.image_url, affiliate_url = excluded.affiliate_url,
+                    rating = excluded.rating, reviews = excluded.reviews, data = excluded.data,
+                    content_hash = excluded.content_hash, active = 1,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', changed[start:start + self.chunk_size])
+
+        active = sum(1 for content_hash in existing.values() if content_hash is not None)
+        removed = [(platform, external_id) for external_id, content_hash in existing.items()
+                   if external_id not in seen and content_hash is not None]
+        if removed and (not seen or len(removed) > self.max_shrink * active):
+            print(f"Catalog sync for {platform}: feed has {len(seen)} products, would retire "
+                  f"{len(removed)} of {active}; skipping deactivation")
+            removed = []
+        conn.executemany('''
+            UPDATE catalog_products SET active = 0, updated_at = CURRENT_TIMESTAMP
+            WHERE platform = ? AND external_id = ?
+        ''', removed)
+
+        return inserted, len(changed) - inserted, len(seen) - len(changed), len(removed)
+
+    def run_once(self):
+        """Sync every registered provider; returns per-platform counts"""
+        result = {}
+        for platform, (fetch, deadline) in self.aggregator.providers.items():
+            try:
+                products = fetch()
+            except Exception as e:
+                print(f"Catalog sync error for {platform}: {e}")
+                continue
+            with self.database.session() as conn:
+                result[platform] = dict(zip(('inserted', 'updated', 'unchanged', 'deactivated'),
+                                            self.sync_platform(conn, platform, products)))
+        self.last_result = result
+        return result
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='catalog-sync', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Catalog sync worker error: {e}")
+            self._stopping.wait(self.interval)
+
+def fts_query(text):
+    """Turn free text into an FTS5 query: every word must match as a prefix"""
+    words = [word for word in text.replace('"', ' ').split() if word]
+    return ' '.join(f'"{word}"*' for word in words)
+
+def fetch_json_products(url, params, timeout):
+    """GET a provider endpoint that answers {"products": [...]}"""
+    response = requests.get(url, params=params, timeout=timeout)
+    response.raise_for_status()
+    return response.json()['products']
+
+class FakeProviderServer:
+    """Local HTTP stand-in for partner catalog APIs.
+
+    Serves GET /<provider>?limit=N from `catalogs`, after an optional
+    per-provider delay, and counts requests per provider. Used by tests and
+    local development in place of the real partner endpoints.
+    """
+
+    def __init__(self, catalogs=None, delays=None, host='127.0.0.1', port=0):
+        self.catalogs = catalogs or {}
+        self.delays = delays or {}
+        self.requests = {}
+        outer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                provider = url.path.strip('/')
+                outer.requests[provider] = outer.requests.get(provider, 0) + 1
+                if provider not in outer.catalogs:
+                    self.send_error(404)
+                    return
+                time.sleep(outer.delays.get(provider, 0))
+                limit = int(parse_qs(url.query).get('limit', ['0'])[0]) or None
+                body = json.dumps({'products': outer.catalogs[provider][:limit]}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.host, self.port = self.server.server_address
+        self.url = f'http://{self.host}:{self.port}'
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+# Global catalog aggregator and mirror sync instances
+catalog = CatalogAggregator()
+catalog_sync = CatalogSync(db, catalog)
@@ -0,0 +1,74 @@
+import threading
+import time
+
+from database import db
+
+class PlatformCounters:
+    """Database-backed platform totals shared by every worker process.
+
+    Reads are served from a short-TTL in-process snapshot so hot pages such
+    as the home page cost no queries while the snapshot is fresh. Writes are
+    atomic UPSERT increments run on the caller's connection, so they commit
+    (or roll back) together with the rest of the request. The snapshot is
+    only dropped once that connection commits (after_commit), so it never
+    holds a value that might still be rolled back.
+    """
+
+    def __init__(self, database, ttl=5.0):
+        self.database = database
+        self.ttl = ttl
+        self._values = {}
+        self._loaded_at = 0.0
+        self._pending = set()   # ids of connections with uncommitted increments
+        self._generation = 0    # bumped by every invalidation
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        generation = self._generation
+        with self.database.session() as conn:
+            rows = conn.execute('SELECT name, value FROM platform_counters').fetchall()
+        with self._lock:
+            self._values = dict(rows)
+            # A read that raced an invalidation may predate the commit: serve it, but reload next time
+            if generation == self._generation:
+                self._loaded_at = time.monotonic()
+
+    def snapshot(self):
+        """Return all counters, reloading them if the cached copy is stale"""
+        if time.monotonic() - self._loaded_at > self.ttl:
+            self._refresh()
+        with self._lock:
+            return dict(self._values)
+
+    def get(self, name, default=0):
+        return self.snapshot().get(name, default)
+
+    def increment(self, conn, name, delta):
+        """Atomically add delta to a counter and return its new value as conn sees it"""
+        new_value = conn.execute('''
+            INSERT INTO platform_counters (name, value) VALUES (?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                value = value + excluded.value,
+                updated_at = CURRENT_TIMESTAMP
+            RETURNING value
+        ''', (name, delta)).fetchone()[0]
+        with self._lock:
+            self._pending.add(id(conn))
+        return new_value
+
+    def after_commit(self, conn):
+        """Database hook: reload on the next read once conn's increments are committed"""
+        with self._lock:
+            if id(conn) in self._pending:
+                self._pending.discard(id(conn))
+                self._generation += 1
+                self._loaded_at = 0.0
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._loaded_at = 0.0
+
+# Global platform counters instance
+platform_counters = PlatformCounters(db)
+db.after_commit.append(platform_counters.after_commit)
@@ -0,0 +1,350 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+
+DEFAULT_DATABASE = 'dadaal.db'
+
+# Applied once to every new connection before it enters the pool
+CONNECTION_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-16000',      # 16 MB page cache per connection
+    'PRAGMA mmap_size=134217728',    # 128 MB memory-mapped I/O
+    'PRAGMA temp_store=MEMORY',
+)
+
+# Read-only reporting connections cannot change the journal mode, and
+# query_only makes any accidental write fail instead of taking the lock
+READONLY_PRAGMAS = (
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA cache_size=-32000',      # 32 MB: reports scan more pages
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA query_only=1',
+)
+
+class Database:
+    """Pooled SQLite connections shared by requests and worker threads.
+
+    Besides the read-write pool there is a read-only pool for admin reports
+    (`file:...?mode=ro`). Under WAL those readers never block or wait on the
+    payment and login writers. With REPORTS_SNAPSHOT set, reports read a copy
+    instead, refreshed with the backup API by refresh_snapshot(), so even
+    their page-cache and I/O load stays off the live file.
+    """
+
+    # Names of the request-scoped connections on flask.g
+    g_name = 'db'
+
+    def __init__(self, app=None, pool_size=8, timeout=20.0, cached_statements=512):
+        self.app = None
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._snapshot_generation = 0
+        self._stopping = threading.Event()
+        self._attached = {}
+        # Callables run as hook(conn) once a request's, session's or
+        # immediate block's transaction has committed
+        self.after_commit = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('DATABASE', DEFAULT_DATABASE)
+        app.config.setdefault('REPORTS_SNAPSHOT', None)
+        app.teardown_appcontext(self.teardown)
+
+    @property
+    def path(self):
+        if self.app is not None:
+            return self.app.config.get('DATABASE', DEFAULT_DATABASE)
+        return DEFAULT_DATABASE
+
+    @property
+    def snapshot_path(self):
+        return self.app.config.get('REPORTS_SNAPSHOT') if self.app is not None else None
+
+    def connect(self, path=None):
+        """Open a new tuned connection (not pooled)"""
+        conn = sqlite3.connect(path or self.path,
+                               timeout=self.timeout,
+                               check_same_thread=False,
+                               cached_statements=self.cached_statements)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def connect_readonly(self, path=None):
+        """Open a new read-only connection (not pooled)"""
+        conn = sqlite3.connect(f'file:{os.path.abspath(path or self.path)}?mode=ro', uri=True,
+                               timeout=self.timeout,
+                               check_same_thread=False,
+                               cached_statements=self.cached_statements)
+        for pragma in READONLY_PRAGMAS:
+            conn.execute(pragma)
+        self._attach(conn, readonly=True)
+        return conn
+
+    def attach(self, schema, database):
+        """Attach another database's file to read-only connections as `schema`.
+
+        Read-write connections never attach: BEGIN IMMEDIATE would take the
+        write lock of every attached file, coupling the two again.
+        """
+        self._attached[schema] = database
+
+    def _attach(self, conn, readonly):
+        for schema, database in self._attached.items():
+            path = os.path.abspath(database.path)
+            if readonly:
+                conn.execute('ATTACH DATABASE ? AS ' + schema, (f'file:{path}?mode=ro',))
+            else:
+                conn.execute('ATTACH DATABASE ? AS ' + schema, (path,))
+
+    def _pool(self, key):
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = queue.LifoQueue(maxsize=self.pool_size)
+            return pool
+
+    def acquire(self):
+        """Take a connection from the pool, opening one if the pool is empty"""
+        path = self.path
+        try:
+            conn = self._pool(path).get_nowait()
+        except queue.Empty:
+            conn = self.connect(path)
+        return conn, path
+
+    def acquire_readonly(self):
+        """Take a read-only reporting connection (snapshot copy when configured)"""
+        snapshot = self.snapshot_path
+        if snapshot and os.path.exists(snapshot):
+            key = ('ro', snapshot, self._snapshot_generation)
+        else:
+            key = ('ro', self.path, None)
+        try:
+            conn = self._pool(key).get_nowait()
+        except queue.Empty:
+            try:
+                conn = self.connect_readonly(key[1])
+            except sqlite3.OperationalError:
+                # WAL file not created yet: fall back to a query-only connection.
+                # It is closed on release, so the next reader retries mode=ro.
+                conn = self.connect(key[1])
+                conn.execute('PRAGMA query_only=1')
+                self._attach(conn, readonly=False)
+                return conn, None
+        return conn, key
+
+    def release(self, conn, path):
+        """Return a connection to its pool, closing it if the pool is full"""
+        try:
+            if path is None:
+                raise queue.Full   # Read-write fallback for a reader, never pooled
+            if conn.in_transaction:
+                conn.rollback()
+            if isinstance(path, tuple) and path[2] not in (None, self._snapshot_generation):
+                raise queue.Full   # Reading a replaced snapshot
+            self._pool(path).put_nowait(conn)
+        except (queue.Full, sqlite3.Error):
+            conn.close()
+
+    def connection(self):
+        """Return the connection bound to the current request"""
+        conn = g.get(self.g_name)
+        if conn is None:
+            conn, path = self.acquire()
+            setattr(g, self.g_name, conn)
+            setattr(g, f'{self.g_name}_path', path)
+        return conn
+
+    def reader(self):
+        """Return the read-only reporting connection bound to the current request"""
+        conn = g.get(f'{self.g_name}_ro')
+        if conn is None:
+            conn, key = self.acquire_readonly()
+            setattr(g, f'{self.g_name}_ro', conn)
+            setattr(g, f'{self.g_name}_ro_key', key)
+        return conn
+
+    def refresh_snapshot(self):
+        """Copy the live database to REPORTS_SNAPSHOT with the backup API.
+
+        The copy is written next to the snapshot and renamed over it, so
+        readers always see a complete file; connections still open on the
+        previous copy are closed as they come back to the pool.
+        """
+        snapshot = self.snapshot_path
+        if not snapshot:
+            return False
+        staging = f'{snapshot}.tmp'
+        source = self.connect()
+        try:
+            target = sqlite3.connect(staging)
+            try:
+                # One step reads a single WAL snapshot, so writers are never blocked
+                source.backup(target)
+                # The copied header says WAL; read-only opens need a rollback journal
+                target.execute('PRAGMA journal_mode=DELETE')
+            finally:
+                target.close()
+        finally:
+            source.close()
+        os.replace(staging, snapshot)
+        with self._lock:
+            stale = [key for key in self._pools if isinstance(key, tuple) and key[1] == snapshot]
+            pools = [self._pools.pop(key) for key in stale]
+            self._snapshot_generation += 1
+        for pool in pools:
+            while True:
+                try:
+                    pool.get_nowait().close()
+                except queue.Empty:
+                    break
+        return True
+
+    def rollback(self):
+        """Roll back the current request's connection, if one is open"""
+        if has_app_context():
+            conn = g.get(self.g_name)
+            if conn is not None:
+                conn.rollback()
+
+    def teardown(self, exception=None):
+        reader = g.pop(f'{self.g_name}_ro', None)
+        if reader is not None:
+            self.release(reader, g.pop(f'{self.g_name}_ro_key', None))
+        conn = g.pop(self.g_name, None)
+        path = g.pop(f'{self.g_name}_path', None)
+        if conn is None:
+            return
+        try:
+            if exception is None:
+                conn.commit()
+                self._committed(conn)
+            else:
+                conn.rollback()
+        finally:
+            self.release(conn, path)
+
+    def _committed(self, conn):
+        for hook in self.after_commit:
+            try:
+                hook(conn)
+            except Exception as e:
+                print(f"Database hook error: {e}")
+
+    @contextmanager
+    def session(self):
+        """Pooled connection for code running outside a request"""
+        conn, path = self.acquire()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        else:
+            self._committed(conn)
+        finally:
+            self.release(conn, path)
+
+    @contextmanager
+    def immediate(self, conn):
+        """Run a block on conn inside BEGIN IMMEDIATE, committing on success.
+
+        Takes the write lock up front, so check-then-write sequences cannot
+        interleave with another writer. If conn already has a transaction
+        open, the block runs in a savepoint instead: a failure rolls back
+        only the block, and committing is left to whoever opened the outer
+        transaction. Should that transaction not hold the write lock yet,
+        SQLite fails the block's first write with SQLITE_BUSY rather than
+        let it build on a stale read.
+        """
+        if conn.in_transaction:
+            conn.execute('SAVEPOINT immediate')
+            try:
+                yield conn
+            except Exception:
+                conn.execute('ROLLBACK TO immediate')
+                conn.execute('RELEASE immediate')
+                raise
+            conn.execute('RELEASE immediate')
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        self._committed(conn)
+
+    def start_snapshots(self, interval):
+        """Refresh the reports snapshot every `interval` seconds in the background"""
+        def run():
+            while not self._stopping.wait(interval):
+                try:
+                    self.refresh_snapshot()
+                except Exception as e:
+                    print(f"Reports snapshot error: {e}")
+        self.refresh_snapshot()
+        self._stopping.clear()
+        threading.Thread(target=run, name='reports-snapshot', daemon=True).start()
+
+    def close_all(self):
+        self._stopping.set()
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            while True:
+                try:
+                    pool.get_nowait().close()
+                except queue.Empty:
+                    break
+
+class TelemetryDatabase(Database):
+    """Separate file for high-volume telemetry (clicks, shares, activity logs).
+
+    It has its own write lock and WAL, so click bursts written by the event
+    ingestor never queue payment commits in the main database. The file sits
+    next to the main one unless TELEMETRY_DATABASE names it.
+    """
+
+    g_name = 'telemetry_db'
+    snapshot_path = None
+
+    @property
+    def path(self):
+        if self.app is not None and self.app.config.get('TELEMETRY_DATABASE'):
+            return self.app.config['TELEMETRY_DATABASE']
+        root, extension = os.path.splitext(super().path)
+        return f'{root}_telemetry{extension or ".db"}'
+
+# Global database instances
+db = Database()
+telemetry_db = TelemetryDatabase()
+db.attach('telemetry', telemetry_db)
+
+def get_db():
+    """Request-scoped database connection helper"""
+    return db.connection()
+
+def get_telemetry_db():
+    """Request-scoped connection to the telemetry database"""
+    return telemetry_db.connection()
+
+def get_report_db():
+    """Request-scoped read-only connection for admin reports"""
+    return db.reader()
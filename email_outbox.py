@@ -0,0 +1,248 @@
+import os
+import smtplib
+import socketserver
+import threading
+import time
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+
+from database import db
+
+class EmailOutbox:
+    """Durable email queue drained by a background SMTP worker.
+
+    Request handlers only insert a row into email_outbox on their own
+    connection, so the email is committed together with the rest of the
+    request. A worker thread claims due rows in batches and sends them over
+    one long-lived authenticated SMTP session, retrying failures with
+    exponential backoff.
+    """
+
+    def __init__(self, database, batch_size=20, poll_interval=2.0, idle_timeout=60.0,
+                 max_attempts=6, backoff_base=30, backoff_max=3600, claim_timeout=600):
+        self.database = database
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.claim_timeout = claim_timeout
+        self._smtp = None
+        self._last_used = 0.0
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    # Configuration
+    @property
+    def smtp_server(self):
+        return os.environ.get('SMTP_SERVER', 'smtp.gmail.com')
+
+    @property
+    def smtp_port(self):
+        return int(os.environ.get('SMTP_PORT', 587))
+
+    @property
+    def credentials(self):
+        user = os.environ.get('GMAIL_USER')
+        password = os.environ.get('GMAIL_APP_PASSWORD')
+        return (user, password) if user and password else None
+
+    @property
+    def sender(self):
+        return os.environ.get('GMAIL_USER', 'noreply@dadaal.com')
+
+    def is_configured(self):
+        """True when there is an SMTP server the worker can deliver to"""
+        return bool(self.credentials or os.environ.get('SMTP_SERVER'))
+
+    # Request path
+    def enqueue(self, conn, recipient, subject, body):
+        """Insert an email into the outbox on the caller's connection"""
+        cursor = conn.execute('''
+            INSERT INTO email_outbox (recipient, subject, body)
+            VALUES (?, ?, ?)
+        ''', (recipient, subject, body))
+        self._wakeup.set()
+        return cursor.lastrowid
+
+    # Worker
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='email-outbox', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        self._close_smtp()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                sent = self.run_once()
+            except Exception as e:
+                print(f"Email outbox worker error: {e}")
+                sent = 0
+            if not sent:
+                if self._smtp and time.monotonic() - self._last_used > self.idle_timeout:
+                    self._close_smtp()
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def run_once(self):
+        """Claim and send one batch of due emails; returns the number sent"""
+        batch = self._claim_batch()
+        if not batch:
+            return 0
+
+        sent, results = 0, []
+        for email_id, recipient, subject, body, attempts in batch:
+            try:
+                self._send(recipient, subject, body)
+                results.append(('sent', None, None, email_id))
+                sent += 1
+            except Exception as e:
+                print(f"Email sending error for {recipient}: {e}")
+                self._close_smtp()
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    results.append(('failed', str(e), 0, email_id))
+                else:
+                    delay = min(self.backoff_base * 2 ** (attempts - 1), self.backoff_max)
+                    results.append(('pending', str(e), delay, email_id))
+
+        with self.database.session() as conn:
+            conn.executemany('''
+                UPDATE email_outbox
+                SET status = ?1,
+                    last_error = ?2,
+                    attempts = attempts + (?1 != 'sent'),
+                    next_attempt_at = datetime('now', '+' || COALESCE(?3, 0) || ' seconds'),
+                    sent_at = CASE WHEN ?1 = 'sent' THEN CURRENT_TIMESTAMP END
+                WHERE id = ?4
+            ''', results)
+        return sent
+
+    def _claim_batch(self):
+        # Single UPDATE ... RETURNING, so concurrent workers never claim the same row.
+        # Rows stuck in 'sending' after a crash are reclaimed once the claim expires.
+        with self.database.session() as conn:
+            return conn.execute('''
+                UPDATE email_outbox
+                SET status = 'sending', claimed_at = CURRENT_TIMESTAMP
+                WHERE id IN (
+                    SELECT id FROM email_outbox
+                    WHERE (status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP)
+                       OR (status = 'sending' AND claimed_at <= datetime('now', ?))
+                    ORDER BY id
+                    LIMIT ?
+                )
+                RETURNING id, recipient, subject, body, attempts
+            ''', (f'-{self.claim_timeout} seconds', self.batch_size)).fetchall()
+
+    def _connection(self):
+        if self._smtp is None:
+            server = smtplib.SMTP(self.smtp_server, self.smtp_port, timeout=30)
+            if os.environ.get('SMTP_STARTTLS', '1') == '1' and server.has_extn('starttls'):
+                server.starttls()
+            if self.credentials:
+                server.login(*self.credentials)
+            self._smtp = server
+        self._last_used = time.monotonic()
+        return self._smtp
+
+    def _send(self, recipient, subject, body):
+        msg = MIMEMultipart()
+        msg['From'] = self.sender
+        msg['To'] = recipient
+        msg['Subject'] = subject
+        msg.attach(MIMEText(body, 'plain'))
+
+        try:
+            self._connection().sendmail(self.sender, recipient, msg.as_string())
+        except smtplib.SMTPServerDisconnected:
+            # The server dropped our idle session; reconnect once
+            self._close_smtp()
+            self._connection().sendmail(self.sender, recipient, msg.as_string())
+
+    def _close_smtp(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except Exception:
+                pass
+            self._smtp = None
+
+class DebugSMTPServer:
+    """Minimal local SMTP server that keeps received messages in memory.
+
+    Stand-in for a real mail server in tests and local development:
+    point SMTP_SERVER/SMTP_PORT at it and read `messages`.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.messages = []
+        self.connections = 0
+        outer = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(f'{line}\r\n'.encode())
+
+            def handle(self):
+                outer.connections += 1
+                self.reply('220 dadaal debug smtp')
+                sender, recipients = None, []
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    command = line.decode(errors='replace').strip()
+                    verb = command[:4].upper()
+                    if verb in ('HELO', 'EHLO'):
+                        self.reply('250 localhost')
+                    elif verb == 'MAIL':
+                        sender, recipients = command.split(':', 1)[1].strip(' <>'), []
+                        self.reply('250 OK')
+                    elif verb == 'RCPT':
+                        recipients.append(command.split(':', 1)[1].strip(' <>'))
+                        self.reply('250 OK')
+                    elif verb == 'DATA':
+                        self.reply('354 End data with <CR><LF>.<CR><LF>')
+                        data = []
+                        for data_line in self.rfile:
+                            if data_line in (b'.\r\n', b'.\n'):
+                                break
+                            data.append(data_line)
+                        outer.messages.append({'from': sender, 'to': recipients,
+                                         'data': b''.join(data).decode(errors='replace')})
+                        self.reply('250 OK')
+                    elif verb == 'QUIT':
+                        self.reply('221 Bye')
+                        return
+                    else:  # RSET, NOOP and anything else
+                        self.reply('250 OK')
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.host, self.port = self.server.server_address
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+# Global email outbox instance
+email_outbox = EmailOutbox(db)
@@ -0,0 +1,140 @@
+import csv
+import io
+import json
+import zlib
+
+from database import db
+
+class ExportDataset:
+    """One exportable table: its SELECT and the columns the filters apply to"""
+
+    def __init__(self, select, columns, date_column, type_column=None, user_column=None):
+        self.select = select
+        self.columns = columns
+        self.date_column = date_column
+        self.type_column = type_column
+        self.user_column = user_column
+
+    def query(self, start=None, end=None, type=None, user_id=None):
+        """Build the filtered, id-ordered query and its parameters"""
+        where, params = [], []
+        if start:
+            where.append(f'{self.date_column} >= ?')
+            params.append(start)
+        if end:
+            # Inclusive end date
+            where.append(f"{self.date_column} < date(?, '+1 day')")
+            params.append(end)
+        if type and self.type_column:
+            where.append(f'{self.type_column} = ?')
+            params.append(type)
+        if user_id and self.user_column:
+            where.append(f'{self.user_column} = ?')
+            params.append(user_id)
+        sql = self.select
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        return sql + f' ORDER BY {self.columns[0][1]}', params
+
+EXPORT_DATASETS = {
+    'transactions': ExportDataset(
+        'SELECT t.id, t.user_id, t.amount, t.type, t.status, t.payment_method, t.source, '
+        't.reference_id, t.description, t.created_at FROM transactions t',
+        [('id', 't.id'), ('user_id', 't.user_id'), ('amount', 't.amount'), ('type', 't.type'),
+         ('status', 't.status'), ('payment_method', 't.payment_method'), ('source', 't.source'),
+         ('reference_id', 't.reference_id'), ('description', 't.description'),
+         ('created_at', 't.created_at')],
+        date_column='t.created_at', type_column='t.type', user_column='t.user_id'),
+    'users': ExportDataset(
+        'SELECT u.id, u.name, u.email, u.phone, u.status, u.premium_until, u.email_verified, '
+        'u.total_earnings, u.referral_code, u.created_at FROM users u',
+        [('id', 'u.id'), ('name', 'u.name'), ('email', 'u.email'), ('phone', 'u.phone'),
+         ('status', 'u.status'), ('premium_until', 'u.premium_until'),
+         ('email_verified', 'u.email_verified'), ('total_earnings', 'u.total_earnings'),
+         ('referral_code', 'u.referral_code'), ('created_at', 'u.created_at')],
+        date_column='u.created_at', type_column='u.status', user_column='u.id'),
+    'sales': ExportDataset(
+        'SELECT s.id, s.order_id, s.product_id, s.partner_id, s.buyer_id, s.quantity, s.unit_price, '
+        's.total_amount, s.commission_amount, s.commission_rate, s.status, s.sale_date '
+        'FROM wholesale_sales s',
+        [('id', 's.id'), ('order_id', 's.order_id'), ('product_id', 's.product_id'),
+         ('partner_id', 's.partner_id'), ('buyer_id', 's.buyer_id'), ('quantity', 's.quantity'),
+         ('unit_price', 's.unit_price'), ('total_amount', 's.total_amount'),
+         ('commission_amount', 's.commission_amount'), ('commission_rate', 's.commission_rate'),
+         ('status', 's.status'), ('sale_date', 's.sale_date')],
+        date_column='s.sale_date', type_column='s.status', user_column='s.buyer_id'),
+}
+
+EXPORT_FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+class Exporter:
+    """Constant-memory exports streamed straight off a SQLite cursor.
+
+    Each export runs on its own read-only connection inside one read
+    transaction, so every row comes from the same snapshot and, under WAL,
+    no write lock is ever taken: payments and logins keep committing while
+    a long export runs. Rows are pulled `chunk_size` at a time with
+    fetchmany, encoded and yielded, optionally through a streaming gzip
+    compressor.
+    """
+
+    def __init__(self, database, chunk_size=1000):
+        self.database = database
+        self.chunk_size = chunk_size
+
+    def rows(self, dataset, **filters):
+        """Yield the header, then every matching row, one chunk in memory at a time"""
+        spec = EXPORT_DATASETS[dataset]
+        sql, params = spec.query(**filters)
+        conn, key = self.database.acquire_readonly()
+        try:
+            conn.execute('BEGIN')
+            cursor = conn.execute(sql, params)
+            yield [name for name, _ in spec.columns]
+            while True:
+                chunk = cursor.fetchmany(self.chunk_size)
+                if not chunk:
+                    break
+                yield from chunk
+        finally:
+            conn.rollback()
+            self.database.release(conn, key)
+
+    def stream(self, dataset, format='csv', compress=False, **filters):
+        """Yield the export as encoded (and optionally gzipped) byte chunks"""
+        encoded = self._csv(self.rows(dataset, **filters)) if format == 'csv' \
+            else self._jsonl(self.rows(dataset, **filters))
+        if not compress:
+            yield from encoded
+            return
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)   # wbits=31 writes a gzip container
+        for chunk in encoded:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    def _csv(self, rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for count, row in enumerate(rows, 1):
+            writer.writerow(row)
+            if count % self.chunk_size == 0:
+                yield buffer.getvalue().encode()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue().encode()
+
+    def _jsonl(self, rows):
+        header = next(rows)
+        lines = []
+        for row in rows:
+            lines.append(json.dumps(dict(zip(header, row)), default=str))
+            if len(lines) == self.chunk_size:
+                yield ('\n'.join(lines) + '\n').encode()
+                lines = []
+        if lines:
+            yield ('\n'.join(lines) + '\n').encode()
+
+# Global exporter instance
+exporter = Exporter(db)
@@ -0,0 +1,172 @@
+import atexit
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+from database import telemetry_db
+
+# One INSERT per event kind; the event timestamp is always the last parameter
+EVENT_STATEMENTS = {
+    'affiliate_click': '''
+        INSERT INTO affiliate_clicks (user_id, product_id, platform, clicked_at)
+        VALUES (?, ?, ?, ?)
+    ''',
+    'share': '''
+        INSERT INTO shares (user_id, platform, referral_code, shared_at)
+        VALUES (?, ?, ?, ?)
+    ''',
+    'activity': '''
+        INSERT INTO user_activity_logs (user_id, activity_type, description, created_at)
+        VALUES (?, ?, ?, ?)
+    ''',
+}
+
+class EventIngestor:
+    """Buffers high-volume telemetry inserts and writes them in batches.
+
+    emit() only puts the event on an in-process queue. A writer thread
+    flushes the queue every `flush_interval` seconds or every `batch_size`
+    events, using executemany inside a single transaction, so a burst of
+    clicks costs one commit instead of one per click. The queue is bounded;
+    events that do not fit are dropped and counted in stats().
+    """
+
+    def __init__(self, database, flush_interval=0.25, batch_size=500, max_queue=10000):
+        self.database = database
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._write_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+        # Callables run as hook(conn, grouped) inside each batch's transaction,
+        # and as hook(grouped) once it has committed
+        self.after_write = []
+        self.after_commit = []
+        self.dropped = 0
+        self.written = 0
+        self.flushes = 0
+        self.failures = 0
+        self.last_flush_at = None
+
+    def emit(self, kind, *params):
+        """Queue one event; returns False if it was dropped under backpressure"""
+        self._ensure_started()
+        event_time = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        try:
+            self._queue.put_nowait((kind, params + (event_time,)))
+        except queue.Full:
+            with self._stats_lock:
+                self.dropped += 1
+            return False
+        if self._queue.qsize() >= self.batch_size:
+            self._wake.set()
+        return True
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._start_lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._stopping.clear()
+                    self._thread = threading.Thread(target=self._run, name='event-ingestor', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            # Woken early by emit() once a full batch is queued, and by stop()
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def _drain(self):
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_next(self):
+        """Take one batch off the queue and write it; returns its size, or None if the write failed"""
+        # Drained and written under one lock, so no batch is ever held
+        # outside the queue while another thread flushes
+        with self._write_lock:
+            batch = self._drain()
+            if not batch:
+                return 0
+            grouped = {}
+            for kind, params in batch:
+                grouped.setdefault(kind, []).append(params)
+            try:
+                with self.database.session() as conn:
+                    for kind, rows in grouped.items():
+                        conn.executemany(EVENT_STATEMENTS[kind], rows)
+                    for hook in self.after_write:
+                        hook(conn, grouped)
+            except Exception as e:
+                print(f"Event ingestion error: {e}")
+                with self._stats_lock:
+                    self.failures += 1
+                # Requeue for the next flush; whatever no longer fits is dropped
+                for event in batch:
+                    try:
+                        self._queue.put_nowait(event)
+                    except queue.Full:
+                        with self._stats_lock:
+                            self.dropped += 1
+                return None
+
+        for hook in self.after_commit:
+            try:
+                hook(grouped)
+            except Exception as e:
+                print(f"Event ingestion hook error: {e}")
+
+        with self._stats_lock:
+            self.written += len(batch)
+            self.flushes += 1
+            self.last_flush_at = time.time()
+        return len(batch)
+
+    def flush(self):
+        """Synchronously write everything queued so far.
+
+        Returns once every event emitted before the call is written, including
+        any the writer thread had already taken, unless a write fails.
+        """
+        while self._write_next():
+            pass
+
+    def stop(self, timeout=5.0):
+        """Stop the writer thread and flush what is left (runs at exit)"""
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    def stats(self):
+        """Backpressure metrics for monitoring"""
+        with self._stats_lock:
+            queued = self._queue.qsize()
+            return {
+                'queued': queued,
+                'max_queue': self.max_queue,
+                'queue_utilization': queued / self.max_queue if self.max_queue else 0,
+                'dropped': self.dropped,
+                'written': self.written,
+                'flushes': self.flushes,
+                'failures': self.failures,
+                'last_flush_at': self.last_flush_at,
+            }
+
+# Global event ingestor instance
+event_ingestor = EventIngestor(telemetry_db)
+atexit.register(event_ingestor.stop)
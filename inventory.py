@@ -0,0 +1,131 @@
+import json
+
+from database import db
+
+# Columns returned for a product whose stock was just taken
+TAKEN_PRODUCT_COLUMNS = '''
+    id, partner_id, product_name, price_cents, commission_bps,
+    (SELECT user_id FROM wholesale_partners WHERE wholesale_partners.id = partner_id) AS partner_user_id
+'''
+
+class Inventory:
+    """Oversell-proof stock changes for wholesale products.
+
+    Stock only ever goes down through a conditional decrement
+    (stock_quantity >= quantity) whose RETURNING row carries the price and
+    commission, so there is no read-then-write window. Multi-step checkout
+    holds stock through a reservation row that either gets confirmed or,
+    once abandoned past its expiry, hands its quantity back.
+
+    Every method runs on the caller's connection; wrap calls in
+    db.immediate(conn) so the whole checkout commits or rolls back together.
+    """
+
+    def __init__(self, database, hold_seconds=900):
+        self.database = database
+        self.hold_seconds = hold_seconds
+
+    def take_stock(self, conn, product_id, quantity):
+        """Decrement stock if enough is left; returns the product row or None"""
+        if quantity <= 0:
+            return None
+        return conn.execute(f'''
+            UPDATE wholesale_products
+            SET stock_quantity = stock_quantity - ?
+            WHERE id = ? AND status = 'active' AND stock_quantity >= ?
+            RETURNING {TAKEN_PRODUCT_COLUMNS}
+        ''', (quantity, product_id, quantity)).fetchone()
+
+    def take_cart(self, conn, lines):
+        """Validate and take stock for a whole cart ({product_id: quantity}).
+
+        All lines are checked with one query; stock is taken only if every
+        line can be filled. Returns (products by id, errors by id). Needs the
+        write lock (db.immediate) so nothing changes between check and take.
+        """
+        rows = conn.execute(f'''
+            SELECT {TAKEN_PRODUCT_COLUMNS}, stock_quantity, status
+            FROM wholesale_products
+            WHERE id IN (SELECT value FROM json_each(?))
+        ''', (json.dumps(list(lines)),)).fetchall()
+        found = {row[0]: row for row in rows}
+
+        products, errors = {}, {}
+        for product_id, quantity in lines.items():
+            row = found.get(product_id)
+            if row is None or row[7] != 'active':
+                errors[product_id] = 'not_found'
+            elif quantity <= 0 or row[6] < quantity:
+                errors[product_id] = 'insufficient_stock'
+            else:
+                products[product_id] = row[:6]
+        if errors:
+            return {}, errors
+
+        before = conn.total_changes
+        conn.executemany('''
+            UPDATE wholesale_products SET stock_quantity = stock_quantity - ?
+            WHERE id = ? AND stock_quantity >= ?
+        ''', [(quantity, product_id, quantity) for product_id, quantity in lines.items()])
+        if conn.total_changes - before != len(lines):
+            raise RuntimeError('Stock changed while the cart held the write lock')
+        return products, {}
+
+    def reserve(self, conn, product_id, buyer_id, quantity):
+        """Hold stock for a buyer; returns (reservation_id, product_row) or None"""
+        self.expire_reservations(conn)
+        product = self.take_stock(conn, product_id, quantity)
+        if product is None:
+            return None
+        reservation_id = conn.execute('''
+            INSERT INTO stock_reservations (product_id, buyer_id, quantity, expires_at)
+            VALUES (?, ?, ?, datetime('now', ?))
+        ''', (product_id, buyer_id, quantity, f'+{self.hold_seconds} seconds')).lastrowid
+        return reservation_id, product
+
+    def confirm(self, conn, reservation_id, buyer_id):
+        """Turn a live hold into a purchase; returns (quantity, product_row) or None"""
+        reservation = conn.execute('''
+            UPDATE stock_reservations SET status = 'confirmed'
+            WHERE id = ? AND buyer_id = ? AND status = 'held' AND expires_at > CURRENT_TIMESTAMP
+            RETURNING product_id, quantity
+        ''', (reservation_id, buyer_id)).fetchone()
+        if reservation is None:
+            return None
+        product = conn.execute(f'''
+            SELECT {TAKEN_PRODUCT_COLUMNS} FROM wholesale_products WHERE id = ?
+        ''', (reservation[0],)).fetchone()
+        return reservation[1], product
+
+    def release(self, conn, reservation_id, buyer_id):
+        """Cancel a live hold and return its stock; returns True if one was released"""
+        reservation = conn.execute('''
+            UPDATE stock_reservations SET status = 'released'
+            WHERE id = ? AND buyer_id = ? AND status = 'held'
+            RETURNING product_id, quantity
+        ''', (reservation_id, buyer_id)).fetchone()
+        if reservation is None:
+            return False
+        self._restock(conn, [reservation])
+        return True
+
+    def expire_reservations(self, conn):
+        """Return the stock of abandoned holds; returns how many expired"""
+        expired = conn.execute('''
+            UPDATE stock_reservations SET status = 'expired'
+            WHERE status = 'held' AND expires_at <= CURRENT_TIMESTAMP
+            RETURNING product_id, quantity
+        ''').fetchall()
+        self._restock(conn, expired)
+        return len(expired)
+
+    def _restock(self, conn, reservations):
+        totals = {}
+        for product_id, quantity in reservations:
+            totals[product_id] = totals.get(product_id, 0) + quantity
+        conn.executemany('''
+            UPDATE wholesale_products SET stock_quantity = stock_quantity + ? WHERE id = ?
+        ''', [(quantity, product_id) for product_id, quantity in totals.items()])
+
+# Global inventory instance
+inventory = Inventory(db)
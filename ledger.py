@@ -0,0 +1,124 @@
+from database import db
+from money import to_dollars
+
+# One posting: credit the user's account, debit the platform account paying for it
+POSTING_INSERT = '''
+    INSERT INTO ledger_entries (account, amount, amount_cents, source, transaction_id)
+    VALUES (?, ?, ?, ?, ?), (?, ?, ?, ?, ?)
+'''
+
+# Highest entry id already folded into ledger_checkpoints
+WATERMARK = 'COALESCE((SELECT last_id FROM backfill_progress WHERE job = ?), 0)'
+
+def user_account(user_id):
+    return f'user:{user_id}'
+
+def platform_account(source):
+    return f'platform:{source}'
+
+class Ledger:
+    """Append-only double-entry ledger of user balances.
+
+    Every balance change is a posting of two ledger_entries rows that sum to
+    zero: the user's account is credited and the platform account for the
+    earning source is debited. Entries are never updated or deleted (triggers
+    reject it), and users.earnings_cents (with total_earnings derived from
+    it) is kept as a cache of the user accounts by a trigger on insert, so
+    writers only append. Amounts are integer cents throughout; the REAL
+    amount column is a display copy.
+
+    checkpoint() folds entries above a watermark into ledger_checkpoints,
+    one running balance per account. A balance read is that checkpoint plus
+    the few entries appended since, and platform-wide reports read the
+    checkpoints instead of every entry.
+    """
+
+    job = 'ledger_checkpoints'
+
+    def __init__(self, database, batch_size=5000):
+        self.database = database
+        self.batch_size = batch_size
+
+    def post(self, cursor, user_id, cents, source, transaction_id=None):
+        """Credit `cents` to the user, debited from the source's platform account"""
+        cursor.execute(POSTING_INSERT, self._legs(user_id, cents, source, transaction_id))
+
+    def post_many(self, cursor, postings):
+        """Append several (user_id, cents, source, transaction_id) postings"""
+        cursor.executemany(POSTING_INSERT, [self._legs(*posting) for posting in postings])
+
+    @staticmethod
+    def _legs(user_id, cents, source, transaction_id=None):
+        return (user_account(user_id), to_dollars(cents), cents, source, transaction_id,
+                platform_account(source), to_dollars(-cents), -cents, source, transaction_id)
+
+    def watermark(self, conn):
+        row = conn.execute('SELECT last_id FROM backfill_progress WHERE job = ?', (self.job,)).fetchone()
+        return row[0] if row else 0
+
+    def balance(self, conn, user_id):
+        """Checkpointed balance plus the entries appended since, in cents"""
+        account = user_account(user_id)
+        # One statement, so the checkpoint and the tail come from the same snapshot
+        return conn.execute(f'''
+            SELECT COALESCE((SELECT balance_cents FROM ledger_checkpoints WHERE account = ?), 0)
+                 + COALESCE((SELECT SUM(amount_cents) FROM ledger_entries WHERE account = ? AND id > {WATERMARK}), 0)
+        ''', (account, account, self.job)).fetchone()[0]
+
+    def balances(self, conn):
+        """Platform-wide balances per account in cents, from the checkpoints and the tail"""
+        return dict(conn.execute(f'''
+            SELECT account, SUM(cents) FROM (
+                SELECT account, balance_cents AS cents FROM ledger_checkpoints
+                UNION ALL
+                SELECT account, amount_cents FROM ledger_entries WHERE id > {WATERMARK}
+            )
+            GROUP BY account
+        ''', (self.job,)))
+
+    def report(self, conn):
+        """Total owed to users, per-source platform accounts and the trial balance"""
+        balances = self.balances(conn)
+        users = [cents for account, cents in balances.items() if account.startswith('user:')]
+        return {
+            'users_total': to_dollars(sum(users)),
+            'users_with_balance': sum(1 for cents in users if cents),
+            'platform': {account.split(':', 1)[1]: to_dollars(cents)
+                         for account, cents in sorted(balances.items()) if account.startswith('platform:')},
+            # Every posting sums to zero, so the whole ledger must too
+            'trial_balance': to_dollars(sum(balances.values())),
+            'checkpoint_entry_id': self.watermark(conn),
+        }
+
+    def checkpoint(self, conn):
+        """Fold entries above the watermark into the checkpoints; returns how many"""
+        total = 0
+        while True:
+            with self.database.immediate(conn):
+                last_id = self.watermark(conn)
+                upper_id, count = conn.execute('''
+                    SELECT MAX(id), COUNT(*) FROM (
+                        SELECT id FROM ledger_entries WHERE id > ? ORDER BY id LIMIT ?
+                    )
+                ''', (last_id, self.batch_size)).fetchone()
+                if not count:
+                    return total
+                conn.execute('''
+                    INSERT INTO ledger_checkpoints (account, balance, balance_cents, entry_id)
+                    SELECT account, SUM(amount_cents) / 100.0, SUM(amount_cents), MAX(id) FROM ledger_entries
+                    WHERE id > ? AND id <= ?
+                    GROUP BY account
+                    ON CONFLICT(account) DO UPDATE SET
+                        balance_cents = balance_cents + excluded.balance_cents,
+                        balance = (balance_cents + excluded.balance_cents) / 100.0,
+                        entry_id = excluded.entry_id,
+                        updated_at = CURRENT_TIMESTAMP
+                ''', (last_id, upper_id))
+                conn.execute('''
+                    INSERT INTO backfill_progress (job, last_id) VALUES (?, ?)
+                    ON CONFLICT(job) DO UPDATE SET last_id = excluded.last_id, updated_at = CURRENT_TIMESTAMP
+                ''', (self.job, upper_id))
+            total += count
+
+# Global ledger instance
+ledger = Ledger(db)
@@ -0,0 +1,99 @@
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows development machines: in-process lock only
+    fcntl = None
+
+from database import db, telemetry_db
+
+class Migrator:
+    """Numbered schema migrations recorded in PRAGMA user_version.
+
+    Migrations register in order with @migrator.migration(n). migrate()
+    first compares the file's user_version with the latest number, so a
+    current schema costs one integer read at startup. Otherwise it takes an
+    exclusive lock file next to the database (shared by every gunicorn
+    worker), re-reads the version and applies what is still pending, each
+    migration and its version bump committing together. Migrations that
+    manage their own transactions (rebuilds, ATTACH) register with
+    transactional=False and bump the version once they return.
+    """
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.migrations = []   # (version, description, function, transactional)
+        self._lock = threading.Lock()
+
+    def migration(self, version, transactional=True):
+        """Register function(conn) as migration number `version`"""
+        def register(function):
+            if version != len(self.migrations) + 1:
+                raise ValueError(f'{self.name} migration {version} registered out of order')
+            description = (function.__doc__ or function.__name__).strip().splitlines()[0]
+            self.migrations.append((version, description, function, transactional))
+            return function
+        return register
+
+    @property
+    def latest(self):
+        return len(self.migrations)
+
+    @staticmethod
+    def version(conn):
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+
+    @contextmanager
+    def _exclusive(self):
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(f'{self.database.path}.migrate.lock', 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def migrate(self):
+        """Apply pending migrations; returns the versions this call applied"""
+        conn, path = self.database.acquire()
+        try:
+            if self.version(conn) >= self.latest:
+                return []
+        finally:
+            self.database.release(conn, path)
+
+        applied = []
+        with self._exclusive():
+            conn = self.database.connect()
+            try:
+                for version, description, function, transactional in self.migrations:
+                    # Another worker may have migrated while we waited for the lock
+                    if version <= self.version(conn):
+                        continue
+                    if transactional:
+                        conn.execute('BEGIN IMMEDIATE')
+                        try:
+                            function(conn)
+                            conn.execute(f'PRAGMA user_version = {version}')
+                            conn.commit()
+                        except Exception:
+                            conn.rollback()
+                            raise
+                    else:
+                        function(conn)
+                        conn.commit()
+                        conn.execute(f'PRAGMA user_version = {version}')
+                    print(f"Applied {self.name} migration {version}: {description}")
+                    applied.append(version)
+            finally:
+                conn.close()
+        return applied
+
+# Global migrators for the main and telemetry database files
+schema = Migrator(db, 'main')
+telemetry_schema = Migrator(telemetry_db, 'telemetry')
@@ -0,0 +1,42 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+# Money is stored as integer cents and rates as integer basis points
+# (1 bp = 0.01%). REAL amount columns are derived display copies: cents / 100.
+CENTS = 100
+BASIS_POINTS = 10000
+
+def to_cents(amount):
+    """Dollars (float, str or Decimal) to integer cents, half away from zero"""
+    return int((Decimal(str(amount)) * CENTS).quantize(Decimal(1), ROUND_HALF_UP))
+
+def parse_cents(text):
+    """A dollar amount typed by a user as cents, or None unless it is a finite number"""
+    try:
+        amount = Decimal(str(text).strip())
+        return to_cents(amount) if amount.is_finite() else None
+    except ArithmeticError:  # InvalidOperation for non-numbers, Overflow for huge exponents
+        return None
+
+def to_basis_points(rate):
+    """A rate such as 0.15 to integer basis points (1500)"""
+    return int((Decimal(str(rate)) * BASIS_POINTS).quantize(Decimal(1), ROUND_HALF_UP))
+
+def apply_rate(cents, basis_points):
+    """The commission on `cents` at `basis_points`, rounded to a whole cent"""
+    return int((Decimal(cents) * basis_points / BASIS_POINTS).quantize(Decimal(1), ROUND_HALF_UP))
+
+def to_dollars(cents):
+    """Integer cents as the float written to REAL columns and shown in templates"""
+    return float(Decimal(cents) / CENTS) if cents is not None else None
+
+def to_rate(basis_points):
+    """Integer basis points back to a fractional rate"""
+    return float(Decimal(basis_points) / BASIS_POINTS) if basis_points is not None else None
+
+# The same conversions in SQL, for triggers and backfills over existing REAL
+# values. ROUND(x, n) rounds the decimal text, so 0.285 becomes 29 like to_cents().
+def cents_sql(column):
+    return f'CAST(ROUND(ROUND({column}, 2) * {CENTS}) AS INTEGER)'
+
+def basis_points_sql(column):
+    return f'CAST(ROUND(ROUND({column}, 4) * {BASIS_POINTS}) AS INTEGER)'
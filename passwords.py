@@ -0,0 +1,102 @@
+import hashlib
+import hmac
+import multiprocessing
+import os
+import secrets
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+ALGORITHM = 'pbkdf2_sha256'
+LEGACY_ITERATIONS = 100000  # salt(32 hex) + sha256 hex, written before hashes were versioned
+DEFAULT_ITERATIONS = int(os.environ.get('PASSWORD_HASH_ITERATIONS', 100000))
+# Hashing processes for the whole server, shared out between the gunicorn
+# workers (WEB_CONCURRENCY, which gunicorn also reads for --workers)
+HASH_BUDGET = int(os.environ.get('PASSWORD_HASH_BUDGET', os.cpu_count() or 1))
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+class PasswordHasherBusy(Exception):
+    """Raised when the hashing queue is full; the request should get a 503"""
+
+def _pbkdf2(password, salt, iterations):
+    return hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), iterations).hex()
+
+def _hash(password, iterations):
+    salt = secrets.token_hex(16)
+    return f'{ALGORITHM}${iterations}${salt}${_pbkdf2(password, salt, iterations)}'
+
+def _verify(stored_password, provided_password):
+    algorithm, iterations, salt, stored_hash = parse_hash(stored_password)
+    if algorithm != ALGORITHM:
+        return False
+    return hmac.compare_digest(_pbkdf2(provided_password, salt, iterations), stored_hash)
+
+def parse_hash(stored_password):
+    """Split a stored hash into (algorithm, iterations, salt, hash)"""
+    if stored_password.startswith(f'{ALGORITHM}$'):
+        algorithm, iterations, salt, stored_hash = stored_password.split('$', 3)
+        return algorithm, int(iterations), salt, stored_hash
+    # Legacy format: 32-char salt followed by the hex digest
+    return ALGORITHM, LEGACY_ITERATIONS, stored_password[:32], stored_password[32:]
+
+class PasswordHasher:
+    """PBKDF2 hashing on a bounded process pool.
+
+    At most `max_pending` hash operations may be queued or running per
+    process; beyond that PasswordHasherBusy is raised immediately so the
+    app can answer 503 instead of tying up every worker in a login burst.
+    By default each gunicorn worker gets its share of HASH_BUDGET, so the
+    pools of all workers together stay within it. The pool starts its
+    processes from a forkserver (spawn where that is missing), never by
+    forking this process and the threads and locks it already holds.
+    With workers=0 the hashing runs inline on the calling thread.
+    """
+
+    def __init__(self, workers=None, max_pending=None, iterations=DEFAULT_ITERATIONS):
+        self.workers = max(HASH_BUDGET // max(WEB_CONCURRENCY, 1), 1) if workers is None else workers
+        self.max_pending = max_pending if max_pending is not None else max(self.workers, 1) * 4
+        self.iterations = iterations
+        self._slots = threading.BoundedSemaphore(self.max_pending) if self.max_pending else None
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context(method))
+            return self._pool
+
+    def _run(self, func, *args):
+        if self._slots is None or not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy('Password hashing queue is full')
+        try:
+            if not self.workers:
+                return func(*args)
+            return self._executor().submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(_hash, password, self.iterations)
+
+    def verify(self, stored_password, provided_password):
+        if not stored_password:
+            return False
+        return self._run(_verify, stored_password, provided_password)
+
+    def needs_rehash(self, stored_password):
+        """True when a stored hash uses an old format or iteration count"""
+        if not stored_password.startswith(f'{ALGORITHM}$'):
+            return True
+        return parse_hash(stored_password)[1] != self.iterations
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+# Global password hasher instance
+password_hasher = PasswordHasher(workers=int(os.environ['PASSWORD_HASH_WORKERS'])
+                                 if 'PASSWORD_HASH_WORKERS' in os.environ else None)
@@ -0,0 +1,289 @@
+import csv
+import io
+import json
+import os
+import secrets
+import tempfile
+import threading
+
+from database import db
+from money import to_cents, apply_rate, to_dollars
+
+# Columns a partner may supply per product, in the order of the upsert below
+IMPORT_COLUMNS = ('product_name', 'description', 'price', 'wholesale_price',
+                  'category', 'sku', 'stock_quantity', 'price_cents', 'wholesale_price_cents')
+
+class RowError(ValueError):
+    """A single import row that cannot be written"""
+
+class ProductImporter:
+    """Background bulk import of wholesale products from CSV or JSONL uploads.
+
+    The request only stores the upload on disk and queues a row in
+    product_imports. A worker thread claims queued imports and streams the
+    file row by row, so memory stays flat however large the catalog is.
+    Valid rows are collected into chunks; each chunk gets its missing SKUs
+    generated in one go, is checked against existing SKUs with one query and
+    is upserted on sku with executemany, committing together with its row
+    errors and the import's progress counters.
+    """
+
+    def __init__(self, database, chunk_size=500, poll_interval=2.0, claim_timeout=1800,
+                 upload_dir=None):
+        self.database = database
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+        self.claim_timeout = claim_timeout
+        self.upload_dir = upload_dir
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    # Request path
+    def format_for(self, filename):
+        """Return 'csv' or 'jsonl' from an upload's file name, or None"""
+        extension = os.path.splitext(filename or '')[1].lower()
+        return {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}.get(extension)
+
+    def submit(self, conn, partner_id, upload):
+        """Store an uploaded file and queue its import; returns the import id"""
+        file_format = self.format_for(upload.filename)
+        if file_format is None:
+            raise ValueError('Unsupported import format')
+        fd, path = tempfile.mkstemp(prefix='import-', suffix=f'.{file_format}',
+                                    dir=self.upload_dir or os.environ.get('IMPORT_UPLOAD_DIR'))
+        with os.fdopen(fd, 'wb') as destination:
+            upload.save(destination)
+        import_id = conn.execute('''
+            INSERT INTO product_imports (partner_id, filename, format, path, total_bytes)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (partner_id, upload.filename, file_format, path, os.path.getsize(path))).lastrowid
+        self._wakeup.set()
+        return import_id
+
+    def progress(self, conn, import_id, partner_id):
+        """Return the import's status and counters as a dict, or None"""
+        row = conn.execute('''
+            SELECT id, filename, status, rows_processed, inserted, updated, failed,
+                   bytes_read, total_bytes, error, created_at, finished_at
+            FROM product_imports WHERE id = ? AND partner_id = ?
+        ''', (import_id, partner_id)).fetchone()
+        if row is None:
+            return None
+        progress = dict(zip(('id', 'filename', 'status', 'rows_processed', 'inserted', 'updated',
+                             'failed', 'bytes_read', 'total_bytes', 'error', 'created_at',
+                             'finished_at'), row))
+        done = progress['status'] in ('completed', 'failed')
+        progress['percent'] = 100 if done else int(100 * progress['bytes_read'] / max(progress['total_bytes'], 1))
+        return progress
+
+    # Worker
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='product-import', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                ran = self.run_once()
+            except Exception as e:
+                print(f"Product import worker error: {e}")
+                ran = False
+            if not ran:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def run_once(self):
+        """Claim and run one queued import; returns its id or None"""
+        job = self._claim()
+        if job is None:
+            return None
+        import_id, partner_id, file_format, path = job
+        try:
+            self._import(import_id, partner_id, file_format, path)
+            status, error = 'completed', None
+        except Exception as e:
+            print(f"Product import {import_id} error: {e}")
+            status, error = 'failed', str(e)
+        with self.database.session() as conn:
+            conn.execute('''
+                UPDATE product_imports
+                SET status = ?, error = ?, finished_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (status, error, import_id))
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        return import_id
+
+    def _claim(self):
+        # Imports stuck in 'running' after a crash start over once the claim
+        # expires; the upsert makes re-running the same rows harmless.
+        with self.database.session() as conn:
+            job = conn.execute('''
+                UPDATE product_imports
+                SET status = 'running', started_at = CURRENT_TIMESTAMP,
+                    rows_processed = 0, inserted = 0, updated = 0, failed = 0, bytes_read = 0
+                WHERE id = (
+                    SELECT id FROM product_imports
+                    WHERE status = 'queued'
+                       OR (status = 'running' AND started_at <= datetime('now', ?))
+                    ORDER BY id
+                    LIMIT 1
+                )
+                RETURNING id, partner_id, format, path
+            ''', (f'-{self.claim_timeout} seconds',)).fetchone()
+            if job is not None:
+                conn.execute('DELETE FROM product_import_errors WHERE import_id = ?', (job[0],))
+            return job
+
+    def _import(self, import_id, partner_id, file_format, path):
+        with open(path, 'rb') as raw:
+            text = io.TextIOWrapper(raw, encoding='utf-8-sig', newline='')
+            rows = self._csv_rows(text) if file_format == 'csv' else self._jsonl_rows(text)
+
+            chunk, errors, seen = [], [], set()
+            for row_number, record in rows:
+                try:
+                    product = self._validate(record)
+                    if product['sku'] is not None:
+                        if product['sku'] in seen:
+                            raise RowError('duplicate sku in file')
+                        seen.add(product['sku'])
+                    chunk.append((row_number, product))
+                except RowError as e:
+                    errors.append((import_id, row_number, (record or {}).get('sku'), str(e)))
+                if len(chunk) + len(errors) >= self.chunk_size:
+                    self._write_chunk(import_id, partner_id, chunk, errors, raw.tell())
+                    chunk, errors = [], []
+            self._write_chunk(import_id, partner_id, chunk, errors, raw.tell())
+
+    @staticmethod
+    def _csv_rows(text):
+        reader = csv.DictReader(text)
+        missing = {'product_name', 'price'} - set(reader.fieldnames or ())
+        if missing:
+            raise ValueError(f"CSV header is missing: {', '.join(sorted(missing))}")
+        for record in reader:
+            yield reader.line_num, record
+
+    @staticmethod
+    def _jsonl_rows(text):
+        for row_number, line in enumerate(text, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield row_number, record if isinstance(record, dict) else None
+
+    @staticmethod
+    def _text(value):
+        return str(value).strip()[:1000] if value is not None else ''
+
+    def _validate(self, record):
+        """Normalise one uploaded record into upsert values or raise RowError"""
+        if record is None:
+            raise RowError('invalid JSON object')
+        product_name = self._text(record.get('product_name'))
+        category = self._text(record.get('category'))
+        if not product_name:
+            raise RowError('product_name is required')
+        if not category:
+            raise RowError('category is required')
+        try:
+            price_cents = to_cents(float(record.get('price')))
+            wholesale_price = record.get('wholesale_price')
+            wholesale_price_cents = (to_cents(float(wholesale_price)) if wholesale_price not in (None, '')
+                                     else apply_rate(price_cents, 7000))
+            stock_quantity = record.get('stock_quantity')
+            stock_quantity = int(stock_quantity) if stock_quantity not in (None, '') else 0
+        except (TypeError, ValueError, ArithmeticError):
+            raise RowError('price, wholesale_price and stock_quantity must be numbers')
+        if price_cents <= 0 or wholesale_price_cents < 0 or stock_quantity < 0:
+            raise RowError('price must be positive and stock_quantity not negative')
+        return {
+            'product_name': product_name,
+            'description': self._text(record.get('description')),
+            'price': to_dollars(price_cents),
+            'wholesale_price': to_dollars(wholesale_price_cents),
+            'category': category,
+            'sku': self._text(record.get('sku')) or None,
+            'stock_quantity': stock_quantity,
+            'price_cents': price_cents,
+            'wholesale_price_cents': wholesale_price_cents,
+        }
+
+    def _generate_skus(self, conn, partner_id, count):
+        """Return `count` fresh SKUs, checking the whole batch in one query"""
+        skus = set()
+        while len(skus) < count:
+            candidates = {f"WS-{partner_id}-{secrets.token_hex(4).upper()}"
+                          for _ in range(count - len(skus))}
+            taken = {row[0] for row in conn.execute('''
+                SELECT sku FROM wholesale_products WHERE sku IN (SELECT value FROM json_each(?))
+            ''', (json.dumps(list(candidates)),))}
+            skus |= candidates - taken
+        return list(skus)
+
+    def _write_chunk(self, import_id, partner_id, chunk, errors, bytes_read):
+        with self.database.session() as conn:
+            with self.database.immediate(conn):
+                missing = [product for _, product in chunk if product['sku'] is None]
+                for product, sku in zip(missing, self._generate_skus(conn, partner_id, len(missing))):
+                    product['sku'] = sku
+
+                owners = dict(conn.execute('''
+                    SELECT sku, partner_id FROM wholesale_products
+                    WHERE sku IN (SELECT value FROM json_each(?))
+                ''', (json.dumps([product['sku'] for _, product in chunk]),)).fetchall())
+
+                upserts, inserted = [], 0
+                for row_number, product in chunk:
+                    owner = owners.get(product['sku'])
+                    if owner is not None and owner != partner_id:
+                        errors.append((import_id, row_number, product['sku'],
+                                       'sku belongs to another partner'))
+                        continue
+                    inserted += owner is None
+                    upserts.append((partner_id,) + tuple(product[column] for column in IMPORT_COLUMNS))
+
+                conn.executemany('''
+                    INSERT INTO wholesale_products (
+                        partner_id, product_name, description, price, wholesale_price,
+                        category, sku, stock_quantity, price_cents, wholesale_price_cents
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(sku) DO UPDATE SET
+                        product_name = excluded.product_name, description = excluded.description,
+                        price = excluded.price, wholesale_price = excluded.wholesale_price,
+                        price_cents = excluded.price_cents, wholesale_price_cents = excluded.wholesale_price_cents,
+                        category = excluded.category, stock_quantity = excluded.stock_quantity,
+                        status = 'active'
+                    WHERE wholesale_products.partner_id = excluded.partner_id
+                ''', upserts)
+                conn.executemany('''
+                    INSERT INTO product_import_errors (import_id, row_number, sku, error)
+                    VALUES (?, ?, ?, ?)
+                ''', errors)
+                conn.execute('''
+                    UPDATE product_imports
+                    SET rows_processed = rows_processed + ?, inserted = inserted + ?,
+                        updated = updated + ?, failed = failed + ?, bytes_read = ?
+                    WHERE id = ?
+                ''', (len(upserts) + len(errors), inserted,
+                      len(upserts) - inserted, len(errors), bytes_read, import_id))
+
+# Global product importer instance
+product_importer = ProductImporter(db)
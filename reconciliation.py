@@ -0,0 +1,117 @@
+import json
+
+from database import db
+from ledger import ledger, WATERMARK
+from money import to_dollars
+
+class Reconciler:
+    """Checks users.earnings_cents against the ledger and records drift.
+
+    A trigger appends the id of every user whose stored balance changes to
+    balance_changes. run() works through that queue above its high-water
+    mark in batches, so it only looks at users touched since the last run.
+    run_full() walks every user in id order instead. Both compare a batch
+    of users in one statement: each user's ledger balance is their checkpoint
+    plus the entries appended since, read through the indexes. Balances are
+    integer cents, so any difference is drift: those users get a
+    balance_drift row (in dollars), removed once they agree again.
+    """
+
+    job = 'balance_reconciliation'
+
+    def __init__(self, database, ledger, batch_size=5000):
+        self.database = database
+        self.ledger = ledger
+        self.batch_size = batch_size
+
+    def watermark(self, conn):
+        row = conn.execute('SELECT last_id FROM backfill_progress WHERE job = ?', (self.job,)).fetchone()
+        return row[0] if row else 0
+
+    def _compare(self, conn, user_ids):
+        """Return [(user_id, stored, ledger_balance)] in cents for the given users"""
+        # The tail is summed for the batch's accounts only, each a range scan of
+        # idx_ledger_account, however much of the ledger is not checkpointed yet
+        return conn.execute(f'''
+            WITH tail AS (
+                SELECT account, SUM(amount_cents) AS cents FROM ledger_entries
+                WHERE account IN (SELECT 'user:' || value FROM json_each(?)) AND id > {WATERMARK}
+                GROUP BY account
+            )
+            SELECT u.id, u.earnings_cents, COALESCE(c.balance_cents, 0) + COALESCE(t.cents, 0)
+            FROM users u
+            LEFT JOIN ledger_checkpoints c ON c.account = 'user:' || u.id
+            LEFT JOIN tail t ON t.account = 'user:' || u.id
+            WHERE u.id IN (SELECT value FROM json_each(?))
+        ''', (json.dumps(user_ids), self.ledger.job, json.dumps(user_ids))).fetchall()
+
+    def _record(self, conn, user_ids):
+        """Compare one batch and replace its rows in balance_drift; returns the drift count"""
+        drifted = [(user_id, to_dollars(stored), to_dollars(balance), to_dollars(stored - balance))
+                   for user_id, stored, balance in self._compare(conn, user_ids)
+                   if stored != balance]
+        conn.execute('DELETE FROM balance_drift WHERE user_id IN (SELECT value FROM json_each(?))',
+                     (json.dumps(user_ids),))
+        conn.executemany('''
+            INSERT INTO balance_drift (user_id, stored_balance, ledger_balance, drift)
+            VALUES (?, ?, ?, ?)
+        ''', drifted)
+        return len(drifted)
+
+    def run(self, conn):
+        """Reconcile users touched since the last run; returns (users checked, drifted)"""
+        checked = drifted = 0
+        while True:
+            with self.database.immediate(conn):
+                last_id = self.watermark(conn)
+                upper_id = conn.execute('''
+                    SELECT MAX(id) FROM (
+                        SELECT id FROM balance_changes WHERE id > ? ORDER BY id LIMIT ?
+                    )
+                ''', (last_id, self.batch_size)).fetchone()[0]
+                if upper_id is None:
+                    return checked, drifted
+                user_ids = [row[0] for row in conn.execute('''
+                    SELECT DISTINCT user_id FROM balance_changes WHERE id > ? AND id <= ?
+                ''', (last_id, upper_id))]
+                drifted += self._record(conn, user_ids)
+                checked += len(user_ids)
+                conn.execute('''
+                    INSERT INTO backfill_progress (job, last_id) VALUES (?, ?)
+                    ON CONFLICT(job) DO UPDATE SET last_id = excluded.last_id, updated_at = CURRENT_TIMESTAMP
+                ''', (self.job, upper_id))
+                # Everything up to the mark has been checked
+                conn.execute('DELETE FROM balance_changes WHERE id <= ?', (upper_id,))
+
+    def run_full(self, conn):
+        """Reconcile every user in id-ordered batches; returns (users checked, drifted)"""
+        checked = drifted = 0
+        after = 0
+        while True:
+            with self.database.immediate(conn):
+                user_ids = [row[0] for row in conn.execute(
+                    'SELECT id FROM users WHERE id > ? ORDER BY id LIMIT ?', (after, self.batch_size))]
+                if not user_ids:
+                    return checked, drifted
+                drifted += self._record(conn, user_ids)
+            checked += len(user_ids)
+            after = user_ids[-1]
+
+    def report(self, conn, limit=50):
+        """Drift totals and the users with the largest drift"""
+        count, total = conn.execute('SELECT COUNT(*), COALESCE(SUM(ABS(drift)), 0) FROM balance_drift').fetchone()
+        columns = ('user_id', 'stored_balance', 'ledger_balance', 'drift', 'detected_at')
+        worst = conn.execute(f'''
+            SELECT {', '.join(columns)} FROM balance_drift ORDER BY ABS(drift) DESC LIMIT ?
+        ''', (limit,)).fetchall()
+        pending = conn.execute('SELECT COUNT(*) FROM balance_changes WHERE id > ?',
+                               (self.watermark(conn),)).fetchone()[0]
+        return {
+            'drifted_users': count,
+            'total_drift': round(total, 2),
+            'pending_changes': pending,
+            'users': [dict(zip(columns, row)) for row in worst],
+        }
+
+# Global reconciler instance
+reconciler = Reconciler(db, ledger)
@@ -0,0 +1,184 @@
+import unittest
+import tempfile
+import os
+import json
+import threading
+import sqlite3
+from unittest import mock
+from app import app, init_db, migrate_database, process_affiliate_commission
+from database import db, telemetry_db
+from ingestion import event_ingestor
+from affiliate_rollups import affiliate_rollups
+
+RAW_STATS = '''
+    SELECT COUNT(*), COALESCE(SUM(converted), 0), COALESCE(SUM(commission_earned), 0),
+           COUNT(CASE WHEN DATE(clicked_at) = DATE('now') THEN 1 END),
+           COUNT(CASE WHEN converted = 1 AND strftime('%Y-%m', clicked_at) = strftime('%Y-%m', 'now') THEN 1 END)
+    FROM affiliate_clicks WHERE user_id = ?
+'''
+
+class AffiliateRollupsTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up test database"""
+        event_ingestor.flush()
+        self.db_fd, app.config['DATABASE'] = tempfile.mkstemp()
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        init_db()
+        migrate_database()
+
+    def tearDown(self):
+        """Clean up test database"""
+        event_ingestor.flush()
+        os.close(self.db_fd)
+        try:
+            os.unlink(telemetry_db.path)
+            os.unlink(app.config['DATABASE'])
+        except:
+            pass
+
+    def assertMatchesRaw(self, user_id):
+        with telemetry_db.session() as conn:
+            stats = affiliate_rollups.user_stats(conn, user_id)
+            raw = conn.execute(RAW_STATS, (user_id,)).fetchone()
+        self.assertEqual(tuple(stats.values()), tuple(raw))
+        return stats
+
+    def test_ingested_clicks_are_rolled_up(self):
+        """Test each click batch advances the rollups in its own transaction"""
+        for product_id in ('AMZ001', 'AMZ001', 'ALI002'):
+            event_ingestor.emit('affiliate_click', 1, product_id, 'amazon')
+        event_ingestor.flush()
+
+        with telemetry_db.session() as conn:
+            self.assertEqual(affiliate_rollups.watermark(conn), 3)
+            rows = conn.execute('''
+                SELECT product_id, clicks FROM affiliate_stats_daily
+                WHERE user_id = 1 ORDER BY product_id
+            ''').fetchall()
+            hourly = conn.execute('SELECT SUM(clicks) FROM affiliate_stats_hourly').fetchone()[0]
+        self.assertEqual(rows, [('ALI002', 1), ('AMZ001', 2)])
+        self.assertEqual(hourly, 3)
+        self.assertEqual(self.assertMatchesRaw(1)['clicks_today'], 3)
+
+    def test_stats_include_unrolled_tail(self):
+        """Test clicks above the watermark are counted from the raw table"""
+        event_ingestor.emit('affiliate_click', 1, 'AMZ001', 'amazon')
+        event_ingestor.flush()
+        with telemetry_db.session() as conn:
+            conn.execute("INSERT INTO affiliate_clicks (user_id, product_id, platform) VALUES (1, 'AMZ001', 'amazon')")
+
+        self.assertEqual(self.assertMatchesRaw(1)['total_clicks'], 2)
+
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+        rv = self.app.get('/affiliate_stats')
+        self.assertEqual(rv.get_json()['total_clicks'], 2)
+
+    def test_conversions_update_rollups(self):
+        """Test commissions keep rolled-up and tail clicks consistent"""
+        event_ingestor.emit('affiliate_click', 1, 'AMZ001', 'amazon')
+        event_ingestor.emit('affiliate_click', 1, 'AMZ001', 'amazon')
+        event_ingestor.flush()
+        with telemetry_db.session() as conn:
+            conn.execute("INSERT INTO affiliate_clicks (user_id, product_id, platform) VALUES (1, 'AMZ001', 'amazon')")
+
+        with app.test_request_context():
+            self.assertTrue(process_affiliate_commission(1, 'AMZ001', 20.0, 0.10))
+        with app.test_request_context():
+            self.assertTrue(process_affiliate_commission(1, 'AMZ001', 50.0, 0.10))
+
+        stats = self.assertMatchesRaw(1)
+        self.assertEqual(stats['total_conversions'], 3)
+        self.assertAlmostEqual(stats['total_earned'], 15.0)
+
+        # A full rebuild from raw clicks lands on the same rows
+        with telemetry_db.session() as conn:
+            self.assertEqual(affiliate_rollups.roll_up(conn), 1)
+            conn.commit()
+            before = conn.execute('SELECT * FROM affiliate_stats_daily ORDER BY 1, 2, 3, 4').fetchall()
+            affiliate_rollups.rebuild(conn)
+            after = conn.execute('SELECT * FROM affiliate_stats_daily ORDER BY 1, 2, 3, 4').fetchall()
+            self.assertEqual(affiliate_rollups.watermark(conn), 3)
+        self.assertEqual([row[:6] for row in before], [row[:6] for row in after])
+        self.assertAlmostEqual(before[0][6], after[0][6])
+
+    def test_commission_converts_buffered_clicks_and_survives_telemetry_errors(self):
+        """Test a sale right after a click converts it, and telemetry errors keep the committed money"""
+        event_ingestor.emit('affiliate_click', 1, 'AMZ001', 'amazon')  # still buffered
+        with app.test_request_context():
+            self.assertTrue(process_affiliate_commission(1, 'AMZ001', 20.0, 0.10))
+        self.assertEqual(self.assertMatchesRaw(1)['total_conversions'], 1)
+
+        with mock.patch.object(affiliate_rollups, 'record_conversion', side_effect=sqlite3.OperationalError('locked')):
+            with app.test_request_context():
+                self.assertTrue(process_affiliate_commission(1, 'AMZ001', 20.0, 0.10))
+        with db.session() as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM transactions WHERE source = 'affiliate'").fetchone()[0], 2)
+
+    def test_partial_rebuild_repairs_recent_days(self):
+        """Test rebuilding from a date repairs drifted rows and folds the tail"""
+        with telemetry_db.session() as conn:
+            conn.execute('''
+                INSERT INTO affiliate_clicks (user_id, product_id, platform, clicked_at)
+                VALUES (1, 'OLD', 'amazon', '2020-01-01 10:00:00'), (1, 'NEW', 'amazon', CURRENT_TIMESTAMP)
+            ''')
+            conn.execute("INSERT INTO affiliate_stats_daily VALUES (1, DATE('now'), 'NEW', 'amazon', 99, 0, 0)")
+            conn.commit()
+            affiliate_rollups.rebuild(conn, since='2024-01-01')
+            rows = conn.execute('SELECT day, product_id, clicks FROM affiliate_stats_daily ORDER BY day').fetchall()
+        self.assertEqual([row[1:] for row in rows], [('OLD', 1), ('NEW', 1)])
+        self.assertMatchesRaw(1)
+
+    def test_stats_endpoint_answers_304_when_unchanged(self):
+        """Test the JSON stats carry an ETag and revalidate to 304"""
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+        rv = self.app.get('/affiliate_stats')
+        etag = rv.headers['ETag']
+        self.assertEqual(self.app.get('/affiliate_stats', headers={'If-None-Match': etag}).status_code, 304)
+
+        event_ingestor.emit('affiliate_click', 1, 'AMZ001', 'amazon')
+        event_ingestor.flush()
+        rv = self.app.get('/affiliate_stats', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.get_json()['total_clicks'], 1)
+
+    def test_stream_pushes_only_changed_fields(self):
+        """Test the SSE stream wakes on a committed click and sends a delta"""
+        app.config['AFFILIATE_STREAM_HEARTBEAT'] = 5
+        self.addCleanup(app.config.pop, 'AFFILIATE_STREAM_HEARTBEAT')
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+        rv = self.app.get('/affiliate_stats/stream', buffered=False)
+        self.assertEqual(rv.mimetype, 'text/event-stream')
+        events = (chunk.decode() for chunk in rv.response)
+
+        self.assertTrue(next(events).startswith('retry:'))
+        initial = next(events)
+        self.assertIn('"total_clicks": 0', initial)
+
+        event_ingestor.emit('affiliate_click', 1, 'AMZ001', 'amazon')
+        event_ingestor.flush()
+        delta = json.loads(next(events).split('data: ', 1)[1])
+        rv.close()
+        self.assertEqual(delta['total_clicks'], 1)
+        self.assertEqual(delta['clicks_today'], 1)
+        self.assertNotIn('total_earned', delta)
+
+    def test_streams_past_the_slot_cap_fall_back_to_polling(self):
+        """Test a worker holds at most AFFILIATE_STREAM_SLOTS streams and answers 204 beyond that"""
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+        with mock.patch('app.affiliate_stream_slots', threading.BoundedSemaphore(1)):
+            first = self.app.get('/affiliate_stats/stream', buffered=False)
+            self.assertEqual(first.status_code, 200)
+            self.assertEqual(self.app.get('/affiliate_stats/stream', buffered=False).status_code, 204)
+            first.close()
+
+            again = self.app.get('/affiliate_stats/stream', buffered=False)
+            self.assertEqual(again.status_code, 200)
+            again.close()
+
+if __name__ == '__main__':
+    unittest.main()
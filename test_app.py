@@ -2,7 +2,14 @@ import unittest
 import tempfile
 import os
 import sqlite3
-from app import app, init_db, migrate_database
+from app import (app, init_db, migrate_database, backfill_transaction_classification,
+                 rebuild_platform_rollups, rebuild_marketplace_search, fetch_users_page,
+                 fetch_marketplace_page, fetch_marketplace_facets, fetch_user_summary)
+from database import db, get_db, get_report_db
+from counters import PlatformCounters, platform_counters
+from passwords import PasswordHasher, password_hasher
+import hashlib
+from unittest import mock
 
 class DadaalTestCase(unittest.TestCase):
     def setUp(self):
@@ -11,6 +18,8 @@ class DadaalTestCase(unittest.TestCase):
         app.config['TESTING'] = True
         self.app = app.test_client()
         init_db()
+        migrate_database()
+        platform_counters.invalidate()
 
     def tearDown(self):
         """Clean up test database"""
@@ -45,6 +54,319 @@ class DadaalTestCase(unittest.TestCase):
         rv = self.app.get('/dashboard')
         self.assertEqual(rv.status_code, 302)  # Should redirect
 
+    def test_request_connection_is_pooled(self):
+        """Test requests reuse one tuned connection from the pool"""
+        with app.test_request_context('/'):
+            conn = get_db()
+            self.assertIs(conn, get_db())
+            self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            self.assertEqual(conn.execute('PRAGMA busy_timeout').fetchone()[0], 5000)
+            self.assertEqual(conn.execute('PRAGMA synchronous').fetchone()[0], 1)
+        with app.test_request_context('/'):
+            self.assertIs(get_db(), conn)
+
+    def test_teardown_commits_request_writes(self):
+        """Test request writes are committed when the request ends"""
+        with app.test_request_context('/'):
+            get_db().execute("INSERT INTO contact_messages (name, email, subject, message) VALUES ('a', 'a@b.co', 's', 'm')")
+        with db.session() as conn:
+            count = conn.execute('SELECT COUNT(*) FROM contact_messages').fetchone()[0]
+        self.assertEqual(count, 1)
+
+    def test_nested_immediate_leaves_outer_transaction_to_its_owner(self):
+        """Test db.immediate inside an open transaction neither commits nor rolls it back"""
+        insert = "INSERT INTO contact_messages (name, email, subject, message) VALUES (?, 'a@b.co', 's', 'm')"
+        with db.session() as conn:
+            conn.execute(insert, ('outer',))
+            with db.immediate(conn):
+                conn.execute(insert, ('kept',))
+            with self.assertRaises(ZeroDivisionError):
+                with db.immediate(conn):
+                    conn.execute(insert, ('undone',))
+                    1 / 0
+            self.assertTrue(conn.in_transaction)
+            conn.rollback()
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM contact_messages').fetchone()[0], 0)
+
+            conn.execute(insert, ('outer',))
+            with db.immediate(conn):
+                conn.execute(insert, ('kept',))
+        with db.session() as conn:
+            names = [row[0] for row in conn.execute('SELECT name FROM contact_messages ORDER BY id')]
+        self.assertEqual(names, ['outer', 'kept'])
+
+    def test_report_connection_is_read_only(self):
+        """Test admin reports read through a read-only connection that never blocks writers"""
+        with app.test_request_context('/'):
+            reader = get_report_db()
+            self.assertIsNot(reader, get_db())
+            with self.assertRaises(sqlite3.OperationalError):
+                reader.execute("INSERT INTO contact_messages (name, email, subject, message) VALUES ('a', 'a@b.co', 's', 'm')")
+
+            # A long report holding a read transaction does not stop a payment committing
+            reader.rollback()
+            reader.execute('BEGIN')
+            reader.execute('SELECT COUNT(*) FROM users').fetchone()
+            with db.session() as conn:
+                conn.execute("INSERT INTO users (name, email) VALUES ('Payer', 'payer@x.co')")
+
+    def test_readonly_fallback_is_not_pooled(self):
+        """Test the query-only fallback reader is closed on release and mode=ro is retried"""
+        with mock.patch.object(db, 'connect_readonly', side_effect=sqlite3.OperationalError):
+            fallback, key = db.acquire_readonly()
+        self.assertEqual(fallback.execute('PRAGMA query_only').fetchone()[0], 1)
+        db.release(fallback, key)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            fallback.execute('SELECT 1')
+
+        with mock.patch.object(db, 'connect_readonly', wraps=db.connect_readonly) as connect_readonly:
+            reader, key = db.acquire_readonly()
+            db.release(reader, key)
+        self.assertEqual(connect_readonly.call_count, 1)
+
+    def test_reports_read_backup_snapshot(self):
+        """Test REPORTS_SNAPSHOT serves reports from a copy refreshed with the backup API"""
+        fd, snapshot = tempfile.mkstemp()
+        os.close(fd)
+        app.config['REPORTS_SNAPSHOT'] = snapshot
+        self.addCleanup(app.config.__setitem__, 'REPORTS_SNAPSHOT', None)
+        self.addCleanup(os.unlink, snapshot)
+
+        with db.session() as conn:
+            conn.execute("INSERT INTO users (name, email) VALUES ('First', 'first@x.co')")
+        self.assertTrue(db.refresh_snapshot())
+        with db.session() as conn:
+            conn.execute("INSERT INTO users (name, email) VALUES ('Second', 'second@x.co')")
+
+        count = lambda: get_report_db().execute('SELECT COUNT(*) FROM users').fetchone()[0]
+        with app.test_request_context('/'):
+            self.assertEqual(count(), 1)
+        db.refresh_snapshot()
+        with app.test_request_context('/'):
+            self.assertEqual(count(), 2)
+
+    def test_platform_counters_shared_between_workers(self):
+        """Test counter increments are visible to every worker process"""
+        worker_a = PlatformCounters(db, ttl=60)
+        worker_b = PlatformCounters(db, ttl=60)
+        self.assertEqual(worker_b.get('total_earnings_cents'), 0)
+        with db.session() as conn:
+            worker_a.increment(conn, 'total_earnings_cents', 500)
+            self.assertEqual(worker_a.increment(conn, 'total_earnings_cents', 25), 525)
+        self.assertEqual(worker_b.get('total_earnings_cents'), 0)  # still cached
+        worker_b.invalidate()
+        self.assertEqual(worker_b.get('total_earnings_cents'), 525)
+
+    def test_track_referral_persists_earnings(self):
+        """Test referral tracking updates the database-backed counter"""
+        platform_counters.invalidate()
+        self.assertEqual(platform_counters.get('total_earnings_cents'), 0)
+        rv = self.app.post('/track_referral', json={'referral_code': 'DADAAL-1234', 'action': 'signup'})
+        self.assertEqual(rv.get_json()['earnings'], 5.0)
+        self.assertEqual(platform_counters.get('total_earnings_cents'), 500)
+
+    def test_counter_cache_only_sees_committed_increments(self):
+        """Test the cached counters drop an increment that rolls back and pick up one that commits"""
+        platform_counters.invalidate()
+        self.assertEqual(platform_counters.get('referral_count'), 0)
+        with self.assertRaises(ZeroDivisionError):
+            with db.session() as conn:
+                self.assertEqual(platform_counters.increment(conn, 'referral_count', 1), 1)
+                1 / 0
+        self.assertEqual(platform_counters.get('referral_count'), 0)
+        with db.session() as conn:
+            platform_counters.increment(conn, 'referral_count', 2)
+            self.assertEqual(platform_counters.get('referral_count'), 0)
+        self.assertEqual(platform_counters.get('referral_count'), 2)
+
+    def test_backfill_classifies_legacy_transactions(self):
+        """Test the resumable backfill fills payment_method and source"""
+        with db.session() as conn:
+            conn.executemany('''
+                INSERT INTO transactions (user_id, amount, type, description, reference_id)
+                VALUES (1, ?, ?, ?, ?)
+            ''', [(0.5, 'earning', 'Commission from $10.0 payment via Mobile Money', 'MM-1'),
+                  (19.99, 'premium', 'Premium subscription - monthly plan', 'STRIPE-1'),
+                  (1.2, 'earning', 'Affiliate commission - Product AMZ001', None),
+                  (0.25, 'bonus', 'Sharing bonus - whatsapp', None)])
+
+        self.assertEqual(backfill_transaction_classification(batch_size=3), 4)
+        self.assertEqual(backfill_transaction_classification(batch_size=3), 0)  # resumes at the end
+
+        with db.session() as conn:
+            rows = conn.execute('SELECT payment_method, source FROM transactions ORDER BY id').fetchall()
+        self.assertEqual(rows, [('mobile_money', 'payment_commission'), ('credit_card', 'premium'),
+                                (None, 'affiliate'), (None, 'share_bonus')])
+
+    def test_rollups_follow_every_write(self):
+        """Test rollup tables track inserts, updates and deletes"""
+        with db.session() as conn:
+            conn.execute("INSERT INTO users (name, email, total_earnings) VALUES ('A', 'a@x.co', 0)")
+            conn.execute("INSERT INTO users (name, email, total_earnings) VALUES ('B', 'b@x.co', 0)")
+            conn.execute("UPDATE users SET total_earnings = total_earnings + 2.5 WHERE email = 'a@x.co'")
+            conn.execute("UPDATE users SET status = 'suspended' WHERE email = 'b@x.co'")
+            conn.execute("INSERT INTO transactions (user_id, amount, type) VALUES (1, 2.5, 'earning')")
+            conn.execute("INSERT INTO transactions (user_id, amount, type) VALUES (2, 1.0, 'bonus')")
+            conn.execute("DELETE FROM transactions WHERE type = 'bonus'")
+
+        with db.session() as conn:
+            users = dict((row[0], row[1:]) for row in conn.execute('SELECT * FROM user_status_totals'))
+            totals = conn.execute('''
+                SELECT type, SUM(tx_count), SUM(amount_total), SUM(amount_total_cents) FROM daily_transaction_totals
+                GROUP BY type ORDER BY type
+            ''').fetchall()
+        # REAL-only writes still reach the integer columns and their rollups
+        self.assertEqual(users['active'], (1, 2.5, 250))
+        self.assertEqual(users['suspended'], (1, 0, 0))
+        self.assertEqual(totals, [('bonus', 0, 0, 0), ('earning', 1, 2.5, 250)])
+
+        with db.session() as conn:
+            conn.execute('UPDATE daily_transaction_totals SET tx_count = 99')
+        with db.session() as conn:
+            rebuild_platform_rollups(conn)
+            rebuilt = conn.execute('SELECT type, tx_count, amount_total FROM daily_transaction_totals').fetchall()
+        self.assertEqual(rebuilt, [('earning', 1, 2.5)])
+
+    def test_user_summary_follows_writes(self):
+        """Test the dashboard read model tracks balance, referrals and recent transactions"""
+        with db.session() as conn:
+            conn.execute("INSERT INTO users (name, email, referral_code) VALUES ('Referrer', 'r@x.co', 'DADAAL-R')")
+            conn.execute("INSERT INTO users (name, email) VALUES ('Friend', 'f@x.co')")
+            conn.execute('''
+                INSERT INTO referrals (referrer_id, referred_id, commission_earned, status) VALUES (1, 2, 5, 'completed')
+            ''')
+            conn.execute('UPDATE users SET total_earnings = total_earnings + 5 WHERE id = 1')
+            conn.executemany('''
+                INSERT INTO transactions (user_id, amount, type, description, created_at) VALUES (1, ?, 'earning', ?, ?)
+            ''', [(i, f'Tx {i}', f'2025-01-01 00:00:{i:02d}') for i in range(12)])
+
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+        self.assertTrue(self.app.post('/track_share', json={'platform': 'whatsapp'}).get_json()['success'])
+
+        with db.session() as conn:
+            summary = fetch_user_summary(conn.cursor(), 1)
+        self.assertEqual((summary['balance'], summary['referral_count'], summary['referral_commission']), (5.25, 1, 5))
+        self.assertEqual(len(summary['recent_transactions']), 10)
+        self.assertEqual(summary['recent_transactions'][0][3], 'Sharing bonus - whatsapp')
+        self.assertEqual(summary['recent_transactions'][1][3], 'Tx 11')
+
+        rv = self.app.get('/dashboard')
+        self.assertIn('Referrer', rv.get_data(as_text=True))
+
+        with db.session() as conn:
+            conn.execute('DELETE FROM referrals')
+            conn.execute('DELETE FROM transactions WHERE amount >= 2')
+            summary = fetch_user_summary(conn.cursor(), 1)
+            self.assertEqual((summary['referral_count'], summary['referral_commission']), (0, 0))
+            self.assertEqual([tx[1] for tx in summary['recent_transactions']], [0.25, 1, 0])
+            conn.execute('DELETE FROM users WHERE id = 1')
+            self.assertIsNone(fetch_user_summary(conn.cursor(), 1))
+
+    def test_admin_user_pages_use_keyset_cursor(self):
+        """Test admin user listing pages through every user exactly once"""
+        with db.session() as conn:
+            conn.executemany('''
+                INSERT INTO users (name, email, status, created_at) VALUES (?, ?, ?, '2025-01-01 00:00:00')
+            ''', [(f'User {i}', f'user{i:02d}@x.co', 'active' if i % 3 else 'suspended') for i in range(25)])
+            conn.execute("INSERT INTO referrals (referrer_id, referred_id, status) VALUES (1, 2, 'completed')")
+
+            seen, after = [], None
+            while True:
+                rows, after = fetch_users_page(conn.cursor(), status='active', after=after, limit=7)
+                seen.extend(row[0] for row in rows)
+                if not after:
+                    break
+            self.assertEqual(len(seen), len(set(seen)))
+            self.assertEqual(len(seen), 16)
+            self.assertEqual(seen, sorted(seen, reverse=True))
+
+            rows, _ = fetch_users_page(conn.cursor(), email_prefix='user0', sort='oldest')
+            self.assertEqual([row[2] for row in rows][:2], ['user00@x.co', 'user01@x.co'])
+            self.assertEqual(rows[0][9], 1)  # precomputed referral count
+
+    def test_login_upgrades_legacy_password_hash(self):
+        """Test unversioned hashes still verify and are rehashed on login"""
+        salt = 'a' * 32
+        legacy = salt + hashlib.pbkdf2_hmac('sha256', b'password123', salt.encode(), 100000).hex()
+        with db.session() as conn:
+            conn.execute("INSERT INTO users (name, email, password_hash) VALUES ('Ali', 'ali@x.co', ?)", (legacy,))
+
+        rv = self.app.post('/login', data={'email': 'ali@x.co', 'password': 'password123'})
+        self.assertEqual(rv.status_code, 302)
+        with db.session() as conn:
+            upgraded = conn.execute("SELECT password_hash FROM users WHERE email = 'ali@x.co'").fetchone()[0]
+        self.assertTrue(upgraded.startswith('pbkdf2_sha256$'))
+        self.assertFalse(password_hasher.needs_rehash(upgraded))
+        self.assertTrue(password_hasher.verify(upgraded, 'password123'))
+
+    def test_full_hashing_queue_returns_503(self):
+        """Test logins are shed with 503 when the hashing queue is full"""
+        with db.session() as conn:
+            conn.execute("INSERT INTO users (name, email, password_hash) VALUES ('Ali', 'ali@x.co', ?)",
+                         (PasswordHasher(workers=0).hash('password123'),))
+
+        with mock.patch.object(password_hasher, '_slots', None):  # no free hashing slots
+            rv = self.app.post('/login', data={'email': 'ali@x.co', 'password': 'password123'})
+        self.assertEqual(rv.status_code, 503)
+        self.assertEqual(rv.headers['Retry-After'], '1')
+
+    def test_hashing_pool_shares_the_server_budget_without_forking(self):
+        """Test each gunicorn worker gets its share of the hashing budget and a non-fork pool"""
+        with mock.patch.multiple('passwords', HASH_BUDGET=8, WEB_CONCURRENCY=2):
+            hasher = PasswordHasher()
+        self.addCleanup(hasher.shutdown)
+        self.assertEqual((hasher.workers, hasher.max_pending), (4, 16))
+        with mock.patch.multiple('passwords', HASH_BUDGET=1, WEB_CONCURRENCY=4):
+            self.assertEqual(PasswordHasher().workers, 1)
+
+        self.assertTrue(hasher.verify(hasher.hash('password123'), 'password123'))
+        self.assertIn(hasher._pool._mp_context.get_start_method(), ('forkserver', 'spawn'))
+
+    def test_marketplace_facets_follow_item_changes(self):
+        """Test facet counts track inserts, edits and delistings without a rescan"""
+        with db.session() as conn:
+            conn.execute("INSERT INTO users (name, email) VALUES ('Seller', 'seller@x.co')")
+            conn.executemany('''
+                INSERT INTO marketplace_items (seller_id, title, description, price, category) VALUES (1, ?, ?, ?, ?)
+            ''', [('Logo design', 'Custom logo', 25, 'graphics'), ('Python course', 'Learn Python', 80, 'courses'),
+                  ('Banner pack', 'Social banners', 8, 'graphics')])
+            conn.execute("UPDATE marketplace_items SET status = 'sold' WHERE title = 'Banner pack'")
+            conn.execute("UPDATE marketplace_items SET price = 120 WHERE title = 'Python course'")
+            facets = fetch_marketplace_facets(conn.cursor())
+            self.assertEqual(facets['category'], [('courses', 1), ('graphics', 1)])
+            self.assertEqual(facets['price_band'], [('10-50', 1), ('100-500', 1)])
+            conn.commit()
+
+            rebuild_marketplace_search(conn)
+            self.assertEqual(fetch_marketplace_facets(conn.cursor()), facets)
+
+    def test_marketplace_search_pages_in_sql(self):
+        """Test marketplace search, price filters and keyset pages"""
+        with db.session() as conn:
+            conn.execute("INSERT INTO users (name, email) VALUES ('Seller', 'seller@x.co')")
+            conn.executemany('''
+                INSERT INTO marketplace_items (seller_id, title, description, price, category) VALUES (1, ?, ?, ?, ?)
+            ''', [(f'Ebook {i}', 'Marketing guide' if i % 2 else 'Cooking recipes', i, 'ebooks') for i in range(1, 31)])
+
+            seen, after = [], None
+            while True:
+                rows, after = fetch_marketplace_page(conn.cursor(), query='market', price_band='10-50',
+                                                     sort='price_low', after=after, limit=4)
+                seen.extend(row[4] for row in rows)
+                if not after:
+                    break
+            self.assertEqual(seen, [i for i in range(11, 31) if i % 2])
+            self.assertEqual(rows[-1][9], 'Seller')
+
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+        rv = self.app.get('/marketplace?q=cooking&sort=price_high')
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn(b'Ebook 30', rv.data)
+        self.assertNotIn(b'Ebook 29', rv.data)
+        self.assertIn(b'ebooks (30)', rv.data)
+
 if __name__ == '__main__':
     print("🧪 Starting Dadaal App Tests...")
     unittest.main()
\ No newline at end of file
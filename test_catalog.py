@@ -0,0 +1,214 @@
+import unittest
+import tempfile
+import os
+import threading
+import time
+from unittest import mock
+from app import app, init_db, migrate_database, fetch_catalog_page, CATALOG_SORTS
+from database import db
+from catalog import CatalogAggregator, CatalogSync, FakeProviderServer, fetch_json_products, catalog
+
+ALIBABA = [{'id': 'ALB900', 'name': 'Fake Solar Lantern', 'price': 9.5, 'commission_rate': 0.1,
+            'supplier': 'Test Supplier', 'image_url': '', 'affiliate_url': 'https://example.com/a',
+            'category': 'Electronics'}]
+AMAZON = [{'id': 'AMZ900', 'name': 'Fake Kindle Reader', 'price': 99.0, 'commission_rate': 0.04,
+           'brand': 'Test', 'image_url': '', 'affiliate_url': 'https://example.com/b',
+           'category': 'Electronics', 'rating': 4.2, 'reviews': 10}]
+
+class CatalogAggregatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeProviderServer({'alibaba': ALIBABA, 'amazon': AMAZON}).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def aggregator(self, deadline=2.0, **options):
+        aggregator = CatalogAggregator(**options)
+        for name in ('alibaba', 'amazon'):
+            url = f'{self.server.url}/{name}'
+            aggregator.register(name, lambda url=url, **params: fetch_json_products(url, params, 5), deadline)
+        return aggregator
+
+    def test_providers_are_fetched_concurrently(self):
+        """Test page latency is the slowest provider, not the sum"""
+        self.server.delays = {'alibaba': 0.3, 'amazon': 0.3}
+        started = time.monotonic()
+        results = self.aggregator().get_many({'alibaba': {}, 'amazon': {}})
+        self.assertLess(time.monotonic() - started, 0.55)
+        self.assertEqual(results['alibaba'][0]['id'], 'ALB900')
+        self.assertEqual(results['amazon'][0]['id'], 'AMZ900')
+
+    def test_slow_provider_misses_deadline_then_fills_cache(self):
+        """Test a provider past its deadline renders empty and warms the cache"""
+        self.server.delays = {'amazon': 0.4}
+        aggregator = self.aggregator(deadline=0.1)
+        self.assertEqual(aggregator.get('amazon'), [])
+        self.assertEqual(aggregator.stats()['timeouts'], 1)
+
+        time.sleep(0.6)
+        self.assertEqual(aggregator.get('amazon')[0]['id'], 'AMZ900')
+        self.assertEqual(aggregator.stats()['hits'], 1)
+
+    def test_concurrent_misses_share_one_fetch(self):
+        """Test simultaneous misses for one key hit the provider once"""
+        self.server.delays = {'alibaba': 0.2}
+        aggregator = self.aggregator()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(aggregator.get('alibaba', category='x')))
+                   for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.server.requests['alibaba'], 1)
+        self.assertTrue(all(result == ALIBABA for result in results))
+
+    def test_stale_entries_are_served_while_revalidating(self):
+        """Test expired entries answer immediately and refresh in the background"""
+        aggregator = self.aggregator(ttl=0, max_entries=2)
+        aggregator.get('amazon')
+        self.server.delays = {'amazon': 0.3}
+        self.server.catalogs['amazon'] = AMAZON * 2
+
+        started = time.monotonic()
+        self.assertEqual(aggregator.get('amazon'), AMAZON)
+        self.assertLess(time.monotonic() - started, 0.2)
+        time.sleep(0.5)
+        self.assertEqual(len(aggregator.get('amazon')), 2)
+
+        for category in ('a', 'b', 'c'):
+            aggregator.get('alibaba', category=category)
+        self.assertEqual(aggregator.stats()['entries'], 2)
+
+    def test_real_affiliate_uses_partner_endpoints(self):
+        """Test the affiliate page renders products from the configured partner APIs"""
+        db_fd, app.config['DATABASE'] = tempfile.mkstemp()
+        app.config['TESTING'] = True
+        init_db()
+        migrate_database()
+        catalog.clear()
+        self.addCleanup(catalog.clear)
+        try:
+            client = app.test_client()
+            with client.session_transaction() as sess:
+                sess['user_id'] = 1
+            with mock.patch.dict(os.environ, {'ALIBABA_API_URL': f'{self.server.url}/alibaba',
+                                              'AMAZON_API_URL': f'{self.server.url}/amazon'}):
+                rv = client.get('/real_affiliate')
+            self.assertIn(b'Fake Solar Lantern', rv.data)
+            self.assertIn(b'Fake Kindle Reader', rv.data)
+        finally:
+            os.close(db_fd)
+            os.unlink(app.config['DATABASE'])
+
+class CatalogMirrorTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up test database"""
+        self.db_fd, app.config['DATABASE'] = tempfile.mkstemp()
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        init_db()
+        migrate_database()
+        self.feeds = {'amazon': [dict(product, id=f'AMZ{i:04d}', name=f'{name} {i}', brand=brand,
+                                      commission_rate=round(0.01 * (i % 20), 2), price=10 + i)
+                                 for i, (name, brand) in enumerate([('Wireless Earbuds', 'Sony'),
+                                                                    ('Espresso Machine', 'Breville'),
+                                                                    ('Trail Running Shoes', 'Salomon')] * 1000)
+                                 for product in AMAZON]}
+        aggregator = CatalogAggregator()
+        aggregator.register('amazon', lambda: self.feeds['amazon'])
+        self.sync = CatalogSync(db, aggregator)
+
+    def tearDown(self):
+        """Clean up test database"""
+        os.close(self.db_fd)
+        try:
+            os.unlink(app.config['DATABASE'])
+        except:
+            pass
+
+    def test_sync_writes_only_changed_products(self):
+        """Test content hashes skip unchanged products and retire removed ones"""
+        first = self.sync.run_once()['amazon']
+        self.assertEqual((first['inserted'], first['updated'], first['unchanged']), (3000, 0, 0))
+
+        self.feeds['amazon'][0] = dict(self.feeds['amazon'][0], price=1.0)
+        removed = self.feeds['amazon'].pop()
+        second = self.sync.run_once()['amazon']
+        self.assertEqual(second, {'inserted': 0, 'updated': 1, 'unchanged': 2998, 'deactivated': 1})
+
+        with db.session() as conn:
+            active = conn.execute('SELECT active FROM catalog_products WHERE external_id = ?',
+                                  (removed['id'],)).fetchone()[0]
+        self.assertEqual(active, 0)
+
+    def test_empty_or_truncated_feed_keeps_products_active(self):
+        """Test a provider hiccup retires nothing, while a real delisting still does"""
+        self.sync.run_once()
+        feed = self.feeds['amazon']
+        for hiccup in ([], feed[:1000]):
+            self.feeds['amazon'] = hiccup
+            self.assertEqual(self.sync.run_once()['amazon']['deactivated'], 0)
+        with db.session() as conn:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM catalog_products WHERE active = 1').fetchone()[0], 3000)
+
+        self.feeds['amazon'] = feed[:2000]
+        self.assertEqual(self.sync.run_once()['amazon']['deactivated'], 1000)
+
+    def test_search_uses_fts_and_keyset_pages(self):
+        """Test free-text search, filters and cursor pages over the mirror"""
+        self.sync.run_once()
+        with db.session() as conn:
+            cursor = conn.cursor()
+            # Work per page in VM steps (deterministic, unlike timing): deeper pages cost no more
+            steps = [0]
+            conn.set_progress_handler(lambda: steps.__setitem__(-1, steps[-1] + 1), 100)
+            page, after = fetch_catalog_page(cursor, query='espres brev', min_commission=0.15, limit=50)
+            seen = {row['id'] for row in page}
+            while after:
+                steps.append(0)
+                page, after = fetch_catalog_page(cursor, query='espres brev', min_commission=0.15,
+                                                 after=after, limit=50)
+                self.assertFalse(seen & {row['id'] for row in page})
+                seen |= {row['id'] for row in page}
+            conn.set_progress_handler(None, 0)
+
+            expected = conn.execute('''
+                SELECT COUNT(*) FROM catalog_products
+                WHERE name LIKE 'Espresso%' AND commission_rate >= 0.15
+            ''').fetchone()[0]
+        self.assertEqual(len(seen), expected)
+        self.assertGreater(len(steps), 2)
+        self.assertLessEqual(steps[-1], steps[1])
+
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+        data = self.app.get('/affiliate/products?q=salomon&sort=price_low&limit=5').get_json()
+        self.assertEqual(len(data['products']), 5)
+        self.assertEqual(data['products'][0]['brand'], 'Salomon')
+        self.assertEqual([p['price'] for p in data['products']], sorted(p['price'] for p in data['products']))
+        self.assertIsNotNone(data['next_cursor'])
+
+    def test_products_without_sort_keys_page_through(self):
+        """Test products missing a price or commission are stored as 0 and every page is reachable"""
+        for product in self.feeds['amazon'][::2]:
+            del product['price'], product['commission_rate']
+        self.sync.run_once()
+        with db.session() as conn:
+            missing = conn.execute('''
+                SELECT COUNT(*) FROM catalog_products WHERE price IS NULL OR commission_rate IS NULL
+            ''').fetchone()[0]
+            self.assertEqual(missing, 0)
+            cursor = conn.cursor()
+            for sort in CATALOG_SORTS:
+                seen, after = set(), None
+                while True:
+                    page, after = fetch_catalog_page(cursor, query='wireless', sort=sort, after=after, limit=200)
+                    seen |= {row['id'] for row in page}
+                    if not after:
+                        break
+                self.assertEqual(len(seen), 1000, sort)
+
+if __name__ == '__main__':
+    unittest.main()
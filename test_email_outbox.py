@@ -0,0 +1,83 @@
+import unittest
+import tempfile
+import os
+import socket
+from app import app, init_db, migrate_database, hash_password
+from database import db
+from email_outbox import EmailOutbox, DebugSMTPServer
+
+class EmailOutboxTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up test database and a local SMTP stand-in"""
+        self.db_fd, app.config['DATABASE'] = tempfile.mkstemp()
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        init_db()
+        migrate_database()
+
+        self.smtp = DebugSMTPServer().start()
+        self.env = {'SMTP_SERVER': self.smtp.host, 'SMTP_PORT': str(self.smtp.port), 'SMTP_STARTTLS': '0'}
+        self.saved_env = {key: os.environ.get(key) for key in self.env}
+        os.environ.update(self.env)
+        self.outbox = EmailOutbox(db)
+
+    def tearDown(self):
+        """Clean up test database and SMTP server"""
+        self.outbox.stop()
+        self.smtp.stop()
+        for key, value in self.saved_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        os.close(self.db_fd)
+        try:
+            os.unlink(app.config['DATABASE'])
+        except:
+            pass
+
+    def outbox_rows(self):
+        with db.session() as conn:
+            return conn.execute('SELECT recipient, status, attempts FROM email_outbox ORDER BY id').fetchall()
+
+    def test_request_only_queues_email(self):
+        """Test forgot_password inserts an outbox row instead of talking SMTP"""
+        with db.session() as conn:
+            conn.execute("INSERT INTO users (name, email, password_hash) VALUES ('Ali', 'ali@x.co', ?)",
+                         (hash_password('password123'),))
+
+        rv = self.app.post('/forgot_password', data={'email': 'ali@x.co'})
+        self.assertEqual(rv.status_code, 302)
+        self.assertEqual(self.outbox_rows(), [('ali@x.co', 'pending', 0)])
+        self.assertEqual(self.smtp.messages, [])
+
+        self.assertEqual(self.outbox.run_once(), 1)
+        self.assertEqual(self.outbox_rows(), [('ali@x.co', 'sent', 0)])
+        self.assertIn('reset_password', self.smtp.messages[0]['data'])
+
+    def test_batch_reuses_one_smtp_session(self):
+        """Test a batch of emails is sent over a single SMTP connection"""
+        with db.session() as conn:
+            for i in range(5):
+                self.outbox.enqueue(conn, f'user{i}@x.co', 'Subject', 'Body')
+
+        self.assertEqual(self.outbox.run_once(), 5)
+        self.assertEqual(len(self.smtp.messages), 5)
+        self.assertEqual(self.smtp.connections, 1)
+
+    def test_failed_send_is_retried_with_backoff(self):
+        """Test SMTP failures reschedule the email instead of losing it"""
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            os.environ['SMTP_PORT'] = str(sock.getsockname()[1])  # nothing listening
+
+        with db.session() as conn:
+            self.outbox.enqueue(conn, 'ali@x.co', 'Subject', 'Body')
+
+        self.assertEqual(self.outbox.run_once(), 0)
+        self.assertEqual(self.outbox_rows(), [('ali@x.co', 'pending', 1)])
+        self.assertEqual(self.outbox.run_once(), 0)  # backing off, not due yet
+        self.assertEqual(self.outbox_rows(), [('ali@x.co', 'pending', 1)])
+
+if __name__ == '__main__':
+    unittest.main()
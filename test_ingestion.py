@@ -0,0 +1,120 @@
+import unittest
+import tempfile
+import os
+from app import app, init_db, migrate_database
+from database import db, telemetry_db, get_report_db
+from ingestion import EventIngestor, event_ingestor
+from affiliate_rollups import affiliate_rollups
+
+class EventIngestionTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up test database"""
+        event_ingestor.flush()
+        self.db_fd, app.config['DATABASE'] = tempfile.mkstemp()
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        init_db()
+        migrate_database()
+
+    def tearDown(self):
+        """Clean up test database"""
+        event_ingestor.flush()
+        os.close(self.db_fd)
+        try:
+            os.unlink(telemetry_db.path)
+            os.unlink(app.config['DATABASE'])
+        except:
+            pass
+
+    def count(self, table):
+        with telemetry_db.session() as conn:
+            return conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+    def test_click_route_is_buffered(self):
+        """Test clicks are queued by the route and written by a flush"""
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+        for _ in range(3):
+            rv = self.app.post('/track_affiliate_click', json={'product_id': 'AMZ001', 'platform': 'amazon'})
+            self.assertTrue(rv.get_json()['success'])
+
+        event_ingestor.flush()
+        self.assertEqual(self.count('affiliate_clicks'), 3)
+
+    def test_burst_is_written_in_one_transaction(self):
+        """Test a burst of mixed events costs a single flush"""
+        ingestor = EventIngestor(telemetry_db, flush_interval=60, batch_size=1000)
+        for i in range(300):
+            ingestor.emit('affiliate_click', 1, f'P{i}', 'amazon')
+            ingestor.emit('share', 1, 'whatsapp', 'DADAAL-1')
+            ingestor.emit('activity', 1, 'share', 'Shared on whatsapp')
+        ingestor.stop()
+
+        self.assertEqual(ingestor.stats()['flushes'], 1)
+        self.assertEqual(ingestor.stats()['written'], 900)
+        self.assertEqual(self.count('affiliate_clicks'), 300)
+        self.assertEqual(self.count('shares'), 300)
+        self.assertEqual(self.count('user_activity_logs'), 300)
+
+    def test_full_queue_drops_and_reports_backpressure(self):
+        """Test events beyond the queue bound are dropped and counted"""
+        ingestor = EventIngestor(telemetry_db, flush_interval=60, max_queue=5)
+        ingestor._ensure_started = lambda: None  # keep the writer thread from draining
+        results = [ingestor.emit('share', 1, 'whatsapp', None) for _ in range(8)]
+
+        self.assertEqual(results.count(False), 3)
+        stats = ingestor.stats()
+        self.assertEqual((stats['queued'], stats['dropped'], stats['queue_utilization']), (5, 3, 1.0))
+        ingestor.flush()
+        self.assertEqual(self.count('shares'), 5)
+
+    def test_telemetry_lock_does_not_block_payments(self):
+        """Test a held telemetry write lock leaves the main database writable"""
+        with telemetry_db.session() as telemetry:
+            telemetry.execute('BEGIN IMMEDIATE')
+            telemetry.execute("INSERT INTO shares (user_id, platform) VALUES (1, 'whatsapp')")
+            with db.session() as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute("INSERT INTO users (name, email) VALUES ('Payer', 'payer@x.co')")
+
+        # Reports still join across both files
+        event_ingestor.emit('activity', 1, 'login', 'Logged in')
+        event_ingestor.flush()
+        with app.test_request_context('/'):
+            row = get_report_db().execute('''
+                SELECT u.name, l.activity_type FROM user_activity_logs l JOIN users u ON u.id = l.user_id
+            ''').fetchone()
+        self.assertEqual(row, ('Payer', 'login'))
+
+    def test_migration_moves_legacy_telemetry_rows(self):
+        """Test rows left in the main file move to the telemetry file exactly once"""
+        with db.session() as conn:
+            conn.execute('''
+                CREATE TABLE affiliate_clicks (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, product_id TEXT NOT NULL,
+                    platform TEXT NOT NULL, clicked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            conn.executemany("INSERT INTO affiliate_clicks (user_id, product_id, platform) VALUES (1, ?, 'amazon')",
+                             [(f'P{i}',) for i in range(12)])
+            conn.execute('CREATE TABLE shares (id INTEGER PRIMARY KEY, user_id INTEGER, platform TEXT NOT NULL)')
+            conn.execute("INSERT INTO shares (user_id, platform) VALUES (1, 'whatsapp')")
+            # Back to the version just before the move
+            conn.execute('PRAGMA user_version = 3')
+        with telemetry_db.session() as telemetry:
+            # Part of a previous, interrupted move
+            telemetry.execute("INSERT INTO affiliate_clicks (id, user_id, product_id, platform) VALUES (1, 1, 'P0', 'amazon')")
+
+        migrate_database()
+
+        with db.session() as conn:
+            left = conn.execute('''
+                SELECT COUNT(*) FROM sqlite_master WHERE name IN ('affiliate_clicks', 'shares')
+            ''').fetchone()[0]
+        self.assertEqual(left, 0)
+        self.assertEqual((self.count('affiliate_clicks'), self.count('shares')), (12, 1))
+        with telemetry_db.session() as telemetry:
+            self.assertEqual(affiliate_rollups.user_stats(telemetry, 1)['total_clicks'], 12)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import unittest
+import tempfile
+import os
+import threading
+from app import app, init_db, migrate_database
+from database import db
+from inventory import inventory
+
+class InventoryTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up test database with one partner and one product"""
+        self.db_fd, app.config['DATABASE'] = tempfile.mkstemp()
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        init_db()
+        migrate_database()
+        with db.session() as conn:
+            conn.execute("INSERT INTO users (name, email) VALUES ('Partner', 'partner@x.co')")
+            conn.execute("INSERT INTO users (name, email) VALUES ('Buyer', 'buyer@x.co')")
+            conn.execute('''
+                INSERT INTO wholesale_partners (user_id, company_name, contact_person, business_email,
+                                                business_type, product_category, status)
+                VALUES (1, 'Hodan Trading', 'Hodan', 'partner@x.co', 'retail', 'energy', 'approved')
+            ''')
+            self.product_id = conn.execute('''
+                INSERT INTO wholesale_products (partner_id, product_name, price, category, sku, stock_quantity, commission_rate)
+                VALUES (1, 'Solar Panel 100W', 40.0, 'energy', 'SOL-100', 50, 0.10)
+            ''').lastrowid
+
+    def tearDown(self):
+        """Clean up test database"""
+        os.close(self.db_fd)
+        try:
+            os.unlink(app.config['DATABASE'])
+        except:
+            pass
+
+    def scalar(self, sql, params=()):
+        with db.session() as conn:
+            return conn.execute(sql, params).fetchone()[0]
+
+    def test_concurrent_buyers_never_oversell(self):
+        """Test many threads buying one SKU sell exactly the stock on hand"""
+        def buyer():
+            client = app.test_client()
+            with client.session_transaction() as sess:
+                sess['user_id'] = 2
+            for _ in range(10):
+                client.post('/wholesale/buy_product', data={'product_id': self.product_id, 'quantity': 1})
+
+        threads = [threading.Thread(target=buyer) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.scalar('SELECT stock_quantity FROM wholesale_products WHERE id = ?', (self.product_id,)), 0)
+        self.assertEqual(self.scalar('SELECT SUM(quantity) FROM wholesale_sales'), 50)
+        self.assertAlmostEqual(self.scalar('SELECT total_earnings FROM users WHERE id = 1'), 200.0)
+        self.assertEqual(self.scalar("SELECT COUNT(*) FROM transactions WHERE source = 'wholesale'"), 50)
+
+    def test_reservations_hold_confirm_and_expire(self):
+        """Test held stock is confirmed by checkout or returned on expiry"""
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 2
+        first = self.app.post('/wholesale/reserve', json={'product_id': self.product_id, 'quantity': 30}).get_json()
+        self.assertTrue(first['success'])
+        over = self.app.post('/wholesale/reserve', json={'product_id': self.product_id, 'quantity': 30}).get_json()
+        self.assertFalse(over['success'])
+
+        second = self.app.post('/wholesale/reserve', json={'product_id': self.product_id, 'quantity': 20}).get_json()
+        rv = self.app.post(f"/wholesale/reservations/{first['reservation_id']}/checkout").get_json()
+        self.assertEqual(rv, {'success': True, 'commission': 120.0})
+        self.assertEqual(self.scalar('SELECT stock_quantity FROM wholesale_products'), 0)
+
+        # Abandon the second hold; expiry hands its stock back exactly once
+        with db.session() as conn:
+            conn.execute("UPDATE stock_reservations SET expires_at = datetime('now', '-1 minute') WHERE id = ?",
+                         (second['reservation_id'],))
+            conn.commit()
+            with db.immediate(conn):
+                self.assertEqual(inventory.expire_reservations(conn), 1)
+            with db.immediate(conn):
+                self.assertEqual(inventory.expire_reservations(conn), 0)
+        self.assertEqual(self.scalar('SELECT stock_quantity FROM wholesale_products'), 20)
+
+        rv = self.app.post(f"/wholesale/reservations/{second['reservation_id']}/checkout").get_json()
+        self.assertFalse(rv['success'])
+        self.assertEqual(self.scalar('SELECT COUNT(*) FROM wholesale_sales'), 1)
+
+    def test_cart_order_commits_every_line_or_none(self):
+        """Test a cart is one order, and one bad line leaves nothing written"""
+        with db.session() as conn:
+            second_id = conn.execute('''
+                INSERT INTO wholesale_products (partner_id, product_name, price, category, sku, stock_quantity, commission_rate)
+                VALUES (1, 'Battery 12V', 25.0, 'energy', 'BAT-12', 5, 0.20)
+            ''').lastrowid
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 2
+
+        rv = self.app.post('/wholesale/orders', json={'items': [
+            {'product_id': self.product_id, 'quantity': 2},
+            {'product_id': second_id, 'quantity': 6},
+            {'product_id': 999, 'quantity': 1},
+        ]}).get_json()
+        self.assertFalse(rv['success'])
+        self.assertEqual(rv['lines'], {str(second_id): 'insufficient_stock', '999': 'not_found'})
+        self.assertEqual(self.scalar('SELECT stock_quantity FROM wholesale_products WHERE id = ?', (self.product_id,)), 50)
+        self.assertEqual(self.scalar('SELECT COUNT(*) FROM wholesale_sales'), 0)
+
+        rv = self.app.post('/wholesale/orders', json={'items': [
+            {'product_id': self.product_id, 'quantity': 2},
+            {'product_id': second_id, 'quantity': 4},
+            {'product_id': self.product_id, 'quantity': 1},
+        ]}).get_json()
+        self.assertTrue(rv['success'])
+        self.assertAlmostEqual(rv['total_amount'], 220.0)
+        self.assertAlmostEqual(rv['commission_amount'], 32.0)
+        self.assertEqual(self.scalar('SELECT COUNT(*) FROM wholesale_sales WHERE order_id = ?', (rv['order_id'],)), 2)
+        self.assertEqual(self.scalar('SELECT stock_quantity FROM wholesale_products WHERE id = ?', (second_id,)), 1)
+        self.assertAlmostEqual(self.scalar('SELECT total_earnings FROM users WHERE id = 1'), 32.0)
+        self.assertEqual(self.scalar("SELECT COUNT(*) FROM transactions WHERE source = 'wholesale'"), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import unittest
+import tempfile
+import os
+import sqlite3
+from app import app, init_db, record_wholesale_order
+from database import db, telemetry_db
+from ledger import Ledger, ledger
+from money import to_dollars
+
+class LedgerTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up test database"""
+        self.db_fd, app.config['DATABASE'] = tempfile.mkstemp()
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        init_db()
+        with db.session() as conn:
+            conn.execute("INSERT INTO users (name, email) VALUES ('Sharer', 's@x.co')")
+            conn.execute("INSERT INTO users (name, email) VALUES ('Partner', 'p@x.co')")
+
+    def tearDown(self):
+        """Clean up test database"""
+        os.close(self.db_fd)
+        for path in (app.config['DATABASE'], telemetry_db.path):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def test_share_bonus_is_a_single_posting(self):
+        """Test a balance change appends two balanced entries and updates the cached total"""
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+        self.assertTrue(self.app.post('/track_share', json={'platform': 'whatsapp'}).get_json()['success'])
+
+        with db.session() as conn:
+            entries = conn.execute('SELECT account, amount, source, transaction_id FROM ledger_entries').fetchall()
+            self.assertEqual([entry[:3] for entry in entries],
+                             [('user:1', 0.25, 'share_bonus'), ('platform:share_bonus', -0.25, 'share_bonus')])
+            self.assertIsNotNone(entries[0][3])
+            self.assertEqual(ledger.balance(conn, 1), 25)
+            self.assertEqual(conn.execute('SELECT total_earnings FROM users WHERE id = 1').fetchone()[0], 0.25)
+
+            with self.assertRaises(sqlite3.IntegrityError):
+                conn.execute('UPDATE ledger_entries SET amount = 100')
+            with self.assertRaises(sqlite3.IntegrityError):
+                conn.execute('DELETE FROM ledger_entries')
+
+    def test_balances_read_checkpoints_plus_tail(self):
+        """Test checkpointing in batches leaves every balance and the report unchanged"""
+        batched = Ledger(db, batch_size=3)
+        with db.session() as conn:
+            batched.post_many(conn, [(1, 100, 'affiliate', None), (2, 250, 'wholesale', None),
+                                     (1, 50, 'affiliate', None)])
+        with db.session() as conn:
+            before = (batched.balance(conn, 1), batched.balance(conn, 2), batched.report(conn))
+            self.assertEqual(batched.checkpoint(conn), 6)
+            self.assertEqual(batched.checkpoint(conn), 0)
+            batched.post(conn, 1, 25, 'share_bonus')  # the tail above the checkpoint
+        with db.session() as conn:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM ledger_checkpoints').fetchone()[0], 4)
+            self.assertEqual(before[:2], (150, 250))
+            self.assertEqual((batched.balance(conn, 1), batched.balance(conn, 2)), (175, 250))
+            report = batched.report(conn)
+        self.assertEqual(before[2]['users_total'], 4.0)
+        self.assertEqual(report['users_total'], 4.25)
+        self.assertEqual(report['platform'], {'affiliate': -1.5, 'share_bonus': -0.25, 'wholesale': -2.5})
+        self.assertEqual(report['trial_balance'], 0)
+        self.assertEqual(report['checkpoint_entry_id'], 6)
+
+    def test_wholesale_order_posts_once_per_partner(self):
+        """Test a cart posts one ledger entry pair per partner, linked to its transaction"""
+        product = (1, 1, 'Rice', 1000, 1000, 2)  # price in cents, commission in basis points
+        with db.session() as conn:
+            record_wholesale_order(conn.cursor(), 1, {1: 2, 2: 3}, {1: product, 2: (2,) + product[1:]})
+            rows = conn.execute('''
+                SELECT l.account, l.amount, t.reference_id FROM ledger_entries l
+                JOIN transactions t ON t.id = l.transaction_id ORDER BY l.id
+            ''').fetchall()
+            self.assertEqual(rows, [('user:2', 5.0, 'WO-1-2'), ('platform:wholesale', -5.0, 'WO-1-2')])
+            self.assertEqual(ledger.balance(conn, 2), 500)
+
+    def test_deleting_a_user_closes_their_ledger_account(self):
+        """Test a deleted user's balance moves to the platform and the ledger still reconciles"""
+        with db.session() as conn:
+            ledger.post_many(conn, [(1, 300, 'affiliate', None), (2, 200, 'affiliate', None)])
+            ledger.checkpoint(conn)
+            ledger.post(conn, 1, 45, 'share_bonus')  # still in the tail
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 2
+            sess['is_admin'] = True
+        self.assertTrue(self.app.post('/admin/delete_user', json={'user_id': 1}).get_json()['success'])
+
+        with db.session() as conn:
+            self.assertEqual(ledger.balance(conn, 1), 0)
+            report = ledger.report(conn)
+            earnings = conn.execute('SELECT SUM(earnings_cents) FROM users').fetchone()[0]
+            closing = conn.execute('''
+                SELECT account, amount_cents FROM ledger_entries WHERE source = 'account_closure' ORDER BY id
+            ''').fetchall()
+        self.assertEqual(report['users_total'], to_dollars(earnings))
+        self.assertEqual(report['users_total'], 2.0)
+        self.assertEqual(report['platform']['account_closure'], 3.45)
+        self.assertEqual(report['trial_balance'], 0)
+        self.assertEqual(closing, [('user:1', -345), ('platform:account_closure', 345)])
+
+if __name__ == '__main__':
+    unittest.main()
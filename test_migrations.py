@@ -0,0 +1,130 @@
+import unittest
+import tempfile
+import os
+import sqlite3
+import threading
+from app import app, init_db
+from database import db, telemetry_db
+from migrations import Migrator, schema, telemetry_schema
+from ledger import ledger
+
+# Tables as the first release created them, before any versioned migration
+LEGACY_SCHEMA = '''
+    CREATE TABLE users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, email TEXT UNIQUE NOT NULL, phone TEXT,
+        password_hash TEXT NOT NULL DEFAULT '', total_earnings REAL DEFAULT 0, referral_code TEXT UNIQUE,
+        referrer_id INTEGER, status TEXT DEFAULT 'active', premium_until DATE, email_verified BOOLEAN DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, amount REAL NOT NULL, type TEXT NOT NULL,
+        status TEXT DEFAULT 'completed', description TEXT, reference_id TEXT UNIQUE,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE shares (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, platform TEXT NOT NULL, referral_code TEXT,
+        shared_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE wholesale_sales (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, product_id INTEGER NOT NULL, partner_id INTEGER NOT NULL,
+        buyer_id INTEGER NOT NULL, quantity INTEGER NOT NULL, unit_price REAL NOT NULL, total_amount REAL NOT NULL,
+        commission_amount REAL NOT NULL, commission_rate REAL NOT NULL, status TEXT DEFAULT 'completed',
+        sale_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    INSERT INTO users (name, email, total_earnings) VALUES ('Old', 'old@x.co', 5);
+    INSERT INTO transactions (user_id, amount, type) VALUES (1, 5, 'bonus');
+    INSERT INTO shares (user_id, platform) VALUES (1, 'whatsapp');
+'''
+
+class MigrationTestCase(unittest.TestCase):
+    def setUp(self):
+        """Point the app at an empty database file"""
+        self.db_fd, app.config['DATABASE'] = tempfile.mkstemp()
+        app.config['TESTING'] = True
+
+    def tearDown(self):
+        """Clean up both database files and their lock files"""
+        os.close(self.db_fd)
+        for path in (app.config['DATABASE'], telemetry_db.path):
+            for suffix in ('', '.migrate.lock'):
+                try:
+                    os.unlink(path + suffix)
+                except OSError:
+                    pass
+
+    def user_version(self, database):
+        with database.session() as conn:
+            return conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def test_current_schema_is_a_single_version_check(self):
+        """Test a migrated file skips every migration on the next startup"""
+        init_db()
+        self.assertEqual(self.user_version(db), schema.latest)
+        self.assertEqual(self.user_version(telemetry_db), telemetry_schema.latest)
+
+        # The pool is LIFO, so migrate() picks up the traced connection
+        statements = []
+        conn, path = db.acquire()
+        conn.set_trace_callback(statements.append)
+        db.release(conn, path)
+        try:
+            self.assertEqual(schema.migrate(), [])
+        finally:
+            conn.set_trace_callback(None)
+        self.assertEqual(statements, ['PRAGMA user_version'])
+
+    def test_concurrent_workers_migrate_once(self):
+        """Test workers starting together apply each migration exactly once"""
+        applied = []
+        threads = [threading.Thread(target=lambda: applied.extend(schema.migrate())) for _ in range(4)]
+        telemetry_schema.migrate()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(applied), list(range(1, schema.latest + 1)))
+
+    def test_unversioned_database_is_upgraded(self):
+        """Test a pre-versioning database gains the later columns and loses its telemetry"""
+        with sqlite3.connect(app.config['DATABASE']) as conn:
+            conn.executescript(LEGACY_SCHEMA)
+
+        init_db()
+
+        with db.session() as conn:
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(transactions)')}
+            self.assertTrue({'payment_method', 'source'} <= columns)
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'shares'").fetchone()[0], 0)
+            self.assertEqual(conn.execute('SELECT name, total_earnings, earnings_cents FROM users').fetchone(),
+                             ('Old', 5, 500))
+            # Existing earnings open the ledger without being counted twice
+            self.assertEqual(ledger.balance(conn, 1), 500)
+        with telemetry_db.session() as conn:
+            self.assertEqual(conn.execute('SELECT platform FROM shares').fetchone()[0], 'whatsapp')
+
+    def test_failed_migration_leaves_version_unchanged(self):
+        """Test a migration that raises rolls back together with its version bump"""
+        migrator = Migrator(db, 'test')
+
+        @migrator.migration(1)
+        def create_table(conn):
+            """Create a table"""
+            conn.execute('CREATE TABLE migration_probe (id INTEGER)')
+
+        @migrator.migration(2)
+        def broken(conn):
+            """Half-done migration"""
+            conn.execute('ALTER TABLE migration_probe ADD COLUMN name TEXT')
+            raise RuntimeError('boom')
+
+        with self.assertRaises(RuntimeError):
+            migrator.migrate()
+        self.assertEqual(self.user_version(db), 1)
+        with db.session() as conn:
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(migration_probe)')]
+        self.assertEqual(columns, ['id'])
+        with self.assertRaises(ValueError):
+            migrator.migration(5)(lambda conn: None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import unittest
+import tempfile
+import os
+import sqlite3
+from app import app, init_db, backfill_money_columns, rebuild_money_rollups
+from database import db, telemetry_db
+from ledger import ledger
+from money import to_cents, parse_cents, to_basis_points, apply_rate, to_dollars
+
+class MoneyTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up test database"""
+        self.db_fd, app.config['DATABASE'] = tempfile.mkstemp()
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        init_db()
+
+    def tearDown(self):
+        """Clean up test database"""
+        os.close(self.db_fd)
+        for path in (app.config['DATABASE'], telemetry_db.path):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def test_conversions_round_half_up_in_whole_cents(self):
+        """Test dollar and rate conversions and commissions stay exact"""
+        self.assertEqual([to_cents(x) for x in (0.285, 1.005, '19.99', -0.285)], [29, 101, 1999, -29])
+        self.assertEqual(to_basis_points(0.15), 1500)
+        self.assertEqual(apply_rate(1999, 500), 100)  # 5% of $19.99 is $0.9995
+        self.assertEqual(sum(apply_rate(10, 1000) for _ in range(10)), 10)
+        self.assertEqual(to_dollars(1999), 19.99)
+
+    def test_amounts_are_validated_in_cents(self):
+        """Test sub-cent, non-finite and missing amounts get the form's error message"""
+        self.assertEqual([parse_cents(text) for text in ('19.99', ' 5 ', '0.001', 'nan', 'inf', '1e999999', None, 'x')],
+                         [1999, 500, 0, None, None, None, None, None])
+        with db.session() as conn:
+            conn.execute("INSERT INTO users (name, email) VALUES ('Payer', 'p@x.co')")
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+        for amount in ('0.001', 'nan', 'inf'):
+            rv = self.app.post('/payment', data={'amount': amount, 'phone': '252610000000'})
+            self.assertEqual(rv.status_code, 302)
+            with self.app.session_transaction() as sess:
+                self.assertEqual(sess.pop('_flashes'), [('message', 'Fadlan geli lacag sax ah.')])
+
+        product = {'product_name': 'Rice', 'category': 'food', 'price': '10'}
+        for fields in ({'price': ''}, {'wholesale_price': '-1'}, {'stock_quantity': '-5'}, {'stock_quantity': 'many'}):
+            rv = self.app.post('/wholesale/add_product', data=dict(product, **fields))
+            self.assertEqual(rv.status_code, 302)
+            with self.app.session_transaction() as sess:
+                self.assertEqual(sess.pop('_flashes'), [('message', 'Fadlan buuxi dhammaan macluumaadka product-ka.')])
+        with db.session() as conn:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM transactions').fetchone()[0], 0)
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM wholesale_products').fetchone()[0], 0)
+
+    def test_backfill_fills_existing_rows_in_chunks(self):
+        """Test REAL-only rows, ledger entries included, get their integer columns and rollups"""
+        with db.session() as conn:
+            conn.executemany('INSERT INTO users (name, email) VALUES (?, ?)',
+                             [(f'User {i}', f'user{i}@x.co') for i in range(1, 6)])
+            ledger.post_many(conn, [(1, 101, 'affiliate', None), (2, 202, 'affiliate', None)])
+            ledger.checkpoint(conn)
+            # Rows and checkpoints as they were before the integer columns existed
+            conn.execute('UPDATE ledger_checkpoints SET balance_cents = 0')
+            conn.execute('DROP TRIGGER trg_transactions_cents_insert')
+            conn.execute('DROP TRIGGER trg_ledger_entries_cents_insert')
+            conn.executemany('INSERT INTO transactions (user_id, amount, type) VALUES (?, ?, ?)',
+                             [(1, 0.285, 'earning')] * 7)
+            conn.execute('''
+                INSERT INTO ledger_entries (account, amount, source)
+                VALUES ('user:3', 3.03, 'affiliate'), ('platform:affiliate', -3.03, 'affiliate')
+            ''')
+        self.assertRaises(sqlite3.IntegrityError, self.change_cents, 1)
+
+        with db.session() as conn:
+            self.assertEqual(backfill_money_columns(conn, batch_size=3), 5 + 7 + 2)
+            self.assertEqual(backfill_money_columns(conn, batch_size=3), 0)
+            rebuild_money_rollups(conn)
+            self.assertEqual(conn.execute('SELECT SUM(amount_cents) FROM transactions').fetchone()[0], 7 * 29)
+            self.assertEqual(conn.execute('SELECT SUM(amount_total_cents) FROM daily_transaction_totals').fetchone()[0],
+                             7 * 29)
+            self.assertEqual([ledger.balance(conn, user_id) for user_id in range(1, 4)], [101, 202, 303])
+            self.assertEqual(conn.execute('SELECT earnings_cents FROM users WHERE id = 3').fetchone()[0], 303)
+            self.assertEqual(ledger.report(conn)['trial_balance'], 0)
+        self.assertRaises(sqlite3.IntegrityError, self.change_cents, 5)
+
+    def change_cents(self, entry_id):
+        """Filled-in entries cannot be changed"""
+        with db.session() as conn:
+            conn.execute('UPDATE ledger_entries SET amount_cents = 0 WHERE id = ?', (entry_id,))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+import tempfile
+import os
+import io
+import json
+from app import app, init_db, migrate_database
+from database import db
+from product_import import product_importer
+
+class ProductImportTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up test database with two partners, one owning an existing SKU"""
+        self.db_fd, app.config['DATABASE'] = tempfile.mkstemp()
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        init_db()
+        migrate_database()
+        with db.session() as conn:
+            for name in ('Hodan', 'Other'):
+                user_id = conn.execute('INSERT INTO users (name, email) VALUES (?, ?)',
+                                       (name, f'{name}@x.co')).lastrowid
+                conn.execute('''
+                    INSERT INTO wholesale_partners (user_id, company_name, contact_person, business_email,
+                                                    business_type, product_category, status)
+                    VALUES (?, ?, ?, ?, 'retail', 'energy', 'approved')
+                ''', (user_id, f'{name} Trading', name, f'{name}@x.co'))
+            conn.execute('''
+                INSERT INTO wholesale_products (partner_id, product_name, price, category, sku, stock_quantity)
+                VALUES (1, 'Old Lamp', 5.0, 'energy', 'LAMP-1', 1), (2, 'Their Fan', 9.0, 'energy', 'FAN-1', 1)
+            ''')
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 1
+        product_importer.chunk_size = 100
+        self.addCleanup(setattr, product_importer, 'chunk_size', 500)
+
+    def tearDown(self):
+        """Clean up test database"""
+        os.close(self.db_fd)
+        try:
+            os.unlink(app.config['DATABASE'])
+        except:
+            pass
+
+    def scalar(self, sql, params=()):
+        with db.session() as conn:
+            return conn.execute(sql, params).fetchone()[0]
+
+    def upload(self, name, text):
+        return self.app.post('/wholesale/import', data={'file': (io.BytesIO(text.encode()), name)},
+                             content_type='multipart/form-data')
+
+    def test_csv_import_upserts_in_chunks_and_reports_bad_rows(self):
+        """Test a large CSV inserts, updates by SKU and records row errors"""
+        lines = ['product_name,price,category,sku,stock_quantity']
+        lines += [f'Panel {i},{10 + i},energy,,{i}' for i in range(250)]
+        lines += ['New Lamp,6.5,energy,LAMP-1,7',      # updates our own SKU
+                  'Stolen Fan,1,energy,FAN-1,1',       # another partner's SKU
+                  ',3,energy,,1',                      # missing name
+                  'Cheap,abc,energy,,1',               # bad price
+                  'Dup,2,energy,LAMP-1,1']             # repeated in file
+        rv = self.upload('catalog.csv', '\n'.join(lines) + '\n')
+        self.assertEqual(rv.status_code, 202)
+        import_id = rv.get_json()['import_id']
+        self.assertEqual(self.app.get(f'/wholesale/import/{import_id}').get_json()['status'], 'queued')
+
+        self.assertEqual(product_importer.run_once(), import_id)
+
+        progress = self.app.get(f'/wholesale/import/{import_id}').get_json()
+        self.assertEqual((progress['status'], progress['percent']), ('completed', 100))
+        self.assertEqual((progress['rows_processed'], progress['inserted'], progress['updated'],
+                          progress['failed']), (255, 250, 1, 4))
+        self.assertEqual(self.scalar('SELECT COUNT(DISTINCT sku) FROM wholesale_products WHERE partner_id = 1'), 251)
+        self.assertEqual(self.scalar("SELECT stock_quantity FROM wholesale_products WHERE sku = 'LAMP-1'"), 7)
+        self.assertEqual(self.scalar("SELECT product_name FROM wholesale_products WHERE sku = 'FAN-1'"), 'Their Fan')
+
+        report = self.app.get(f'/wholesale/import/{import_id}/errors.csv').data.decode().splitlines()
+        self.assertEqual([line.split(',')[0] for line in report], ['row', '253', '254', '255', '256'])
+        self.assertIn('another partner', report[1])
+
+    def test_jsonl_import_and_ownership(self):
+        """Test JSONL uploads import and other partners cannot see the job"""
+        records = [json.dumps({'product_name': 'Kettle', 'price': 12, 'category': 'home', 'sku': 'KET-1'}),
+                   'not json']
+        import_id = self.upload('catalog.jsonl', '\n'.join(records)).get_json()['import_id']
+        product_importer.run_once()
+
+        progress = self.app.get(f'/wholesale/import/{import_id}').get_json()
+        self.assertEqual((progress['inserted'], progress['failed']), (1, 1))
+        self.assertAlmostEqual(self.scalar("SELECT wholesale_price FROM wholesale_products WHERE sku = 'KET-1'"), 8.4)
+
+        self.assertFalse(self.upload('catalog.xlsx', 'x').get_json()['success'])
+        with self.app.session_transaction() as sess:
+            sess['user_id'] = 2
+        self.assertEqual(self.app.get(f'/wholesale/import/{import_id}').status_code, 404)
+
+if __name__ == '__main__':
+    unittest.main()
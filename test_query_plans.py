@@ -0,0 +1,129 @@
+import unittest
+import tempfile
+import os
+import ast
+import re
+import sqlite3
+import app as app_module
+from app import app, init_db
+from database import db, telemetry_db
+from affiliate_rollups import affiliate_rollups
+
+APP_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+
+SQL_STATEMENT = re.compile(r'\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\s')
+TABLE_SCAN = re.compile(r'SCAN (\w+)$')
+PLAN_TABLE = re.compile(r'(?:SCAN|SEARCH) (\w+)')
+
+# Functions whose statements read whole tables on purpose
+ALLOWED_FUNCTIONS = {
+    'rebuild_platform_rollups': 'rebuilds the admin rollups from every row',
+    'add_legacy_columns': 'one-off referral_count backfill',
+    'move_telemetry_tables': 'looks tables up in sqlite_master',
+    'add_user_summary': 'one-off backfill of the dashboard read model',
+    'add_ledger': 'one-off opening-balance postings',
+    'rebuild_money_rollups': 'rebuilds the integer rollup columns from every row',
+    'backfill_money_columns': 'walks every row once by rowid; the checkpoint refresh reads them all',
+    'backfill_money_command': 'resets the backfill jobs by prefix',
+    'add_summary_and_counter_cents': 'one-off backfill of the integer summary columns',
+}
+
+# Small summary tables kept up to date by triggers; reading them whole is the point
+SUMMARY_TABLES = {'marketplace_facets', 'daily_transaction_totals', 'user_status_totals', 'referral_status_totals'}
+
+def app_statements():
+    """Yield (function, line, sql) for every literal SQL statement in app.py.
+
+    Statements assembled with f-strings are skipped here; the page builders
+    are covered by tracing the SQL they actually run.
+    """
+    with open(APP_SOURCE) as source:
+        tree = ast.parse(source.read())
+    for function in ast.walk(tree):
+        if not isinstance(function, ast.FunctionDef):
+            continue
+        fragments = {id(value) for node in ast.walk(function) if isinstance(node, ast.JoinedStr)
+                     for value in node.values}
+        for node in ast.walk(function):
+            if (isinstance(node, ast.Constant) and isinstance(node.value, str)
+                    and id(node) not in fragments and SQL_STATEMENT.match(node.value)):
+                yield function.name, node.lineno, node.value
+
+def plan_problems(conn, sql, params=()):
+    """Full table scans and temp B-tree sorts in the statement's query plan"""
+    plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+    tables = {match.group(1) for detail in plan for match in [PLAN_TABLE.match(detail)] if match}
+    if tables and tables <= SUMMARY_TABLES:
+        return []
+    return [detail for detail in plan if TABLE_SCAN.match(detail) or 'TEMP B-TREE' in detail]
+
+class QueryPlanTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up test database with both files attached, as report connections see them"""
+        self.db_fd, app.config['DATABASE'] = tempfile.mkstemp()
+        app.config['TESTING'] = True
+        init_db()
+        self.conn = sqlite3.connect(db.path)
+        self.conn.execute('ATTACH DATABASE ? AS telemetry', (telemetry_db.path,))
+
+    def tearDown(self):
+        """Clean up test database"""
+        self.conn.close()
+        os.close(self.db_fd)
+        for path in (app.config['DATABASE'], telemetry_db.path):
+            for suffix in ('', '.migrate.lock'):
+                try:
+                    os.unlink(path + suffix)
+                except OSError:
+                    pass
+
+    def test_route_statements_use_indexes(self):
+        """Test no literal statement in app.py scans a table or sorts in a temp B-tree"""
+        checked = 0
+        for function, line, sql in app_statements():
+            if function in ALLOWED_FUNCTIONS:
+                continue
+            with self.subTest(function=function, line=line):
+                self.assertEqual(plan_problems(self.conn, sql, [None] * sql.count('?')), [],
+                                 ' '.join(sql.split()))
+            checked += 1
+        self.assertGreater(checked, 50)
+
+    def test_page_builders_use_indexes(self):
+        """Test every sort order of the keyset-paginated listings, first and later pages"""
+        statements = []
+        self.conn.set_trace_callback(statements.append)
+        cursor = self.conn.cursor()
+        after = app_module.encode_page_cursor(['2024-01-01 00:00:00', 100])
+        for page in (None, after):
+            for sort in app_module.USER_LIST_SORTS:
+                app_module.fetch_users_page(cursor, sort=sort, after=page)
+                app_module.fetch_users_page(cursor, status='active', sort=sort, after=page)
+            for sort in app_module.CATALOG_SORTS:
+                app_module.fetch_catalog_page(cursor, sort=sort, after=page)
+            for sort in app_module.MARKETPLACE_SORTS:
+                app_module.fetch_marketplace_page(cursor, sort=sort, after=page)
+                app_module.fetch_marketplace_page(cursor, category='electronics', sort=sort, after=page)
+            app_module.fetch_wholesale_page(cursor, after=page)
+        self.conn.set_trace_callback(None)
+
+        for sql in statements:
+            with self.subTest(sql=' '.join(sql.split())):
+                self.assertEqual(plan_problems(self.conn, sql), [])
+
+    def test_affiliate_stats_read_only_the_live_tail(self):
+        """Test the stats behind every dashboard and ETag check seek to the user's clicks above the watermark"""
+        statements = []
+        self.conn.set_trace_callback(statements.append)
+        affiliate_rollups.user_stats(self.conn, 1)
+        self.conn.set_trace_callback(None)
+
+        plans = []
+        for sql in statements:
+            with self.subTest(sql=' '.join(sql.split())):
+                self.assertEqual(plan_problems(self.conn, sql), [])
+            plans += [row[3] for row in self.conn.execute('EXPLAIN QUERY PLAN ' + sql)]
+        self.assertIn('SEARCH affiliate_clicks USING INDEX idx_affiliate_clicks_user_tail (user_id=? AND id>?)', plans)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+import tempfile
+import os
+from datetime import datetime, timedelta
+from app import app, init_db
+from database import db, telemetry_db
+from ledger import ledger
+from reconciliation import Reconciler, reconciler
+
+class ReconciliationTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up test database with a few users paid through the ledger"""
+        self.db_fd, app.config['DATABASE'] = tempfile.mkstemp()
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        init_db()
+        with db.session() as conn:
+            conn.executemany('INSERT INTO users (name, email) VALUES (?, ?)',
+                             [(f'User {i}', f'user{i}@x.co') for i in range(1, 8)])
+            ledger.post_many(conn, [(user_id, user_id * 150, 'affiliate', None) for user_id in range(1, 8)])
+
+    def tearDown(self):
+        """Clean up test database"""
+        os.close(self.db_fd)
+        for path in (app.config['DATABASE'], telemetry_db.path):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def drift(self):
+        with db.session() as conn:
+            return conn.execute('SELECT user_id, stored_balance, ledger_balance FROM balance_drift').fetchall()
+
+    def test_incremental_run_checks_only_touched_users(self):
+        """Test a direct balance edit is caught by the next run and cleared once fixed"""
+        with db.session() as conn:
+            self.assertEqual(reconciler.run(conn), (7, 0))
+            self.assertEqual(reconciler.run(conn), (0, 0))
+            ledger.checkpoint(conn)
+            conn.execute('UPDATE users SET total_earnings = 99 WHERE id = 3')  # bypasses the ledger
+            ledger.post(conn, 5, 25, 'share_bonus')
+        with db.session() as conn:
+            self.assertEqual(reconciler.run(conn), (2, 1))
+            report = reconciler.report(conn)
+        self.assertEqual(self.drift(), [(3, 99, 4.5)])
+        self.assertEqual((report['drifted_users'], report['total_drift'], report['pending_changes']), (1, 94.5, 0))
+
+        with db.session() as conn:
+            conn.execute('UPDATE users SET total_earnings = 4.5 WHERE id = 3')
+            self.assertEqual(reconciler.run(conn), (1, 0))
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM balance_changes').fetchone()[0], 0)
+        self.assertEqual(self.drift(), [])
+
+    def test_full_run_walks_every_user_in_batches(self):
+        """Test a full run finds drift the change queue never saw"""
+        with db.session() as conn:
+            conn.execute('UPDATE users SET total_earnings = 0 WHERE id IN (2, 6)')
+            conn.execute('DELETE FROM balance_changes')
+            ledger.checkpoint(conn)
+            self.assertEqual(Reconciler(db, ledger, batch_size=3).run_full(conn), (7, 2))
+        self.assertEqual(sorted(self.drift()), [(2, 0, 3.0), (6, 0, 9.0)])
+
+    def test_full_run_reads_only_the_batch_tail(self):
+        """Test a long unfolded tail is summed per batch account through idx_ledger_account"""
+        with db.session() as conn:
+            conn.executemany('INSERT INTO users (name, email) VALUES (?, ?)',
+                             [(f'User {i}', f'user{i}@x.co') for i in range(8, 201)])
+            ledger.post_many(conn, [(user_id, 1, 'share_bonus', None)
+                                    for user_id in range(1, 201) for _ in range(10)])
+            conn.execute('UPDATE users SET total_earnings = 0 WHERE id = 150')
+
+        statements = []
+        with db.session() as conn:
+            conn.set_trace_callback(lambda sql: statements.append(sql) if 'WITH tail' in sql else None)
+            self.assertEqual(Reconciler(db, ledger, batch_size=50).run_full(conn), (200, 1))
+            conn.set_trace_callback(None)
+            plan = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {statements[0]}')]
+        self.assertEqual(len(statements), 4)
+        self.assertIn('SEARCH ledger_entries USING COVERING INDEX idx_ledger_account (account=? AND id>?)', plan)
+        self.assertEqual(self.drift(), [(150, 0, 0.1)])
+
+    def test_referral_bonus_has_a_transaction(self):
+        """Test verify_email() records the referrer's $5 bonus as a transaction and a posting"""
+        with db.session() as conn:
+            conn.execute('INSERT INTO email_verification_codes (email, code, expires_at) VALUES (?, ?, ?)',
+                         ('new@x.co', '123456', datetime.now() + timedelta(minutes=10)))
+        with self.app.session_transaction() as sess:
+            sess['pending_user'] = {'name': 'New', 'email': 'new@x.co', 'phone': None, 'password_hash': 'x',
+                                    'referral_code': 'DADAAL-NEW', 'referrer_id': 1}
+        self.app.post('/verify_email', data={'verification_code': '123456'})
+
+        with db.session() as conn:
+            self.assertEqual(conn.execute('''
+                SELECT t.amount, t.type, l.amount FROM transactions t
+                JOIN ledger_entries l ON l.transaction_id = t.id AND l.account = 'user:1'
+            ''').fetchall(), [(5.0, 'referral', 5.0)])
+            self.assertEqual(reconciler.run(conn)[1], 0)
+
+if __name__ == '__main__':
+    unittest.main()